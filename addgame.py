@@ -5,17 +5,19 @@ import db
 import handler
 import tornado.web
 import settings
+import workers
 
 class AddGameHandler(handler.BaseHandler):
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.render("addgame.html", 
-                    unusedPointsIncrement=db.unusedPointsIncrement(),
+                    unusedPointsIncrement=await workers.run_db(
+                        db.unusedPointsIncrement),
                     fourplayertotal='{:,d}'.format(4 * settings.SCOREPERPLAYER))
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         scores = self.get_argument('scores', None)
 
         scores = json.loads(scores)
 
-        self.write(json.dumps(db.addGame(scores)))
+        self.write(json.dumps(await workers.run_db(db.addGame, scores)))
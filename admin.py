@@ -1,157 +1,209 @@
 #!/usr/bin/env python3
 
 import json
+import datetime
 
 import handler
 import db
 import util
 import settings
+import workers
+import backup
+import cache
+import push
+import exportgames
 
 class AdminPanelHandler(handler.BaseHandler):
     @handler.is_admin
     def get(self):
         self.render("admin.html")
 
+class StatsHandler(handler.BaseHandler):
+    @handler.is_admin_ajax
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'status': 0, 'dbpool': db.poolStats(),
+                               'workers': workers.statistics(),
+                               'backups': backup.statistics(),
+                               'cache': cache.statistics(),
+                               'push': push.statistics()}))
+
+class ExportHandler(handler.BaseHandler):
+    """Stream the scores as CSV, NDJSON, or columnar JSON.  Each chunk of
+    rows is read in the database pool and flushed to the client before the
+    next is read, so the export never sits in memory."""
+    extensions = {'csv': 'csv', 'ndjson': 'ndjson', 'columnar': 'json'}
+
+    @handler.is_admin
+    async def get(self):
+        fmt = self.get_argument('format', 'csv')
+        if fmt not in exportgames.writers:
+            return self.render("message.html", title="Export",
+                               message="Unknown export format " + fmt)
+        writer = exportgames.writers[fmt]()
+        chunks = exportgames.exportChunks(
+            quarter=self.get_argument('quarter', None),
+            start=self.get_argument('from', None),
+            end=self.get_argument('to', None),
+            player=self.get_argument('player', None))
+        try:
+            rows = await workers.run_db(next, chunks, None)
+        except LookupError as e:
+            return self.render("message.html", message=str(e), title="Export")
+        self.set_header('Content-Type', writer.content_type)
+        self.set_header(
+            'Content-Disposition', 'attachment; filename="scores-{0}.{1}"'.format(
+                datetime.date.today().isoformat(), self.extensions[fmt]))
+        try:
+            self.write(writer.header())
+            while rows is not None:
+                self.write(writer.write(rows))
+                await self.flush()
+                rows = await workers.run_db(next, chunks, None)
+            self.write(writer.footer())
+        finally:
+            await workers.run_db(chunks.close)
+
 class ManageUsersHandler(handler.BaseHandler):
     @handler.is_admin
-    def get(self):
-        with db.getCur() as cur:
-            cur.execute("SELECT Users.Id, Email, Password, Admins.Id FROM Users LEFT JOIN Admins ON Admins.Id = Users.Id")
-            users = []
-            for row in cur.fetchall():
-                users += [{
-                            "Id":row[0],
-                            "Email":row[1],
-                            "Admin":row[3] is not None,
-                        }]
-            self.render("users.html", users = users)
+    async def get(self):
+        rows = await workers.fetchall("SELECT Users.Id, Email, Password, Admins.Id FROM Users LEFT JOIN Admins ON Admins.Id = Users.Id")
+        users = []
+        for row in rows:
+            users += [{
+                        "Id":row[0],
+                        "Email":row[1],
+                        "Admin":row[3] is not None,
+                    }]
+        self.render("users.html", users = users)
 
 class PromoteUserHandler(handler.BaseHandler):
     @handler.is_admin
-    def get(self, q):
-        with db.getCur() as cur:
-            cur.execute("SELECT Email FROM Users WHERE Id = ?", (q,))
-            row = cur.fetchone()
-            if len(row) == 0:
-                self.render("message.html", message = "User not found", title = "Promote User")
-            else:
-                self.render("promoteuser.html", email = row[0], q = q)
+    async def get(self, q):
+        row = await workers.fetchone("SELECT Email FROM Users WHERE Id = ?", (q,))
+        if row is None or len(row) == 0:
+            self.render("message.html", message = "User not found", title = "Promote User")
+        else:
+            self.render("promoteuser.html", email = row[0], q = q)
     @handler.is_admin
-    def post(self, q):
-        with db.getCur() as cur:
-            cur.execute("SELECT EXISTS(SELECT * FROM Users WHERE Id = ?)", (q,))
-            if cur.fetchone()[0] == 1:
-                cur.execute("INSERT INTO Admins(Id) VALUES(?)", (q,))
-            self.redirect("/admin/users")
+    async def post(self, q):
+        await workers.execute("INSERT INTO Admins(Id) SELECT Id FROM Users WHERE Id = ?", (q,))
+        self.redirect("/admin/users")
 
 class DemoteUserHandler(handler.BaseHandler):
     @handler.is_admin
-    def get(self, q):
-        with db.getCur() as cur:
-            cur.execute("SELECT Email FROM Users WHERE Id = ?", (q,))
-            row = cur.fetchone()
-            if len(row) == 0:
-                self.render("message.html", message = "User not found", title = "Demote User")
-            else:
-                self.render("demoteuser.html", email = row[0], q = q)
+    async def get(self, q):
+        row = await workers.fetchone("SELECT Email FROM Users WHERE Id = ?", (q,))
+        if row is None or len(row) == 0:
+            self.render("message.html", message = "User not found", title = "Demote User")
+        else:
+            self.render("demoteuser.html", email = row[0], q = q)
     @handler.is_admin
-    def post(self, q):
-        with db.getCur() as cur:
-            cur.execute("SELECT EXISTS(SELECT * FROM Users WHERE Id = ?)", (q,))
-            if cur.fetchone()[0] == 1:
-                cur.execute("DELETE FROM Admins WHERE Id = ?", (q,))
-            self.redirect("/admin/users")
+    async def post(self, q):
+        await workers.execute("DELETE FROM Admins WHERE Id = ?", (q,))
+        self.redirect("/admin/users")
+
+def deleteGame(gameid):
+    "Delete a game after backing up the database.  Returns False if not found"
+    with db.getCur() as cur:
+        cur.execute("SELECT EXISTS(SELECT * FROM Scores WHERE GameId = ?)", (gameid,))
+        if cur.fetchone()[0] == 0:
+            return False
+        db.make_backup()
+        periodKeys = db.gamePeriodKeys(cur, gameid)
+        pairs = db.gamePairs(cur, gameid)
+        tags = db.gameTags(cur, gameid)
+        cur.execute("DELETE FROM Scores WHERE GameId = ?", (gameid,))
+        db.updatePlayerPeriods(cur, periodKeys)
+        db.updatePairCounts(cur, {}, pairs)
+    cache.invalidate(*tags)
+    return True
 
 class DeleteGameHandler(handler.BaseHandler):
     @handler.is_admin
-    def get(self, q):
-        with db.getCur() as cur:
-            cur.execute("SELECT Rank, Players.Name, Scores.RawScore / 1000.0, Scores.Score, Scores.Chombos FROM Scores INNER JOIN Players ON Players.Id = Scores.PlayerId WHERE GameId = ?", (q,))
-            rows = cur.fetchall()
-            if len(rows) == 0:
-                self.render("message.html", message = "Game not found", title = "Delete Game")
-            else:
-                scores = {}
-                for row in rows:
-                    scores[row[0]] = (row[1], row[2], round(row[3], 2), row[4])
-                self.render("deletegame.html", id=q, scores=scores)
+    async def get(self, q):
+        rows = await workers.fetchall("SELECT Rank, Players.Name, Scores.RawScore / 1000.0, Scores.Score, Scores.Chombos FROM Scores INNER JOIN Players ON Players.Id = Scores.PlayerId WHERE GameId = ?", (q,))
+        if len(rows) == 0:
+            self.render("message.html", message = "Game not found", title = "Delete Game")
+        else:
+            scores = {}
+            for row in rows:
+                scores[row[0]] = (row[1], row[2], round(row[3], 2), row[4])
+            self.render("deletegame.html", id=q, scores=scores)
     @handler.is_admin
-    def post(self, q):
-        with db.getCur() as cur:
-            cur.execute("SELECT EXISTS(SELECT * FROM Scores WHERE GameId = ?)", (q,))
-            if cur.fetchone()[0] == 0:
-                self.render("message.html", message = "Game not found", title = "Delete Game")
-            else:
-                db.make_backup()
-                cur.execute("DELETE FROM Scores WHERE GameId = ?", (q,))
-                self.redirect("/history")
+    async def post(self, q):
+        if await workers.run_db(deleteGame, q):
+            self.redirect("/history")
+        else:
+            self.render("message.html", message = "Game not found", title = "Delete Game")
+
+def editGame(gameid, scores, gamedate):
+    "Replace a game's scores after backing up the database"
+    with db.getCur() as cur:
+        cur.execute("SELECT GameId FROM Scores WHERE GameId = ?", (gameid,))
+        row = cur.fetchone()
+        if row is None or len(row) == 0:
+            return {"status":1, "error":"Game not found"}
+        gameid = row[0]
+
+    db.make_backup()
+    return db.addGame(scores, gamedate, gameid)
 
 class EditGameHandler(handler.BaseHandler):
     @handler.is_admin
-    def get(self, q):
-        with db.getCur() as cur:
-            cur.execute("SELECT Rank, Players.Name, Scores.RawScore, Scores.Chombos, Scores.Date, Players.Id FROM Scores INNER JOIN Players ON Players.Id = Scores.PlayerId WHERE GameId = ? ORDER BY Rank", (q,))
-            rows = cur.fetchall()
-            if len(rows) == 0:
-                self.render("message.html", message = "Game not found", title = "Edit Game")
-            else:
-                unusedPoints = None
-                # UnusedPointsPlayer always sorted last in rank
-                if rows[-1][5] == db.getUnusedPointsPlayerID():
-                    unusedPoints = rows[-1][2]
-                self.render("editgame.html", id=q,
-                            scores=json.dumps(rows).replace("'", "\\'")
-                            .replace("\\\"", "\\\\\""),
-                            unusedPoints=unusedPoints,
-                            unusedPointsIncrement=db.unusedPointsIncrement())
+    async def get(self, q):
+        rows = await workers.fetchall("SELECT Rank, Players.Name, Scores.RawScore, Scores.Chombos, Scores.Date, Players.Id FROM Scores INNER JOIN Players ON Players.Id = Scores.PlayerId WHERE GameId = ? ORDER BY Rank", (q,))
+        if len(rows) == 0:
+            self.render("message.html", message = "Game not found", title = "Edit Game")
+        else:
+            unusedPoints = None
+            unusedPointsPlayerID, unusedPointsIncrement = await workers.run_db(
+                lambda: (db.getUnusedPointsPlayerID(),
+                         db.unusedPointsIncrement()))
+            # UnusedPointsPlayer always sorted last in rank
+            if rows[-1][5] == unusedPointsPlayerID:
+                unusedPoints = rows[-1][2]
+            self.render("editgame.html", id=q,
+                        scores=json.dumps(rows).replace("'", "\\'")
+                        .replace("\\\"", "\\\\\""),
+                        unusedPoints=unusedPoints,
+                        unusedPointsIncrement=unusedPointsIncrement)
     @handler.is_admin_ajax
-    def post(self, q):
+    async def post(self, q):
         scores = self.get_argument('scores', None)
         gamedate = self.get_argument('gamedate', None)
 
         scores = json.loads(scores)
 
-        with db.getCur() as cur:
-            cur.execute("SELECT GameId FROM Scores WHERE GameId = ?", (q,))
-            row = cur.fetchone()
-            if len(row) == 0:
-                self.write('{"status":1, "error":"Game not found"}')
-                return
-            gameid = row[0]
-
-        db.make_backup()
-        self.write(json.dumps(db.addGame(scores, gamedate, gameid)))
+        self.write(json.dumps(
+            await workers.run_db(editGame, q, scores, gamedate)))
 
 class EditQuarterHandler(handler.BaseHandler):
     @handler.is_admin
-    def get(self, q):
-        with db.getCur() as cur:
-            cur.execute("SELECT Quarter, Gamecount, UnusedPointsIncrement "
-                        "FROM Quarters WHERE Quarter = ? ORDER BY Quarter DESC",
-                        (q,))
-            rows = cur.fetchall()
-            if len(rows) == 0:
-                rows = [(q, settings.DROPGAMES, db.unusedPointsIncrement())]
-            if len(rows) > 1:
-                self.render("message.html",
-                            message = "Multiple entries in database for Quarter {0}".format(q),
-                            title = "Database Error",
-                            next = "Manage Quarters",
-                            next_url = "/admin/quarters")
-            else:
-                self.render("editquarter.html", quarters=rows)
+    async def get(self, q):
+        rows = await workers.fetchall(
+            "SELECT Quarter, Gamecount, UnusedPointsIncrement "
+            "FROM Quarters WHERE Quarter = ? ORDER BY Quarter DESC",
+            (q,))
+        if len(rows) == 0:
+            rows = [(q, settings.DROPGAMES,
+                     await workers.run_db(db.unusedPointsIncrement))]
+        if len(rows) > 1:
+            self.render("message.html",
+                        message = "Multiple entries in database for Quarter {0}".format(q),
+                        title = "Database Error",
+                        next = "Manage Quarters",
+                        next_url = "/admin/quarters")
+        else:
+            self.render("editquarter.html", quarters=rows)
 
     @handler.is_admin
-    def post(self, q):
+    async def post(self, q):
         quarter = q
         gamecount = self.get_argument('gamecount', None)
         unusedPointsIncrement = self.get_argument('unusedPointsIncrement', None)
-        with db.getCur() as cur:
-            cur.execute("DELETE FROM Quarters WHERE Quarter = ?;", (quarter,))
-            cur.execute("INSERT INTO Quarters(Quarter, Gamecount, "
-                        "UnusedPointsIncrement) VALUES (?,?,?);",
-                        (quarter, gamecount, unusedPointsIncrement))
-            leaderboard.clearCache()
+        await workers.run_db(updateQuarter, quarter, gamecount,
+                             unusedPointsIncrement)
 
         self.render("message.html",
                     message = "Quarter {0} updated".format(quarter),
@@ -159,46 +211,65 @@ class EditQuarterHandler(handler.BaseHandler):
                     next = "Update more quarters",
                     next_url = "/admin/quarters")
 
+def updateQuarter(quarter, gamecount, unusedPointsIncrement):
+    with db.getCur() as cur:
+        cur.execute("DELETE FROM Quarters WHERE Quarter = ?;", (quarter,))
+        cur.execute("INSERT INTO Quarters(Quarter, Gamecount, "
+                    "UnusedPointsIncrement) VALUES (?,?,?);",
+                    (quarter, gamecount, unusedPointsIncrement))
+    cache.invalidate('quarters', 'quarter:' + quarter)
+
+def quarterSettings():
+    with db.getCur() as cur:
+        cur.execute(
+            "SELECT DISTINCT Scores.Quarter, Gamecount, "
+            " COALESCE(UnusedPointsIncrement, ?)"
+            " FROM Scores LEFT OUTER JOIN Quarters"
+            " ON Scores.Quarter = Quarters.Quarter"
+            " ORDER BY Scores.Quarter DESC",
+            (db.unusedPointsIncrement(),))
+        return cur.fetchall()
+
 class QuartersHandler(handler.BaseHandler):
     @handler.is_admin
-    def get(self):
-        with db.getCur() as cur:
-            cur.execute(
-                "SELECT DISTINCT Scores.Quarter, Gamecount, "
-                " COALESCE(UnusedPointsIncrement, ?)"
-                " FROM Scores LEFT OUTER JOIN Quarters"
-                " ON Scores.Quarter = Quarters.Quarter"
-                " ORDER BY Scores.Quarter DESC",
-                (db.unusedPointsIncrement(),))
-            rows = cur.fetchall()
+    async def get(self):
+        rows = await workers.run_db(quarterSettings)
 
-            self.render("quarters.html",
-                        message = "No quarters found" if len(rows) == 0 else "",
-                        quarters=rows)
+        self.render("quarters.html",
+                    message = "No quarters found" if len(rows) == 0 else "",
+                    quarters=rows)
+
+def deleteQuarter(quarter):
+    """Delete the settings for a quarter if there is exactly one entry for it.
+    Returns the entries found for the quarter."""
+    with db.getCur() as cur:
+        cur.execute("SELECT Quarter, Gamecount FROM Quarters "
+                    "WHERE Quarter = ? ORDER BY Quarter DESC", (quarter,))
+        rows = cur.fetchall()
+        if len(rows) == 1:
+            cur.execute("DELETE FROM Quarters WHERE Quarter = ?", (quarter,))
+    if len(rows) == 1:
+        cache.invalidate('quarters', 'quarter:' + quarter)
+    return rows
 
 class DeleteQuarterHandler(handler.BaseHandler):
     @handler.is_admin
-    def get(self, q):
-        with db.getCur() as cur:
-            cur.execute("SELECT Quarter, Gamecount FROM Quarters "
-                        "WHERE Quarter = ? ORDER BY Quarter DESC", (q,))
-            rows = cur.fetchall()
-            if len(rows) == 0:
-                self.render("message.html",
-                            message = "Quarter {0} not found".format(q),
-                            title = "Quarter Not Found",
-                            next = "Manage quarters",
-                            next_url = "/admin/quarters")
-            elif len(rows) == 1:
-                cur.execute("DELETE FROM Quarters WHERE Quarter = ?", (q,))
-                self.render("message.html",
-                            message = "Quarter {0} deleted".format(q),
-                            title = "Quarter Deleted",
-                            next = "Manage quarters",
-                            next_url = "/admin/quarters")
-            else:
-                self.render("quarters.html",
-                            message = ("Error: Multiple quarters named {0} "
-                                       "found. See Adminstrator.").format(q),
-                            quarters=rows)
-
+    async def get(self, q):
+        rows = await workers.run_db(deleteQuarter, q)
+        if len(rows) == 0:
+            self.render("message.html",
+                        message = "Quarter {0} not found".format(q),
+                        title = "Quarter Not Found",
+                        next = "Manage quarters",
+                        next_url = "/admin/quarters")
+        elif len(rows) == 1:
+            self.render("message.html",
+                        message = "Quarter {0} deleted".format(q),
+                        title = "Quarter Deleted",
+                        next = "Manage quarters",
+                        next_url = "/admin/quarters")
+        else:
+            self.render("quarters.html",
+                        message = ("Error: Multiple quarters named {0} "
+                                   "found. See Adminstrator.").format(q),
+                        quarters=rows)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Online backups of the scores database.  Snapshots are made with SQLite's
+backup API, a few pages at a time, so they are consistent even while games
+are being written and they don't block other database users.  Requests for
+backups made before a change take the first snapshot right away, so it
+holds the data from before the change, and a background thread coalesces
+the requests made within BACKUPDELAY seconds after it into a single later
+snapshot.  Snapshots are
+written to the DBBACKUPS directory, optionally compressed, and older ones
+are pruned according to the retention settings.
+"""
+
+import os
+import time
+import gzip
+import shutil
+import sqlite3
+import logging
+import datetime
+import threading
+import collections
+
+import settings
+
+log = logging.getLogger("WebServer")
+
+def backup_suffix():
+    return "-" + os.path.split(settings.DBFILE)[1]
+
+def snapshot():
+    """Copy the database to a new file in the backups directory and return
+    the new file's path"""
+    if not os.path.isdir(settings.DBBACKUPS):
+        os.makedirs(settings.DBBACKUPS)
+    backupdb = os.path.join(
+        settings.DBBACKUPS,
+        datetime.datetime.now().strftime(settings.DBDATEFORMAT) +
+        backup_suffix())
+    print("Making backup of database {0} to {1}".format(
+        settings.DBFILE, backupdb))
+    partial = backupdb + ".part"
+    source = sqlite3.connect(settings.DBFILE, timeout=settings.DBBUSYTIMEOUT)
+    target = sqlite3.connect(partial)
+    try:
+        with target:
+            source.backup(target, pages=settings.BACKUPPAGES)
+    finally:
+        target.close()
+        source.close()
+    if settings.BACKUPCOMPRESS:
+        backupdb += ".gz"
+        with open(partial, 'rb') as infile, gzip.open(backupdb, 'wb') as out:
+            shutil.copyfileobj(infile, out)
+        os.remove(partial)
+    else:
+        os.replace(partial, backupdb)
+    return backupdb
+
+def backup_files():
+    "List the paths of the backup files, newest first"
+    if not os.path.isdir(settings.DBBACKUPS):
+        return []
+    suffix = backup_suffix()
+    files = []
+    for name in os.listdir(settings.DBBACKUPS):
+        if name.endswith(suffix) or name.endswith(suffix + ".gz"):
+            path = os.path.join(settings.DBBACKUPS, name)
+            files.append((os.path.getmtime(path), path))
+    return [path for mtime, path in sorted(files, reverse=True)]
+
+retention_tiers = [
+    ('BACKUPHOURLY', lambda t: t.strftime("%Y-%m-%d %H")),
+    ('BACKUPDAILY', lambda t: t.strftime("%Y-%m-%d")),
+    ('BACKUPWEEKLY', lambda t: t.strftime("%G-%V")),
+]
+
+def backups_to_keep(files):
+    """Choose which backup files to keep from a list of files ordered newest
+    first.  The newest BACKUPKEEP files are kept along with the newest file
+    in each of the last BACKUPHOURLY hours, BACKUPDAILY days, and
+    BACKUPWEEKLY weeks that have backups.  If none of these settings are
+    positive, all the files are kept."""
+    tiers = [(getattr(settings, name), bucket)
+             for name, bucket in retention_tiers
+             if getattr(settings, name) > 0]
+    if settings.BACKUPKEEP <= 0 and len(tiers) == 0:
+        return set(files)
+    keep = set(files[:max(0, settings.BACKUPKEEP)])
+    for count, bucket in tiers:
+        buckets = set()
+        for path in files:
+            period = bucket(datetime.datetime.fromtimestamp(
+                os.path.getmtime(path)))
+            if period not in buckets:
+                if len(buckets) >= count:
+                    break
+                buckets.add(period)
+                keep.add(path)
+    return keep
+
+def prune():
+    "Remove the backup files that the retention settings don't keep"
+    files = backup_files()
+    keep = backups_to_keep(files)
+    removed = [path for path in files if path not in keep]
+    for path in removed:
+        log.info("Removing old database backup {0}".format(path))
+        os.remove(path)
+    return removed
+
+class BackupManager(threading.Thread):
+    """Background thread that makes coalesced backups.  A request schedules
+    a snapshot BACKUPDELAY seconds later and any requests made before then
+    are folded into it.  A leading request that comes when no snapshot has
+    been started for BACKUPDELAY seconds makes its snapshot immediately in
+    the calling thread instead."""
+    instance = None
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = "Backups"
+        self.condition = threading.Condition()
+        self.due = None
+        self.running = False
+        self.last = None
+        self.started = None
+        self.stats = collections.Counter()
+
+    @classmethod
+    def get_instance(cls):
+        if not cls.instance:
+            cls.instance = cls()
+        return cls.instance
+
+    def request(self, delay=None, leading=False):
+        """Request a snapshot within delay seconds (default BACKUPDELAY).  If
+        leading is true and no snapshot is pending, running, or was started
+        within delay seconds, make it before returning"""
+        if delay is None:
+            delay = settings.BACKUPDELAY
+        with self.condition:
+            self.stats['requested'] += 1
+            now = time.monotonic()
+            lead = (leading and self.due is None and not self.running and
+                    (self.started is None or now - self.started >= delay))
+            if lead:
+                self.running = True
+            elif self.due is None:
+                self.due = now + delay
+            else:
+                self.stats['coalesced'] += 1
+                self.due = min(self.due, now + delay)
+            if not lead:
+                if not self.is_alive():
+                    self.start()
+                self.condition.notify()
+        if lead:
+            self.backup()
+
+    def flush(self):
+        "Make any pending snapshot now, in the calling thread"
+        with self.condition:
+            pending = self.due is not None
+            self.due = None
+        if pending:
+            self.backup()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.due is None or time.monotonic() < self.due:
+                    self.condition.wait(
+                        None if self.due is None else
+                        self.due - time.monotonic())
+                self.due = None
+            self.backup()
+
+    def backup(self):
+        try:
+            self.running = True
+            self.started = time.monotonic()
+            self.last = snapshot()
+            self.stats['snapshots'] += 1
+            self.stats['pruned'] += len(prune())
+        except Exception:
+            self.stats['failures'] += 1
+            log.exception("Database backup failed")
+        finally:
+            self.running = False
+
+    def statistics(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats.update({
+                'pending': self.due is not None, 'running': self.running,
+                'last': self.last, 'count': len(backup_files())})
+        return stats
+
+def request(delay=None, leading=False):
+    """Request a coalesced snapshot of the database in the background, or
+    right away if leading is true and no snapshot was made recently"""
+    BackupManager.get_instance().request(delay, leading)
+
+def flush():
+    "Make any pending snapshot now, e.g. before shutting down"
+    if BackupManager.instance:
+        BackupManager.instance.flush()
+
+def statistics():
+    return BackupManager.get_instance().statistics()
+
+if __name__ == "__main__":
+    snapshot()
+    for path in prune():
+        print("Removed old backup {0}".format(path))
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Cache for results computed from the database, like leaderboards, player
+statistics, and game history pages.  The CACHE setting picks the backend:
+an LRU cache in the server process, a memcached server, or files on disk.
+
+Values are cached with tags naming the data they were computed from, e.g.
+"scores", "players", "player:12", or "quarter:2017 2nd".  Every tag has a
+version stored in the backend, and each value records the versions of its
+tags when it was computed.  Writes invalidate just the tags they touch by
+giving them new versions, which makes the values stored under those tags
+stale without having to know their keys.  Invalidate tags after the write
+is committed so values computed from the old data can't be stored as
+current.  Concurrent misses for the same key share one computation, and
+fetch_stale can return the previous value while a background thread
+recomputes it, e.g.
+
+    stats = cache.fetch("playerstats:12", ["player:12"], computeStats)
+    ...
+    cache.invalidate("player:12", "players")
+"""
+
+import os
+import time
+import uuid
+import pickle
+import hashlib
+import logging
+import tempfile
+import threading
+import collections
+import urllib.parse
+
+import memcache
+
+import settings
+
+log = logging.getLogger("WebServer")
+
+ALL = "*"  # Tag that every value has so that everything can be invalidated
+
+def new_version():
+    return uuid.uuid4().hex
+
+class Flight():
+    "A computation of a cached value that other threads can wait for"
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class Cache():
+    """Base class for cache backends.  Backends implement _get_multi,
+    _set, and _delete for entries that are (value, tag versions) pairs.
+    A ttl of 0 means the entry doesn't expire."""
+    name = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.inflight = {}
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    def tag_versions(self, tags):
+        "Get the current versions of the tags, creating any that are missing"
+        keys = ['tag:' + tag for tag in tags]
+        versions = self._get_multi(keys)
+        for key in keys:
+            if key not in versions:
+                versions[key] = new_version()
+                self._set(key, versions[key], 0)
+        return dict((tag, versions[key]) for tag, key in zip(tags, keys))
+
+    def lookup(self, key):
+        """Get the cached (value, tag versions) entry for a key and whether
+        all its tags are current.  The entry is None if nothing is cached."""
+        entry = self._get_multi([key]).get(key)
+        if entry is None:
+            self.count('misses')
+            return None, False
+        value, versions = entry
+        if self.tag_versions(list(versions.keys())) != versions:
+            self.count('misses')
+            self.count('stale')
+            return entry, False
+        self.count('hits')
+        return entry, True
+
+    def get(self, key, default=None):
+        entry, current = self.lookup(key)
+        return entry[0] if current else default
+
+    def fetch(self, key, tags, compute, ttl=None):
+        """Get the value cached under the key or compute it and cache it
+        with the tags.  Concurrent misses for the same key wait for a
+        single computation."""
+        entry, current = self.lookup(key)
+        if current:
+            return entry[0]
+        return self.compute_once(key, tags, compute, ttl)
+
+    def fetch_stale(self, key, tags, compute, ttl=None):
+        """Like fetch but if the cached value is stale, return it right away
+        and recompute it in a background thread.  Returns the value and
+        whether it is stale.  Stale values are never older than the TTL."""
+        entry, current = self.lookup(key)
+        if current:
+            return entry[0], False
+        if entry is None:
+            return self.compute_once(key, tags, compute, ttl), False
+        with self.lock:
+            revalidate = key not in self.inflight
+        if revalidate:
+            thread = threading.Thread(
+                target=self.revalidate, args=(key, tags, compute, ttl),
+                name="Revalidate " + key, daemon=True)
+            thread.start()
+        self.count('stale_served')
+        return entry[0], True
+
+    def revalidate(self, key, tags, compute, ttl):
+        try:
+            self.compute_once(key, tags, compute, ttl)
+            self.count('revalidations')
+        except Exception:
+            log.exception("Unable to recompute cached {0}".format(key))
+
+    def compute_once(self, key, tags, compute, ttl):
+        """Compute a value and cache it with the tags, unless another thread
+        is already computing the key, in which case wait for its result.
+        The tag versions are read before the value is computed so that an
+        invalidation made while it is computed leaves it stale."""
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Flight()
+        if not leader:
+            self.count('coalesced')
+            return flight.wait()
+        try:
+            versions = self.tag_versions([ALL] + list(tags))
+            flight.value = compute()
+            self._set(key, (flight.value, versions),
+                      settings.CACHETTL if ttl is None else ttl)
+            self.count('sets')
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+
+    def invalidate(self, *tags):
+        "Make all the values cached with any of the tags stale"
+        for tag in set(tags):
+            self._set('tag:' + tag, new_version(), 0)
+        self.count('invalidations', len(set(tags)))
+
+    def clear(self):
+        self.invalidate(ALL)
+
+    def delete(self, key):
+        self._delete(key)
+
+    def statistics(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        stats['hit_rate'] = round(stats.get('hits', 0) / lookups, 3) if (
+            lookups) else None
+        return stats
+
+class NoCache(Cache):
+    "Backend that stores nothing so every value is recomputed"
+    name = "none"
+
+    def _get_multi(self, keys):
+        return {}
+
+    def _set(self, key, value, ttl):
+        pass
+
+    def _delete(self, key):
+        pass
+
+class MemoryCache(Cache):
+    "LRU cache of up to CACHESIZE entries in the server process"
+    name = "memory"
+
+    def __init__(self, size=None):
+        Cache.__init__(self)
+        self.size = settings.CACHESIZE if size is None else size
+        self.entries = collections.OrderedDict()
+
+    def _get_multi(self, keys):
+        now = time.monotonic()
+        result = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    expires, value = self.entries[key]
+                    if expires and expires < now:
+                        del self.entries[key]
+                    else:
+                        self.entries.move_to_end(key)
+                        result[key] = value
+        return result
+
+    def _set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl if ttl else 0, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def _delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def statistics(self):
+        stats = Cache.statistics(self)
+        stats.update({'entries': len(self.entries), 'size': self.size})
+        return stats
+
+class MemcacheCache(Cache):
+    """Cache in the memcached server at MEMCACHE.  One client is shared by
+    the process; python-memcached gives each thread its own connection."""
+    name = "memcache"
+
+    def __init__(self, servers=None):
+        Cache.__init__(self)
+        self.client = memcache.Client(
+            [settings.MEMCACHE] if servers is None else servers)
+
+    def mckey(self, key):
+        "Quote keys so they have no spaces or control characters"
+        return 'mahjong:' + urllib.parse.quote(key)
+
+    def _get_multi(self, keys):
+        mckeys = dict((self.mckey(key), key) for key in keys)
+        found = self.client.get_multi(list(mckeys.keys()))
+        return dict((mckeys[k], v) for k, v in found.items())
+
+    def _set(self, key, value, ttl):
+        if not self.client.set(self.mckey(key), value, time=ttl):
+            self.count('errors')
+
+    def _delete(self, key):
+        self.client.delete(self.mckey(key))
+
+class DiskCache(Cache):
+    """Cache in files under CACHEDIR, one pickled (expiration, value) pair
+    per file.  It survives restarts and is shared with other programs
+    using the same directory."""
+    name = "disk"
+
+    def __init__(self, directory=None):
+        Cache.__init__(self)
+        self.directory = settings.CACHEDIR if directory is None else directory
+
+    def path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode()).hexdigest())
+
+    def _get_multi(self, keys):
+        result = {}
+        for key in keys:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    expires, value = pickle.load(f)
+            except FileNotFoundError:
+                continue
+            except Exception:
+                self.count('errors')
+                continue
+            if expires and expires < time.time():
+                self._delete(key)
+            else:
+                result[key] = value
+        return result
+
+    def _set(self, key, value, ttl):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((time.time() + ttl if ttl else 0, value), f)
+            os.replace(temp, self.path(key))
+        except Exception:
+            self.count('errors')
+            log.exception("Unable to write cache file for {0}".format(key))
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def _delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def statistics(self):
+        stats = Cache.statistics(self)
+        stats['entries'] = len(os.listdir(self.directory)) if os.path.isdir(
+            self.directory) else 0
+        return stats
+
+backends = dict((backend.name, backend) for backend in
+                (NoCache, MemoryCache, MemcacheCache, DiskCache))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def getCache():
+    """Get the cache backend chosen by the CACHE setting.  If CACHE is
+    empty, memcache is used when MEMCACHE is set and memory otherwise."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            name = settings.CACHE or (
+                "memcache" if settings.MEMCACHE != "" else "memory")
+            if name not in backends:
+                log.error("Unknown CACHE backend {0}, using none".format(name))
+                name = "none"
+            _cache = backends[name]()
+        return _cache
+
+def fetch(key, tags, compute, ttl=None):
+    return getCache().fetch(key, tags, compute, ttl)
+
+def fetch_stale(key, tags, compute, ttl=None):
+    return getCache().fetch_stale(key, tags, compute, ttl)
+
+def get(key, default=None):
+    return getCache().get(key, default)
+
+def invalidate(*tags):
+    getCache().invalidate(*tags)
+
+def clear():
+    getCache().clear()
+
+def statistics():
+    cache = getCache()
+    return {cache.name: cache.statistics()}
@@ -6,26 +6,224 @@ import random
 import datetime
 import re
 import collections
-import shutil
 import os
+import threading
+import time
+import hashlib
+import json
 
 import util
 import settings
-import leaderboard
+import backup
+import cache
+import players
+
+class ConnectionPool():
+    """A pool of long-lived sqlite3 connections to a single database file.
+    Connections are configured once, when they are opened, from the DB
+    settings and are then checked out and returned by getCur.  If every
+    pooled connection is in use, an overflow connection is opened and
+    closed again when it is returned so that nested getCur calls never
+    wait on each other.  A single write lock serializes the writers so
+    that readers continue to use their own snapshots of the (WAL) journal
+    while a game is being written.
+    """
+    def __init__(self, dbfile, size=None):
+        self.dbfile = dbfile
+        self.size = settings.DBPOOLSIZE if size is None else size
+        self.pid = os.getpid()
+        self.idle = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self.stats = collections.Counter()
+
+    def connect(self):
+        con = sqlite3.connect(self.dbfile,
+                              timeout=settings.DBBUSYTIMEOUT,
+                              cached_statements=settings.DBSTATEMENTCACHE,
+                              check_same_thread=False)
+        con.execute("PRAGMA journal_mode = {0};".format(
+            settings.DBJOURNALMODE))
+        con.execute("PRAGMA synchronous = {0};".format(
+            settings.DBSYNCHRONOUS))
+        con.execute("PRAGMA cache_size = {0:d};".format(settings.DBCACHESIZE))
+        con.execute("PRAGMA mmap_size = {0:d};".format(settings.DBMMAPSIZE))
+        con.execute("PRAGMA foreign_keys = 1;")
+        self.stats['opened'] += 1
+        return con
+
+    def checkout(self):
+        with self.lock:
+            self.stats['checkouts'] += 1
+            if self.idle:
+                self.stats['reused'] += 1
+                return self.idle.pop()
+            if self.stats['opened'] - self.stats['closed'] >= self.size:
+                self.stats['overflow'] += 1
+        return self.connect()
+
+    def checkin(self, con):
+        with self.lock:
+            if len(self.idle) < self.size and os.getpid() == self.pid:
+                self.idle.append(con)
+                return
+            self.stats['closed'] += 1
+        con.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.stats['closed'] += len(idle)
+        for con in idle:
+            con.close()
+
+    def statistics(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update({
+                'dbfile': self.dbfile,
+                'size': self.size,
+                'idle': len(self.idle),
+                'open': self.stats['opened'] - self.stats['closed'],
+            })
+        stats['in_use'] = stats['open'] - stats['idle']
+        return stats
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def getPool():
+    """Get the connection pool for the current DBFILE, creating it on first
+    use and after a fork (sqlite connections must not cross processes)."""
+    global _pool
+    with _pool_lock:
+        if (_pool is None or _pool.dbfile != settings.DBFILE or
+            _pool.pid != os.getpid()):
+            if _pool is not None and _pool.pid == os.getpid():
+                _pool.close()
+            _pool = ConnectionPool(settings.DBFILE)
+        return _pool
+
+def poolStats():
+    return getPool().statistics()
+
+# The data version starts at the time in milliseconds so that it keeps
+# increasing across restarts
+_dataVersion = int(time.time() * 1000)
+_dataVersionLock = threading.Lock()
+
+def fileVersion():
+    """Get the latest modification time, in milliseconds, of the database
+    file and its write-ahead log, which changes when other programs, like
+    importgames.py, commit changes"""
+    stamp = 0
+    for path in (settings.DBFILE, settings.DBFILE + '-wal'):
+        try:
+            stamp = max(stamp, os.stat(path).st_mtime_ns // 1000000)
+        except OSError:
+            pass
+    return stamp
+
+def dataVersion():
+    """Get a number that increases whenever data is written to the
+    database.  It is incremented by every getCur transaction that writes
+    and commits, and also follows the database files' modification times.
+    This doesn't query the database."""
+    return max(_dataVersion, fileVersion())
+
+def bumpDataVersion():
+    global _dataVersion
+    with _dataVersionLock:
+        _dataVersion = max(_dataVersion, fileVersion()) + 1
+        return _dataVersion
+
+sql_tokens = re.compile(
+    r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\[[^\]]*\]|`[^`]*`|"
+    r"--[^\n]*|/\*.*?(?:\*/|$)|[()]|\w+", re.DOTALL)
+statement_verbs = ('SELECT', 'VALUES', 'INSERT', 'REPLACE', 'UPDATE', 'DELETE')
+
+def statement_verb(sql):
+    """Get the verb of an SQL statement in upper case, looking past the
+    common table expressions of a WITH clause to the statement they're
+    used in, e.g. INSERT for "WITH t AS (SELECT ...) INSERT ..." """
+    depth = 0
+    first = None
+    for match in sql_tokens.finditer(sql):
+        token = match.group()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif token[0] not in "'\"[`-/" and depth == 0:
+            word = token.upper()
+            if first is None:
+                first = word
+                if first != 'WITH':
+                    return first
+            elif word in statement_verbs:
+                return word
+    return first
+
+class PooledCursor(sqlite3.Cursor):
+    """Cursor that takes the pool's write lock before the first statement
+    that may modify the database.  The lock is held until getCur commits
+    or rolls back the transaction."""
+    readonly_statements = ('SELECT', 'VALUES', 'PRAGMA', 'EXPLAIN')
+    write_lock = None
+    has_write_lock = False
+
+    def execute(self, sql, *args):
+        self.acquire_write_lock(sql)
+        return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        self.acquire_write_lock(sql)
+        return super().executemany(sql, *args)
+
+    def executescript(self, sql):
+        self.acquire_write_lock(sql)
+        return super().executescript(sql)
+
+    def acquire_write_lock(self, sql):
+        if self.has_write_lock or self.write_lock is None:
+            return
+        if statement_verb(sql) in self.readonly_statements:
+            return
+        if not self.write_lock.acquire(blocking=False):
+            self.pool.stats['write_waits'] += 1
+            self.write_lock.acquire()
+        self.pool.stats['writes'] += 1
+        self.has_write_lock = True
+
+    def release_write_lock(self):
+        if self.has_write_lock:
+            self.has_write_lock = False
+            self.write_lock.release()
 
 class getCur():
+    pool = None
     con = None
     cur = None
     def __enter__(self):
-        self.con = sqlite3.connect(settings.DBFILE)
-        self.cur = self.con.cursor()
-        self.cur.execute("PRAGMA foreign_keys = 1;")
+        self.pool = getPool()
+        self.con = self.pool.checkout()
+        self.cur = self.con.cursor(PooledCursor)
+        self.cur.pool = self.pool
+        self.cur.write_lock = self.pool.write_lock
         return self.cur
     def __exit__(self, type, value, traceback):
-        if self.cur and self.con and not value:
-            self.cur.close()
-            self.con.commit()
-            self.con.close()
+        if self.cur and self.con:
+            try:
+                if value:
+                    self.con.rollback()
+                else:
+                    self.con.commit()
+                    if self.cur.has_write_lock:
+                        bumpDataVersion()
+            finally:
+                self.cur.release_write_lock()
+                self.cur.close()
+                self.pool.checkin(self.con)
 
         return False
 
@@ -33,7 +231,8 @@ schema = collections.OrderedDict({
     'Players': [
         'Id INTEGER PRIMARY KEY AUTOINCREMENT',
         'Name TEXT',
-        'MeetupName TEXT'
+        'MeetupName TEXT',
+        'UNIQUE INDEX Players_Name (Name COLLATE NOCASE)'
     ],
     'Scores': [
         'Id INTEGER PRIMARY KEY AUTOINCREMENT',
@@ -46,17 +245,63 @@ schema = collections.OrderedDict({
         'Date DATE',
         'Chombos INTEGER',
         'Quarter TEXT',
-        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE'
+        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE',
+        'INDEX Scores_GameId (GameId)',
+        'INDEX Scores_PlayerId_Quarter_Score (PlayerId, Quarter, Score)',
+        'INDEX Scores_Quarter (Quarter)',
+        'INDEX Scores_Date_GameId (Date, GameId)',
+        'INDEX Scores_PlayerId_Date_GameId (PlayerId, Date, GameId)'
+    ],
+    'PlayerPeriods': [
+        'PlayerId INTEGER',
+        'Period TEXT NOT NULL',
+        'Name TEXT NOT NULL',
+        'ScoreSum REAL',
+        'GameCount INTEGER',
+        'DropSums TEXT',
+        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE',
+        'UNIQUE INDEX PlayerPeriods_PlayerId_Period_Name (PlayerId, Period, Name)',
+        'INDEX PlayerPeriods_Period_Name (Period, Name)'
+    ],
+    'PairCounts': [
+        'Quarter TEXT NOT NULL',
+        'PlayerId INTEGER',
+        'OtherId INTEGER',
+        'Games INTEGER',
+        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE',
+        'FOREIGN KEY(OtherId) REFERENCES Players(Id) ON DELETE CASCADE',
+        'UNIQUE INDEX PairCounts_Quarter_PlayerId_OtherId (Quarter, PlayerId, OtherId)'
     ],
     'CurrentPlayers': [
         'PlayerId INTEGER PRIMARY KEY',
         'Priority TINYINT',
+        'TableNumber INTEGER',
         'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE'
     ],
-    'CurrentTables': [
-        'Id INTEGER PRIMARY KEY AUTOINCREMENT',
+    'SeatingPairs': [
+        'PlayerId INTEGER NOT NULL',
+        'OtherId INTEGER NOT NULL',
+        'Together TINYINT NOT NULL',
+        'FOREIGN KEY(PlayerId) REFERENCES CurrentPlayers(PlayerId) ON DELETE CASCADE',
+        'FOREIGN KEY(OtherId) REFERENCES CurrentPlayers(PlayerId) ON DELETE CASCADE',
+        'UNIQUE INDEX SeatingPairs_PlayerId_OtherId (PlayerId, OtherId)'
+    ],
+    'SeatingTables': [
+        'TableNumber INTEGER PRIMARY KEY',
+        'Capacity TINYINT NOT NULL'
+    ],
+    'SessionRounds': [
+        'Round INTEGER PRIMARY KEY',
+        'Started DATETIME'
+    ],
+    'SessionSeats': [
+        'Round INTEGER NOT NULL',
+        'Seat INTEGER NOT NULL',
         'PlayerId INTEGER',
-        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE'
+        'TableNumber INTEGER',
+        'FOREIGN KEY(Round) REFERENCES SessionRounds(Round) ON DELETE CASCADE',
+        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE',
+        'UNIQUE INDEX SessionSeats_Round_Seat (Round, Seat)'
     ],
     'Users': [
         'Id INTEGER PRIMARY KEY AUTOINCREMENT',
@@ -94,43 +339,118 @@ schema = collections.OrderedDict({
         'Id INTEGER PRIMARY KEY',
         'Name TEXT',
         'Duration INTEGER',
-        'Time DATETIME'
+        'Time DATETIME',
+        'Remaining REAL',
+        'TableNumber INTEGER'
     ]
 })
 
 def init(force=False):
+    """Verify the database schema matches the schema above, creating and
+    updating tables and indexes as needed.  A fingerprint of the schema is
+    stored in the database's user_version once everything matches so that
+    later startups can skip the full reconciliation.  The PlayerPeriods
+    and PairCounts aggregates are rebuilt after reconciling or if they are
+    missing.
+    Returns the elapsed time in seconds."""
     warnings.filterwarnings('ignore', r'Table \'[^\']*\' already exists')
 
+    start = time.perf_counter()
+    fingerprint = schema_fingerprint()
+    with getCur() as cur:
+        cur.execute("PRAGMA user_version;")
+        verified = cur.fetchone()[0] == fingerprint
+
+    rebuild = False
+    if not verified:
+        reindexed = False
+        for table in table_order():
+            reindexed = check_table_schema(table, force=force) or reindexed
+
+        with getCur() as cur:
+            # Refresh the query planner's statistics when the indexes change
+            cur.execute("SELECT COUNT(*) FROM sqlite_master"
+                        " WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if reindexed or cur.fetchone()[0] == 0:
+                cur.execute("ANALYZE;")
+            # Only record the fingerprint if no schema changes were declined
+            if all(table_schema_current(cur, table) for table in schema):
+                cur.execute("PRAGMA user_version = {0:d};".format(fingerprint))
+                rebuild = True
+
+    with getCur() as cur:
+        cur.execute("SELECT EXISTS(SELECT * FROM Scores),"
+                    " NOT EXISTS(SELECT * FROM PlayerPeriods),"
+                    " NOT EXISTS(SELECT * FROM PairCounts)")
+        scores, noPeriods, noPairs = cur.fetchone()
+    if rebuild or (scores and noPeriods):
+        rebuildPlayerPeriods()
+    if rebuild or (scores and noPairs):
+        rebuildPairCounts()
+
+    elapsed = time.perf_counter() - start
+    print("Database schema {0} {1:08x} in {2:.1f} ms".format(
+        "matches fingerprint" if verified else "checked against",
+        fingerprint, elapsed * 1000))
+    return elapsed
+
+def schema_fingerprint():
+    """Hash the declared schema into a positive, non-zero 31-bit integer
+    suitable for storing in SQLite's user_version.  MAXDROPGAMES is
+    included because it determines what the PlayerPeriods aggregates hold."""
     global schema
-    independent_tables = []
-    dependent_tables = []
+    digest = hashlib.sha1(json.dumps(
+        [list(schema.items()), settings.MAXDROPGAMES]).encode())
+    return int(digest.hexdigest()[:8], 16) & 0x7fffffff or 1
+
+def table_order():
+    "Order the tables in the schema so that parent tables precede children"
+    global schema
+    ordered = []
+    visited = set()
+    def visit(table):
+        if table in visited or table not in schema:
+            return
+        visited.add(table)
+        for parent in parent_tables(schema[table]):
+            visit(parent)
+        ordered.append(table)
     for table in schema:
-        if len(parent_tables(schema[table])) == 0:
-            independent_tables.append(table)
-        else:
-            dependent_tables.append(table)
-
-    to_check = collections.deque(independent_tables + dependent_tables)
-    checked = set()
-    max_count = len(independent_tables) + len(dependent_tables) ** 2 / 2
-    count = 0
-    while count < max_count and len(to_check) > 0:
-        table = to_check.popleft()
-        # If this table's parents haven't been checked yet, defer it
-        if set(parent_tables(table)) - checked:
-            to_check.append(table)
-        else:
-            check_table_schema(table, force=force)
-            checked.add(table)
-        count += 1
-
-def make_backup():
-    backupdb = datetime.datetime.now().strftime(settings.DBDATEFORMAT) + "-" + os.path.split(settings.DBFILE)[1]
-    backupdb = os.path.join(settings.DBBACKUPS, backupdb)
-    print("Making backup of database {0} to {1}".format(settings.DBFILE, backupdb))
-    if not os.path.isdir(settings.DBBACKUPS):
-        os.mkdir(settings.DBBACKUPS)
-    shutil.copyfile(settings.DBFILE, backupdb)
+        visit(table)
+    return ordered
+
+def table_schema_current(cur, tablename):
+    """Check whether a table's columns, constraints, and indexes match
+    the schema.  Fields that were deleted from the schema are ignored
+    since they are never removed automatically."""
+    table_fields = table_columns(schema[tablename])
+    cur.execute("PRAGMA table_info('{0}')".format(tablename))
+    actual_fields = cur.fetchall()
+    cur.execute("PRAGMA foreign_key_list('{0}')".format(tablename))
+    actual_fkeys = cur.fetchall()
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'"
+                " AND tbl_name = ? AND sql IS NOT NULL", (tablename,))
+    actual_indexes = dict(
+        (name, normalize_sql(sql)) for name, sql in cur.fetchall())
+    declared_indexes = dict(
+        (name, normalize_sql(sql)) for name, sql in
+        table_indexes(tablename, schema[tablename]).items())
+    return (len(actual_fields) > 0 and
+            len(missing_fields(table_fields, actual_fields)) == 0 and
+            len(missing_constraints(table_fields, actual_fkeys)) == 0 and
+            len(altered_fields(table_fields, actual_fields)) == 0 and
+            actual_indexes == declared_indexes)
+
+def make_backup(wait=False):
+    """Back up the database before changing it.  The first backup in a while
+    is made before returning, so it has the data from before the change, and
+    later requests within BACKUPDELAY seconds are coalesced into one
+    background snapshot.  If wait is true, the backup is always made before
+    returning, e.g. before changing the schema, and the backup's path is
+    returned."""
+    if wait:
+        return backup.snapshot()
+    backup.request(leading=True)
 
 fkey_pattern = re.compile(
     r'.*FOREIGN\s+KEY\s*\((\w+)\)\s*REFERENCES\s+(\w+)\s*\((\w+)\).*',
@@ -154,8 +474,10 @@ def check_table_schema(tablename, force=False, backupname="_backup"):
     new version of the table.
     For really complex schema changs, move the old database aside and
     either build from scratch or manually alter it.
+    Indexes declared in the table's schema are then created, dropped, or
+    rebuilt to match.  Returns True if any indexes were changed.
     """
-    table_fields = schema[tablename]
+    table_fields = table_columns(schema[tablename])
     with getCur() as cur:
         cur.execute("PRAGMA table_info('{0}')".format(tablename))
         actual_fields = cur.fetchall()
@@ -185,7 +507,7 @@ def check_table_schema(tablename, force=False, backupname="_backup"):
                          "to add {1}, impose {2}, correct {3}, and delete {4}))").format(
                              tablename, fields_to_add, fkeys_to_add,
                              altered)):
-                    make_backup()
+                    make_backup(wait=True)
                     backup = tablename + backupname
                     sql = "ALTER TABLE {0} RENAME TO {1};".format(
                         tablename, backup)
@@ -204,6 +526,102 @@ def check_table_schema(tablename, force=False, backupname="_backup"):
                     sql = "DROP TABLE {0};".format(backup)
                     cur.execute(sql)
 
+        return check_table_indexes(cur, tablename, force=force)
+
+index_pattern = re.compile(
+    r'^\s*(UNIQUE\s+)?INDEX\s+(\w+)\s*\((.+)\)\s*$', re.IGNORECASE)
+
+def table_columns(table_spec):
+    "Get the column and constraint specs that go in the CREATE TABLE statement"
+    global index_pattern
+    return [spec for spec in table_spec if not index_pattern.match(spec)]
+
+def table_indexes(tablename, table_spec):
+    "Get a dictionary of index names to CREATE INDEX statements for a table"
+    global index_pattern
+    indexes = collections.OrderedDict()
+    for spec in table_spec:
+        match = index_pattern.match(spec)
+        if match:
+            indexes[match.group(2)] = "CREATE {0}INDEX {1} ON {2} ({3})".format(
+                'UNIQUE ' if match.group(1) else '', match.group(2), tablename,
+                ', '.join(c.strip() for c in match.group(3).split(',')))
+    return indexes
+
+def normalize_sql(sql):
+    return ' '.join(re.findall(r'\w+|[^\w\s]', sql.upper()))
+
+def check_table_indexes(cur, tablename, force=False):
+    """Create any indexes declared in the schema for the table that are
+    missing from the database, rebuild those whose definition differs, and
+    drop indexes that are no longer declared.  Indexes that SQLite creates
+    automatically for PRIMARY KEY and UNIQUE constraints are left alone.
+    Indexes with a function in index_preparers are only created if it
+    returns True, e.g. after fixing rows that would violate the index.
+    Returns True if any indexes were changed."""
+    declared = table_indexes(tablename, schema[tablename])
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'"
+                " AND tbl_name = ? AND sql IS NOT NULL", (tablename,))
+    actual = dict(cur.fetchall())
+    changed = False
+    for name, sql in actual.items():
+        if (name not in declared or
+            normalize_sql(sql) != normalize_sql(declared[name])):
+            print("Dropping index {0} on table {1}".format(name, tablename))
+            cur.execute("DROP INDEX {0};".format(name))
+            changed = True
+    for name, sql in declared.items():
+        if (name not in actual or
+            normalize_sql(actual[name]) != normalize_sql(sql)):
+            if name in index_preparers and not index_preparers[name](
+                    cur, force):
+                print("Skipped creating index {0} on table {1}".format(
+                    name, tablename))
+                continue
+            print("Creating index {0} on table {1}".format(name, tablename))
+            try:
+                cur.execute(sql + ";")
+                changed = True
+            except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
+                print("Unable to create index {0}: {1}".format(name, e))
+    return changed
+
+def rename_duplicate_names(cur, force=False):
+    """Prepare for the unique Players_Name index by renaming players whose
+    names differ from an older player's only in case, like "alice" and
+    "Alice", which older databases allowed.  The oldest player keeps the
+    name, as players.resolve already picks them, and the others get their
+    ID appended, e.g. "alice (12)", so their scores stay separate and an
+    admin can merge them later.  Returns False if the renaming is declined."""
+    cur.execute("SELECT Id, Name FROM Players AS a WHERE EXISTS("
+                " SELECT * FROM Players AS b WHERE b.Id < a.Id"
+                "  AND b.Name = a.Name COLLATE NOCASE) ORDER BY Id")
+    duplicates = cur.fetchall()
+    if len(duplicates) == 0:
+        return True
+    print("Players whose names differ only in case from an older player's:")
+    for id, name in duplicates:
+        print("  {0} {1}".format(id, name))
+    if not (force or util.prompt(
+            "SCHEMA CHANGE: Rename these {0} players to make names unique "
+            "regardless of case".format(len(duplicates)))):
+        return False
+    for id, name in duplicates:
+        newname, suffix = "{0} ({1})".format(name, id), 1
+        while True:
+            cur.execute("SELECT EXISTS(SELECT * FROM Players"
+                        " WHERE Name = ? COLLATE NOCASE)", (newname,))
+            if not cur.fetchone()[0]:
+                break
+            suffix += 1
+            newname = "{0} ({1}-{2})".format(name, id, suffix)
+        print("Renaming player {0} {1} to {2}".format(id, name, newname))
+        cur.execute("UPDATE Players SET Name = ? WHERE Id = ?", (newname, id))
+    cache.invalidate('players')
+    return True
+
+index_preparers = {'Players_Name': rename_duplicate_names}
+
 def words(spec):
     return re.findall(r'\w+', spec)
 
@@ -211,7 +629,7 @@ def missing_fields(table_fields, actual_fields):
     return [ field_spec for field_spec in table_fields if (
         words(field_spec)[0].upper() not in [
             'FOREIGN', 'CONSTRAINT', 'PRIMARY', 'UNIQUE', 'NOT',
-            'CHECK', 'DEFAULT', 'COLLATE'] + [
+            'CHECK', 'DEFAULT', 'COLLATE', 'INDEX'] + [
                 x[1].upper() for x in actual_fields]) ]
 
 def missing_constraints(table_fields, actual_fkeys):
@@ -323,25 +741,29 @@ def getUnusedPointsPlayerID():
 
 dateFormat = "%Y-%m-%d"
 
-def addGame(scores, gamedate = None, gameid = None):
-    """Add raw scores for a particular game to the database.
-    The scores should be a list of dictionaries.
-    Each dictionary should have a 'player' name or ID, a raw 'score', and
-    a 'chombos' count.
-    One of the players may be the UnusedPointsPlayer to represent points
-    that were not claimed at the end of play.
-    The gamedate defaults to today.  A new gameid is created if none is given.
-    If a player name is not found in database, a new record is created for
-    them.
+def prepareGame(scores, gamedate=None, increment=None):
+    """Validate the raw scores for a game and compute each player's rank
+    and adjusted score.  The scores are a list of dictionaries like those
+    given to addGame.  The increment is the UnusedPointsIncrement to check
+    unused points against; it defaults to the current quarter's increment.
+    Returns a dictionary with a non-zero 'status' and an 'error' message
+    if the game is invalid.  Otherwise the 'status' is 0 and the game's
+    'date' and 'quarter' are included along with the sorted 'scores', where
+    each score has been given its 'points', 'rank', and 'adjscore'.
     """
     global dateFormat, unusedPointsPlayerName
     if gamedate is None:
         gamedate = datetime.datetime.now().strftime(dateFormat)
         quarter = quarterString()
     else:
-        quarter = quarterString(datetime.datetime.strptime(gamedate, dateFormat))
+        try:
+            quarter = quarterString(
+                datetime.datetime.strptime(gamedate, dateFormat))
+        except (ValueError, TypeError):
+            return {"status":1, "error":"Invalid game date {0}".format(
+                gamedate)}
 
-    if scores is None:
+    if not scores:
         return {"status":1, "error":"Please enter some scores"}
 
     hasUnusedPoints = False
@@ -351,7 +773,8 @@ def addGame(scores, gamedate = None, gameid = None):
     uniqueIDs = set()
     pointHistogram = {}
     for score in scores:
-        uniqueIDs.add(score['player'])
+        uniqueIDs.add(players.nocase(score['player'])
+                      if isinstance(score['player'], str) else score['player'])
         total += score['score']
         score['points'] = score['score'] - (
             settings.CHOMBOPENALTY * score['chombos'] * 1000)
@@ -369,10 +792,12 @@ def addGame(scores, gamedate = None, gameid = None):
     if not (4 <= realPlayerCount and realPlayerCount <= 5):
         return {"status":1, "error":"Please enter 4 or 5 scores"}
 
-    if hasUnusedPoints and unusedPoints % unusedPointsIncrement() != 0:
+    if increment is None and hasUnusedPoints:
+        increment = unusedPointsIncrement()
+    if hasUnusedPoints and increment and unusedPoints % increment != 0:
         return {"status":1,
                 "error":"Unused points must be a multiple of {0}".format(
-                    unusedPointsIncrement())}
+                    increment)}
 
     if "" in uniqueIDs:
         return {"status":1, "error":"Please enter all player names"}
@@ -390,7 +815,49 @@ def addGame(scores, gamedate = None, gameid = None):
         key=lambda x: (x['player'] != unusedPointsPlayerID, x['points']),
         reverse=True)
 
+    umas = {4:[15,5,-5,-15],
+            5:[15,5,0,-5,-15]}
+    rank = 1
+    pointHistogram[None] = 0
+    last_points = None
+    for score in scores:
+        if score['points'] != last_points:
+            rank += pointHistogram[last_points]
+            last_points = score['points']
+        score['rank'] = rank
+        uma = 0
+        if score['player'] != unusedPointsPlayerID:
+            for j in range(rank-1, rank-1 + pointHistogram[last_points]):
+                uma += umas[realPlayerCount][j]
+            uma /= pointHistogram[last_points]
+
+        score['adjscore'] = 0 if score['player'] == unusedPointsPlayerID else (
+            (score['points'] - settings.SCOREPERPLAYER) / 1000.0 + uma)
+
+    return {"status":0, "date":gamedate, "quarter":quarter, "scores":scores}
+
+def addGame(scores, gamedate = None, gameid = None):
+    """Add raw scores for a particular game to the database.
+    The scores should be a list of dictionaries.
+    Each dictionary should have a 'player' name or ID, a raw 'score', and
+    a 'chombos' count.
+    One of the players may be the UnusedPointsPlayer to represent points
+    that were not claimed at the end of play.
+    The gamedate defaults to today.  A new gameid is created if none is given.
+    If a player name is not found in database, a new record is created for
+    them.
+    """
+    game = prepareGame(scores, gamedate)
+    if game['status'] != 0:
+        return game
+    scores, gamedate, quarter = game['scores'], game['date'], game['quarter']
+
     with getCur() as cur:
+        missing = unknownPlayers(cur, [score['player'] for score in scores])
+        if missing:
+            return {"status":1, "error":"Couldn't find player {0}".format(
+                missing[0])}
+
         if gameid is None:
             cur.execute("SELECT GameId FROM Scores ORDER BY GameId DESC LIMIT 1")
             row = cur.fetchone()
@@ -398,45 +865,308 @@ def addGame(scores, gamedate = None, gameid = None):
                 gameid = row[0] + 1
             else:
                 gameid = 0
+            periodKeys = set()
+            oldPairs = None
+            tags = set()
         else:
+            periodKeys = gamePeriodKeys(cur, gameid)
+            oldPairs = gamePairs(cur, gameid)
+            tags = gameTags(cur, gameid)
             cur.execute("DELETE FROM Scores WHERE GameId = ?", (gameid,))
 
-        umas = {4:[15,5,-5,-15],
-                5:[15,5,0,-5,-15]}
-        rank = 1
-        pointHistogram[None] = 0
-        last_points = None
-        for i in range(len(scores)):
-            score = scores[i]
-            if score['points'] != last_points:
-                rank += pointHistogram[last_points]
-                last_points = score['points']
-            score['rank'] = rank
-            uma = 0
-            if score['player'] != unusedPointsPlayerID:
-                for j in range(rank-1, rank-1 + pointHistogram[last_points]):
-                    uma += umas[realPlayerCount][j]
-                uma /= pointHistogram[last_points]
-            cur.execute("SELECT Id FROM Players WHERE Id = ? OR Name = ?",
-                        (score['player'], score['player']))
-            player = cur.fetchone()
-            if player is None or len(player) == 0:
-                cur.execute("INSERT INTO Players(Name) VALUES(?)",
-                            (score['player'],))
-                cur.execute("SELECT Id FROM Players WHERE Name = ?",
-                            (score['player'],))
-                player = cur.fetchone()
-            player = player[0]
-
-            adjscore = 0 if score['player'] == unusedPointsPlayerID else (
-                (score['points'] - settings.SCOREPERPLAYER) / 1000.0 + uma)
+        created = []
+        playerIDs = players.resolve_many(
+            cur, [score['player'] for score in scores], create=True,
+            created=created)
+        if created:
+            tags.add('players')
+
+        for score in scores:
+            player = playerIDs[score['player']]
 
             cur.execute(
                 "INSERT INTO Scores(GameId, PlayerId, Rank, PlayerCount, "
                 " RawScore, Chombos, Score, Date, Quarter) "
                 " VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 (gameid, player, score['rank'], len(scores),
-                 score['score'], score['chombos'], adjscore, gamedate, quarter))
+                 score['score'], score['chombos'], score['adjscore'],
+                 gamedate, quarter))
+            periodKeys.add((player, gamedate[:4]))
+            tags |= scoreTags([(player, gamedate, quarter)])
 
-            leaderboard.clearCache()
+        updatePlayerPeriods(cur, periodKeys)
+        updatePairCounts(cur, gamePairs(cur, gameid), oldPairs)
+    cache.invalidate(*tags)
     return {"status":0}
+
+def addGames(games, skipInvalid=False):
+    """Add many games to the database in a single transaction.
+    The games are an iterable of dictionaries, each with a list of 'scores'
+    like those for addGame and an optional game 'date'.  Every game is
+    validated with the same rules as addGame, using the UnusedPointsIncrement
+    of the game's quarter.  If any game is invalid, nothing is added unless
+    skipInvalid is true, in which case only the valid games are added.
+    Player names are resolved in one pass, creating records for new
+    players, and the games are given consecutive new game IDs.
+    Returns a dictionary with the 'status', the number of games 'added', and
+    a list of 'errors', each giving the index of the invalid 'game' in the
+    iterable and its 'error' message.
+    """
+    getUnusedPointsPlayerID()  # Create the player before the transaction
+    with getCur() as cur:
+        cur.execute("SELECT Quarter, COALESCE(UnusedPointsIncrement, 0)"
+                    " FROM Quarters ORDER BY Quarter")
+        increments = cur.fetchall()
+
+        valid = []
+        errors = []
+        for i, game in enumerate(games):
+            gamedate = game.get('date')
+            result = prepareGame(
+                game.get('scores'), gamedate,
+                increment=quarterIncrement(increments, gamedate))
+            if result['status'] == 0:
+                valid.append((i, result))
+            else:
+                errors.append({'game': i, 'error': result['error']})
+
+        missing = set(unknownPlayers(
+            cur, [score['player'] for i, game in valid
+                  for score in game['scores']]))
+        for i, game in valid:
+            unknown = [score['player'] for score in game['scores']
+                       if score['player'] in missing]
+            if unknown:
+                errors.append({'game': i, 'error':
+                               "Couldn't find player {0}".format(unknown[0])})
+        errors.sort(key=lambda error: error['game'])
+        valid = [game for i, game in valid
+                 if not any(score['player'] in missing
+                            for score in game['scores'])]
+
+        if errors and not skipInvalid:
+            return {"status":1, "added":0, "errors":errors}
+
+        playerIDs = players.resolve_many(
+            cur, set(score['player'] for game in valid
+                     for score in game['scores']), create=True)
+
+        cur.execute("SELECT COALESCE(MAX(GameId) + 1, 0) FROM Scores")
+        gameid = cur.fetchone()[0]
+        rows = []
+        for game in valid:
+            for score in game['scores']:
+                rows.append(
+                    (gameid, playerIDs[score['player']], score['rank'],
+                     len(game['scores']), score['score'], score['chombos'],
+                     score['adjscore'], game['date'], game['quarter']))
+            gameid += 1
+        cur.executemany(
+            "INSERT INTO Scores(GameId, PlayerId, Rank, PlayerCount, "
+            " RawScore, Chombos, Score, Date, Quarter) "
+            " VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        updatePlayerPeriods(cur, set((row[1], row[7][:4]) for row in rows))
+        updatePairCounts(cur, pairCounts(
+            (row[0], row[1], row[8]) for row in rows))
+
+    if valid:
+        cache.invalidate('players', *scoreTags(
+            set((row[1], row[7], row[8]) for row in rows)))
+    return {"status":1 if errors else 0, "added":len(valid), "errors":errors}
+
+def unknownPlayers(cur, scorePlayers):
+    """Get the players of scores that addGame can't find or create.  Names
+    that aren't found become new players, but player IDs must exist in the
+    Players table as the cursor's transaction sees it."""
+    found = players.resolve_many(cur, scorePlayers)
+    return list(dict.fromkeys(player for player in scorePlayers
+                              if player not in found and
+                              not isinstance(player, str)))
+
+def quarterIncrement(increments, gamedate):
+    """Find the UnusedPointsIncrement for the quarter of a game date from
+    a sorted list of (Quarter, UnusedPointsIncrement) pairs.  Like
+    unusedPointsIncrement, the latest quarter at or before the game's
+    quarter applies."""
+    global dateFormat
+    try:
+        quarter = quarterString(
+            datetime.datetime.strptime(gamedate, dateFormat)
+            if gamedate else None)
+    except (ValueError, TypeError):
+        return 0
+    increment = 0
+    for q, inc in increments:
+        if q > quarter:
+            break
+        increment = inc
+    return increment
+
+def periodNames(date, quarter):
+    """Get the (Period, Name) pairs of the leaderboard periods that a score
+    on the given date and in the given quarter counts toward"""
+    year = date[:4]
+    return [('annual', year),
+            ('biannual', year + (' 1st' if date[5:7] <= '06' else ' 2nd')),
+            ('quarter', quarter)]
+
+def ascendingSum(scores):
+    """Add up a sorted list of scores one at a time from the lowest.
+    Averages that land exactly on half a point round differently depending
+    on the order they are summed in, so the aggregates always use the order
+    SQL queries get from the (PlayerId, Quarter, Score) index."""
+    total = 0.0
+    for score in scores:
+        total += score
+    return total
+
+def playerPeriodRows(scores):
+    """Aggregate (PlayerId, Date, Quarter, Score) rows into PlayerPeriods
+    rows.  Quarterly rows also get the DropSums list where element k is the
+    sum of the player's scores without their k lowest scores, for k up to
+    MAXDROPGAMES - 1, for dropping games from the average."""
+    groups = collections.defaultdict(list)
+    for playerid, date, quarter, score in scores:
+        if date:
+            for period, name in periodNames(date, quarter):
+                groups[playerid, period, name].append(score)
+    for (playerid, period, name), values in groups.items():
+        values.sort()
+        dropSums = None
+        if period == 'quarter':
+            dropSums = json.dumps(
+                [ascendingSum(values[k:]) for k in
+                 range(min(settings.MAXDROPGAMES, len(values)))])
+        yield (playerid, period, name, ascendingSum(values), len(values),
+               dropSums)
+
+def scoreTags(scores):
+    """Get the cache tags for the results that depend on scores given as
+    (PlayerId, Date, Quarter) rows: all scores, each player's results, and
+    the leaderboard periods of the scores, e.g. 'quarter:2017 2nd'"""
+    tags = set(['scores'])
+    for playerid, date, quarter in scores:
+        tags.add('player:{0}'.format(playerid))
+        if date:
+            tags.update('{0}:{1}'.format(period, name)
+                        for period, name in periodNames(date, quarter))
+    return tags
+
+def gameTags(cur, gameid):
+    "Get the cache tags for the results that depend on a game's scores"
+    cur.execute("SELECT DISTINCT PlayerId, Date, Quarter FROM Scores"
+                " WHERE GameId = ?", (gameid,))
+    return scoreTags(cur.fetchall())
+
+def gamePeriodKeys(cur, gameid):
+    """Get the (PlayerId, year) pairs whose PlayerPeriods aggregates include
+    the scores of a game"""
+    cur.execute("SELECT DISTINCT PlayerId, substr(Date, 1, 4) FROM Scores"
+                " WHERE GameId = ?", (gameid,))
+    return set(cur.fetchall())
+
+def updatePlayerPeriods(cur, keys):
+    """Recompute the PlayerPeriods aggregates of the given (PlayerId, year)
+    pairs from their scores.  This must be called in the same transaction
+    that adds, changes, or deletes the scores so the aggregates stay
+    consistent with the Scores table."""
+    for playerid, year in keys:
+        if not year:
+            continue
+        nextyear = str(int(year) + 1)
+        cur.execute("DELETE FROM PlayerPeriods WHERE PlayerId = ? AND"
+                    " Period IN ('annual', 'biannual', 'quarter') AND"
+                    " Name >= ? AND Name < ?", (playerid, year, nextyear))
+        # Compare with full dates; a bare year would get the Date column's
+        # numeric affinity and never match the text dates
+        cur.execute("SELECT PlayerId, Date, Quarter, Score FROM Scores"
+                    " WHERE PlayerId = ? AND Date >= ? AND Date < ?",
+                    (playerid, year + '-01-01', nextyear + '-01-01'))
+        cur.executemany(
+            "INSERT INTO PlayerPeriods(PlayerId, Period, Name, ScoreSum,"
+            " GameCount, DropSums) VALUES(?, ?, ?, ?, ?, ?)",
+            list(playerPeriodRows(cur.fetchall())))
+
+def rebuildPlayerPeriods():
+    """Recompute all the PlayerPeriods aggregates from the Scores table.
+    Returns the number of aggregate rows."""
+    with getCur() as cur:
+        cur.execute("DELETE FROM PlayerPeriods")
+        cur.execute("SELECT PlayerId, Date, Quarter, Score FROM Scores")
+        rows = list(playerPeriodRows(cur.fetchall()))
+        cur.executemany(
+            "INSERT INTO PlayerPeriods(PlayerId, Period, Name, ScoreSum,"
+            " GameCount, DropSums) VALUES(?, ?, ?, ?, ?, ?)", rows)
+    cache.clear()
+    print("Rebuilt {0} player period aggregates".format(len(rows)))
+    return len(rows)
+
+def pairCounts(scores):
+    """Count the (Quarter, PlayerId, OtherId) pairs of players who played
+    together in (GameId, PlayerId, Quarter) score rows, with the lower
+    player ID first"""
+    games = collections.defaultdict(list)
+    for gameid, playerid, quarter in scores:
+        games[gameid, quarter].append(playerid)
+    counts = collections.Counter()
+    for (gameid, quarter), playerids in games.items():
+        playerids.sort()
+        for i, a in enumerate(playerids):
+            for b in playerids[i + 1:]:
+                if a != b:
+                    counts[quarter, a, b] += 1
+    return counts
+
+def gamePairs(cur, gameid):
+    "Count the pairs of players who played together in a game's scores"
+    cur.execute("SELECT GameId, PlayerId, Quarter FROM Scores"
+                " WHERE GameId = ?", (gameid,))
+    return pairCounts(cur.fetchall())
+
+def updatePairCounts(cur, added, removed=None):
+    """Add the pair counts of new scores to the PairCounts table and take
+    away those of removed scores, as counted by pairCounts.  Like
+    updatePlayerPeriods, this must be called in the same transaction that
+    changes the scores.  Only the pairs of the changed games are touched,
+    so each game costs time proportional to the square of its players."""
+    counts = collections.Counter(added)
+    counts.subtract(removed or {})
+    cur.executemany(
+        "INSERT INTO PairCounts(Quarter, PlayerId, OtherId, Games)"
+        " VALUES(?, ?, ?, ?) ON CONFLICT(Quarter, PlayerId, OtherId)"
+        " DO UPDATE SET Games = Games + excluded.Games",
+        [key + (games,) for key, games in counts.items() if games != 0])
+    cur.executemany(
+        "DELETE FROM PairCounts WHERE Quarter = ? AND PlayerId = ?"
+        " AND OtherId = ? AND Games <= 0",
+        [key for key, games in counts.items() if games < 0])
+
+def rebuildPairCounts():
+    """Recompute all the PairCounts of games played together from the
+    Scores table.  Returns the number of pairs."""
+    with getCur() as cur:
+        cur.execute("DELETE FROM PairCounts")
+        cur.execute("INSERT INTO PairCounts(Quarter, PlayerId, OtherId, Games)"
+                    " SELECT a.Quarter, a.PlayerId, b.PlayerId, COUNT(*)"
+                    " FROM Scores AS a JOIN Scores AS b"
+                    "  ON a.GameId = b.GameId AND a.PlayerId < b.PlayerId"
+                    " WHERE a.Quarter IS NOT NULL"
+                    " GROUP BY a.Quarter, a.PlayerId, b.PlayerId")
+        count = cur.rowcount
+    print("Rebuilt {0} player pair counts".format(count))
+    return count
+
+def pairGames(cur, players, quarter=None):
+    """Get the number of games each pair of the players, given by ID, have
+    played together in a quarter (default current) from the PairCounts.
+    Returns a dictionary mapping (PlayerId, OtherId) pairs, with the lower
+    ID first, to their counts.  Pairs that haven't played are left out."""
+    players = list(set(players))
+    if len(players) < 2:
+        return {}
+    inPlayers = ",".join("?" * len(players))
+    cur.execute("SELECT PlayerId, OtherId, Games FROM PairCounts"
+                " WHERE Quarter = ? AND PlayerId IN ({0})"
+                "  AND OtherId IN ({0})".format(inPlayers),
+                [quarter or quarterString()] + players + players)
+    return dict(((a, b), games) for a, b, games in cur.fetchall())
@@ -10,7 +10,75 @@ CLUBNAME = "{0} Richi Mahjong".format(CLUBCITY)
 DBFILE = "scores.db"
 DBBACKUPS = "backups"
 DBDATEFORMAT = "%Y-%m-%d-%H-%M-%S"
+#  Backups are made before games are edited or deleted.  The first one is
+#  made right away and the requests for backups within BACKUPDELAY seconds
+#  after it are combined into one background snapshot.  Snapshots are
+#  copied BACKUPPAGES database pages at a time, and another snapshot is
+#  made every BACKUPINTERVAL hours (0 to disable).  Set BACKUPCOMPRESS to
+#  gzip the snapshots.  The newest BACKUPKEEP snapshots are kept along with
+#  the newest snapshot from each of the last BACKUPHOURLY hours, BACKUPDAILY
+#  days, and BACKUPWEEKLY weeks.  When all of these are 0, every snapshot is
+#  kept.
+BACKUPDELAY = 60
+BACKUPPAGES = 1024
+BACKUPINTERVAL = 24
+BACKUPCOMPRESS = False
+BACKUPKEEP = 0
+BACKUPHOURLY = 0
+BACKUPDAILY = 0
+BACKUPWEEKLY = 0
+#  CACHE chooses where results like leaderboards are cached: "memory" for
+#  an LRU cache of CACHESIZE entries in the server process, "memcache" for
+#  the memcached server at MEMCACHE (host:port), "disk" for files in the
+#  CACHEDIR directory, or "none".  When CACHE is empty, memcache is used if
+#  MEMCACHE is set and memory otherwise.  Entries expire after CACHETTL
+#  seconds (0 for never), which bounds how long a memory cache can miss
+#  changes made by other programs like importgames.py.
+CACHE = ""
+CACHESIZE = 512
+CACHEDIR = "cache"
+CACHETTL = 600
 MEMCACHE = ""
+#  DBPOOLSIZE is the number of database connections kept open for reuse
+#  by web requests.  The other DB settings configure each connection once
+#  when it is opened.  The WAL journal lets readers continue while a game
+#  is being written.  DBCACHESIZE is in pages, or KiB if negative, and
+#  DBMMAPSIZE is in bytes (0 disables memory mapped I/O).
+DBPOOLSIZE = 4
+DBBUSYTIMEOUT = 10
+DBJOURNALMODE = "WAL"
+DBSYNCHRONOUS = "NORMAL"
+DBCACHESIZE = -16000
+DBMMAPSIZE = 64 * 1024 * 1024
+DBSTATEMENTCACHE = 128
+#  Web requests run their database work in a pool of DBWORKERS threads and
+#  CPU intensive work (password hashing, seating searches) in a pool of
+#  CPUWORKERS processes (None means one per CPU).  When more than the
+#  QUEUELIMIT number of tasks are waiting in a pool, new requests are
+#  turned away as busy, and requests give up waiting after the TIMEOUT
+#  number of seconds.
+DBWORKERS = 4
+DBQUEUELIMIT = 64
+DBTIMEOUT = 30
+CPUWORKERS = None
+CPUQUEUELIMIT = 16
+CPUTIMEOUT = 60
+#  EXPORTCHUNK is the number of score rows read and sent at a time when
+#  exporting the scores, which bounds the memory an export uses.
+EXPORTCHUNK = 1000
+#  The seating for the current players is searched by simulated annealing
+#  for up to SEATINGTIME seconds or SEATINGITERATIONS swaps of two players,
+#  stopping early after SEATINGSTALL swaps without finding a better
+#  arrangement.  Searches given a seed stop after the number of swaps
+#  expected to fit in SEATINGTIME instead, so they can be repeated.  Set
+#  SEATINGSEARCH to "genetic" to use the older search.
+SEATINGSEARCH = "anneal"
+SEATINGTIME = 0.5
+SEATINGITERATIONS = 1000000
+SEATINGSTALL = 100000
+#  SEATINGROUNDS is the number of rounds planned for a session unless a
+#  different number is chosen on the seating page.
+SEATINGROUNDS = 4
 
 # PREFERENCES
 # Game play related
@@ -18,8 +86,7 @@ MEMCACHE = ""
 #   quarter in order to have the lowest score dropped from the average.
 DROPGAMES = 9
 #   MAXDROPGAMES is the maximum number of games a player can drop in a quarter
-#   Note that the higher this number is, the longer it will take to generate
-#   the quarterly leaderboard
+#   The leaderboard aggregates are rebuilt at startup when it changes
 MAXDROPGAMES = 4
 #   SCOREPERPLAYER sets the initial score each player has at the start of
 #   each round.  It is used to determine what the total raw scores should
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Export the scores database as CSV, newline delimited JSON (NDJSON), or
+columnar JSON.  Scores are read with the names of their players in order
+of date and game, EXPORTCHUNK rows at a time, so an export never holds
+more than one chunk in memory.  The same exporters serve the admin
+/admin/export page.  Exports can be limited to a quarter, a range of
+dates, or the games of a player.
+
+CSV and NDJSON exports can be imported again with importgames.py.  CSV
+has one row per score with the columns: game, date, quarter, player,
+score (raw), chombos, rank, and points.  NDJSON has one game per line like:
+
+    {"game": 12, "date": "2017-05-04", "quarter": "2017 2nd", "scores":
+     [{"player": "Alice", "score": 32000, "chombos": 0, "rank": 1,
+       "points": 37.0}, ...]}
+
+Columnar JSON lists the column names once followed by chunks, each with a
+list of values for every column:
+
+    {"columns": ["game", "date", ...], "chunks": [{"game": [12, 12, ...],
+     "date": ["2017-05-04", ...], ...}, ...]}
+"""
+
+import io
+import sys
+import csv
+import json
+import argparse
+import contextlib
+
+import db
+import players
+import settings
+
+columns = ['game', 'date', 'quarter', 'player', 'score', 'chombos', 'rank',
+           'points']
+
+def exportQuery(cur, quarter=None, start=None, end=None, player=None):
+    """Build the query for the exported scores and its parameters.
+    Returns None if the player isn't found."""
+    conditions, params = [], []
+    if quarter:
+        conditions.append("Scores.Quarter = ?")
+        params.append(quarter)
+    if start:
+        conditions.append("Scores.Date >= ?")
+        params.append(start)
+    if end:
+        conditions.append("Scores.Date <= ?")
+        params.append(end)
+    if player:
+        playerID = players.resolve(cur, player, cached=True)
+        if playerID is None:
+            return None
+        conditions.append(
+            "Scores.GameId IN (SELECT GameId FROM Scores WHERE PlayerId = ?)")
+        params.append(playerID)
+    return ("SELECT Scores.GameId, Scores.Date, Scores.Quarter, Players.Name,"
+            " Scores.RawScore, Scores.Chombos, Scores.Rank, Scores.Score"
+            " FROM Scores JOIN Players ON Players.Id = Scores.PlayerId"
+            " {0} ORDER BY Scores.Date, Scores.GameId, Scores.Rank".format(
+                "WHERE " + " AND ".join(conditions) if conditions else ""),
+            params)
+
+def exportChunks(quarter=None, start=None, end=None, player=None,
+                 size=None):
+    """Generate lists of up to size (default EXPORTCHUNK) score rows with
+    the export columns.  The rows all come from one read transaction, so
+    they are consistent even if games are added while the generator runs.
+    Raises LookupError if the player isn't found."""
+    with db.getCur() as cur:
+        query = exportQuery(cur, quarter, start, end, player)
+        if query is None:
+            raise LookupError("Couldn't find player {0}".format(player))
+        cur.execute(*query)
+        while True:
+            rows = cur.fetchmany(size or settings.EXPORTCHUNK)
+            if len(rows) == 0:
+                break
+            yield rows
+
+class CSVWriter():
+    "Format score rows as CSV"
+    content_type = 'text/csv'
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def flush(self):
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+    def header(self):
+        self.writer.writerow(columns)
+        return self.flush()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        return self.flush()
+
+    def footer(self):
+        return ""
+
+class NDJSONWriter():
+    """Format score rows as one game per line.  A game's scores may span
+    chunks, so the last game of each chunk is held until the next one."""
+    content_type = 'application/x-ndjson'
+
+    def __init__(self):
+        self.game = None
+
+    def header(self):
+        return ""
+
+    def write(self, rows):
+        lines = []
+        for game, date, quarter, player, score, chombos, rank, points in rows:
+            if self.game is None or self.game['game'] != game:
+                if self.game is not None:
+                    lines.append(json.dumps(self.game) + "\n")
+                self.game = {'game': game, 'date': date, 'quarter': quarter,
+                             'scores': []}
+            self.game['scores'].append(
+                {'player': player, 'score': score, 'chombos': chombos,
+                 'rank': rank, 'points': points})
+        return "".join(lines)
+
+    def footer(self):
+        return "" if self.game is None else json.dumps(self.game) + "\n"
+
+class ColumnarWriter():
+    "Format score rows as chunks of columns in one JSON document"
+    content_type = 'application/json'
+
+    def __init__(self):
+        self.chunks = 0
+
+    def header(self):
+        return '{{"columns": {0}, "chunks": ['.format(json.dumps(columns))
+
+    def write(self, rows):
+        chunk = dict((column, list(values))
+                     for column, values in zip(columns, zip(*rows)))
+        self.chunks += 1
+        return ("" if self.chunks == 1 else ", ") + json.dumps(chunk)
+
+    def footer(self):
+        return ']}\n'
+
+writers = {'csv': CSVWriter, 'ndjson': NDJSONWriter, 'columnar': ColumnarWriter}
+
+def export(stream, fmt='csv', quarter=None, start=None, end=None,
+           player=None):
+    "Write an export to a stream and return the number of scores exported"
+    writer = writers[fmt]()
+    count = 0
+    stream.write(writer.header())
+    for rows in exportChunks(quarter, start, end, player):
+        stream.write(writer.write(rows))
+        count += len(rows)
+    stream.write(writer.footer())
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'output', nargs='?', default='-',
+        help='File to write.  Use - for standard output')
+    parser.add_argument(
+        '-F', '--format', choices=sorted(writers.keys()),
+        help='Format of the export.  Defaults to the file extension or csv')
+    parser.add_argument(
+        '-q', '--quarter', help='Only export games from this quarter')
+    parser.add_argument(
+        '--from', dest='start', help='Only export games on or after this date')
+    parser.add_argument(
+        '--to', dest='end', help='Only export games on or before this date')
+    parser.add_argument(
+        '-p', '--player', help='Only export games with this player')
+    parser.add_argument(
+        '-f', '--force', default=False, action='store_true',
+        help='Force database schema updates without prompting')
+    args = parser.parse_args()
+
+    # Keep the database messages out of exports written to standard output
+    with contextlib.redirect_stdout(sys.stderr):
+        db.init(force=args.force)
+    fmt = args.format or (
+        'ndjson' if args.output.endswith(('.ndjson', '.jsonl')) else
+        'columnar' if args.output.endswith('.json') else 'csv')
+    stream = sys.stdout if args.output == '-' else open(
+        args.output, 'w', newline='')
+    try:
+        with stream:
+            count = export(stream, fmt, args.quarter, args.start, args.end,
+                           args.player)
+    except LookupError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print('Exported {0} scores'.format(count), file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import tornado.web
 
+import db
+
 def stringify(x):
     if x is None or isinstance(x, str):
         return x
@@ -33,7 +35,7 @@ def is_admin(func):
         if not self.get_is_admin():
             self.render("message.html", message = "You must be admin to do that")
         else:
-            func(self, *args, **kwargs)
+            return func(self, *args, **kwargs)
 
     return func_wrapper
 
@@ -42,6 +44,21 @@ def is_admin_ajax(func):
         if not self.get_is_admin():
             self.write('{"status":1, "error":"You must be admin to do that"}')
         else:
-            func(self, *args, **kwargs)
+            return func(self, *args, **kwargs)
+
+    return func_wrapper
+
+def data_version_etag(func):
+    """Decorate GET methods whose response depends only on the URL and the
+    database.  The response gets a strong ETag derived from the database's
+    data version, and a request whose If-None-Match matches it gets a 304
+    Not Modified before the method runs any queries."""
+    def func_wrapper(self, *args, **kwargs):
+        self.set_header('Etag', '"{0:x}"'.format(db.dataVersion()))
+        self.set_header('Cache-Control', 'no-cache')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        return func(self, *args, **kwargs)
 
     return func_wrapper
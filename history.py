@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Game history pages for all games and for each player's games, latest
+first.  Each page has all the games of a few dates, so a session is never
+split across pages.  Pages are found by keyset pagination on the dates:
+the dates before or after a cursor date are read through the Scores
+(Date, GameId) or (PlayerId, Date, GameId) index, so every page costs
+about the same no matter how much history there is.  Cursors are dates in
+the before and after query arguments, e.g. /history?before=2017-05-02.
+There are no numbered pages, since finding page N would mean skipping N
+pages of entries; old numbered page links are redirected to the latest
+page.  The counts of games shown with the pages are cached separately.
+"""
+
+import json
+import datetime
+
+import tornado.escape
+
+import cache
+import db
+import handler
+import players
+import settings
+import workers
+
+def parseCursor(cursor):
+    """Check a page cursor date.  Returns None for an empty cursor and
+    raises ValueError if it's invalid."""
+    if not cursor:
+        return None
+    datetime.datetime.strptime(cursor, db.dateFormat)
+    return cursor
+
+def pageDates(cur, player, before, after, limit):
+    """Get up to limit dates with games, latest first, either the ones just
+    after the after date or those before the before date (or the latest
+    ones).  If a player ID is given, only the dates of their games are
+    included."""
+    conditions, params = [], []
+    if player is not None:
+        conditions.append("PlayerId = ?")
+        params.append(player)
+    if after is not None:
+        conditions.append("Date > ?")
+        params.append(after)
+        order = "ASC"
+    else:
+        if before is not None:
+            conditions.append("Date < ?")
+            params.append(before)
+        order = "DESC"
+    cur.execute(
+        "SELECT DISTINCT Date FROM Scores {0} ORDER BY Date {1} LIMIT ?".format(
+            "WHERE " + " AND ".join(conditions) if conditions else "", order),
+        params + [limit])
+    dates = [row[0] for row in cur.fetchall()]
+    return dates[::-1] if after is not None else dates
+
+def datesGames(cur, player, dates):
+    "Get the IDs of the games, or the player's games, from a range of dates"
+    if len(dates) == 0:
+        return []
+    cur.execute(
+        "SELECT DISTINCT GameId FROM Scores WHERE Date BETWEEN ? AND ?" +
+        ("" if player is None else " AND PlayerId = ?"),
+        (dates[-1], dates[0]) + (() if player is None else (player,)))
+    return [row[0] for row in cur.fetchall()]
+
+def loadGames(cur, gameIDs):
+    """Get the dictionaries for games with their scores ordered by rank,
+    latest game first"""
+    if len(gameIDs) == 0:
+        return []
+    unusedPointsPlayerID = db.getUnusedPointsPlayerID()
+    cur.execute(
+        "SELECT Scores.GameId, strftime('%Y-%m-%d', Scores.Date), Rank,"
+        " Players.Name, Scores.RawScore / 1000.0, Scores.Score,"
+        " Scores.Chombos, Players.Id"
+        " FROM Scores INNER JOIN Players ON Players.Id = Scores.PlayerId"
+        " WHERE Scores.GameId IN ({0})".format(",".join("?" * len(gameIDs))),
+        list(gameIDs))
+    games = {}
+    for gID, date, rank, name, rawscore, points, chombos, pID in cur.fetchall():
+        if gID not in games:
+            games[gID] = {'date':date, 'scores':[],
+                          'id':gID, 'unusedPoints': 0}
+        if pID == unusedPointsPlayerID:
+            games[gID]['unusedPoints'] = rawscore
+        else:
+            games[gID]['scores'].append(
+                {'rank': rank, 'name': name, 'rawscore': rawscore,
+                 'score': round(points, 2), 'chombos': chombos})
+    for game in games.values():
+        game['scores'].sort(key=lambda score: score['rank'])
+    return sorted(games.values(), key=lambda x: (x['date'], x['id']),
+                  reverse=True)
+
+def computePage(player, before, after, perpage):
+    with db.getCur() as cur:
+        dates = pageDates(cur, player, before, after, perpage + 1)
+        more = len(dates) > perpage
+        if after is not None:
+            dates = dates[len(dates) - perpage:] if more else dates
+            newer = dates[0] if more else None
+            older = dates[-1] if dates else None
+        else:
+            dates = dates[:perpage]
+            newer = dates[0] if dates and before else None
+            older = dates[-1] if more else None
+        return loadGames(cur, datesGames(cur, player, dates)), newer, older
+
+def historyPage(player=None, before=None, after=None, perpage=5):
+    """Get a page of the games from perpage dates, latest first, of all
+    games or those of a player given by ID.  The page is the one just
+    before or after a cursor date, or the latest dates if neither is given.
+    Returns the list of game dictionaries and the newest and oldest dates
+    on the page if there are newer or older games to page to.  Pages are
+    cached until the scores or player names change."""
+    key = "history:{0}:{1}:{2}:{3}".format(player, before, after, perpage)
+    tags = ['scores' if player is None else 'player:{0}'.format(player),
+            'players']
+    return cache.fetch(
+        key, tags,
+        lambda: computePage(player, before, after, perpage))
+
+def historySummary(player=None):
+    """Get the number of games and of dates with games, and the first and
+    last game dates, for all games or those of a player given by ID.  The
+    counts are cached until the scores change."""
+    def compute():
+        with db.getCur() as cur:
+            cur.execute(
+                "SELECT COUNT(DISTINCT GameId), COUNT(DISTINCT Date),"
+                " MIN(Date), MAX(Date) FROM Scores" +
+                ("" if player is None else " WHERE PlayerId = ?"),
+                () if player is None else (player,))
+            return dict(zip(['games', 'dates', 'first', 'last'],
+                            cur.fetchone()))
+    return cache.fetch(
+        "historysummary:{0}".format(player),
+        ['scores' if player is None else 'player:{0}'.format(player)],
+        compute)
+
+def getHistory(player, before, after, perpage):
+    """Get the player's ID and name (None for all games), the history
+    summary, and a page of games.  Returns None if the player isn't found."""
+    name = None
+    if player is not None:
+        with db.getCur() as cur:
+            record = players.lookup(cur, player)
+        if record is None:
+            return None
+        player, name = record[0], record[1]
+    summary = historySummary(player)
+    games, newer, older = historyPage(player, before, after, perpage)
+    return player, name, summary, games, newer, older
+
+class HistoryHandlerBase(handler.BaseHandler):
+    """Base for the history pages and their JSON data.  The before and
+    after arguments take cursor dates, and PERPAGE is the number of dates
+    on a page."""
+    PERPAGE = 5
+
+    async def history(self, player):
+        before = parseCursor(self.get_argument('before', None))
+        after = parseCursor(self.get_argument('after', None))
+        return await workers.run_db(getHistory, player, before, after,
+                                    self.PERPAGE)
+
+class HistoryHandler(HistoryHandlerBase):
+    async def get(self, page):
+        if page is not None:
+            return self.redirect("/history", permanent=True)
+        try:
+            history = await self.history(None)
+        except ValueError:
+            return self.render("message.html", message="Invalid page",
+                               title="Game History")
+        player, name, summary, games, newer, older = history
+        if summary['games'] > 0:
+            self.render("history.html", error=None, games=games,
+                        gamecount=summary['games'],
+                        newer=newer, older=older,
+                        ChomboPenalty=settings.CHOMBOPENALTY)
+        else:
+            self.render("message.html", message="No games entered thusfar", title="Game History")
+
+class PlayerHistory(HistoryHandlerBase):
+    PERPAGE = 3
+
+    async def get(self, player, page):
+        if page is not None:
+            return self.redirect(
+                "/playerhistory/" + tornado.escape.url_escape(player, False),
+                permanent=True)
+        try:
+            history = await self.history(player)
+        except ValueError:
+            return self.render("message.html", message="Invalid page",
+                               title="User Game History")
+        if history is None:
+            self.render("message.html", message="Couldn't find that player", title="User Game History")
+            return
+        player, name, summary, games, newer, older = history
+        if summary['games'] > 0:
+            self.render("userhistory.html",
+                    error=None,
+                    games=games,
+                    gamecount=summary['games'],
+                    newer=newer,
+                    older=older,
+                    user = name,
+                    player = name,
+                    ChomboPenalty=settings.CHOMBOPENALTY)
+        else:
+            self.render("message.html", message="No games entered thusfar", title="Game History", user = name)
+
+class HistoryDataHandler(HistoryHandlerBase):
+    """Base for the JSON game history.  Gives the summary, the page of
+    games, and the cursors for the newer and older pages, or null if there
+    are none."""
+    async def writeHistory(self, player):
+        try:
+            history = await self.history(player)
+        except ValueError:
+            return self.write(json.dumps({'status': 1,
+                                          'error': "Invalid page cursor"}))
+        if history is None:
+            return self.write(json.dumps({'status': 1,
+                                          'error': "Couldn't find player"}))
+        player, name, summary, games, newer, older = history
+        self.write(json.dumps({
+            'status': 0, 'player': name, 'summary': summary, 'games': games,
+            'newer': newer, 'older': older}))
+
+class GameHistoryDataHandler(HistoryDataHandler):
+    @handler.data_version_etag
+    async def get(self):
+        await self.writeHistory(None)
+
+class PlayerHistoryDataHandler(HistoryDataHandler):
+    PERPAGE = 3
+
+    @handler.data_version_etag
+    async def get(self, player):
+        await self.writeHistory(player)
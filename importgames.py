@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Import games into the scores database from CSV or newline delimited JSON
+(NDJSON) files.  Records are streamed from the files and added in batches,
+each in a single transaction, using the same validation rules as games
+entered on the web site.
+
+CSV files need a header row with the columns: game, date, player, score,
+and optionally chombos.  Consecutive rows with the same game and date
+values make up one game.  The game column only groups the rows; imported
+games are given new game IDs.  For example:
+
+    game,date,player,score,chombos
+    1,2017-05-04,Alice,32000,0
+    1,2017-05-04,Bob,28000,0
+    1,2017-05-04,Carol,22000,0
+    1,2017-05-04,Dave,18000,1
+
+NDJSON files have one game per line like:
+
+    {"date": "2017-05-04", "scores": [{"player": "Alice", "score": 32000,
+     "chombos": 0}, ...]}
+"""
+
+import sys
+import csv
+import json
+import argparse
+import itertools
+
+import db
+
+def csvGames(stream):
+    "Generate game records from CSV rows"
+    reader = csv.DictReader(stream)
+    for key, rows in itertools.groupby(
+            reader, key=lambda row: (row.get('game'), row.get('date'))):
+        yield {'date': key[1] or None,
+               'scores': [{'player': row['player'],
+                           'score': int(row['score']),
+                           'chombos': int(row.get('chombos') or 0)}
+                          for row in rows]}
+
+def ndjsonGames(stream):
+    "Generate game records from lines of JSON"
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+readers = {'csv': csvGames, 'ndjson': ndjsonGames}
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'files', nargs='*', default=['-'],
+        help='Files of games to import.  Use - for standard input')
+    parser.add_argument(
+        '-F', '--format', choices=sorted(readers.keys()),
+        help='Format of the game records.  Defaults to the file extension '
+        'or csv')
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=5000,
+        help='Number of games to add in each transaction')
+    parser.add_argument(
+        '-s', '--skip-invalid', default=False, action='store_true',
+        help='Skip invalid games instead of rejecting their whole batch')
+    parser.add_argument(
+        '-f', '--force', default=False, action='store_true',
+        help='Force database schema updates without prompting')
+    args = parser.parse_args()
+
+    db.init(force=args.force)
+    added = 0
+    failed = 0
+    for filename in args.files:
+        fmt = args.format or (
+            'ndjson' if filename.endswith(('.ndjson', '.jsonl', '.json'))
+            else 'csv')
+        stream = sys.stdin if filename == '-' else open(filename, newline='')
+        with stream:
+            for i, batch in enumerate(batches(readers[fmt](stream),
+                                              args.batch_size)):
+                result = db.addGames(batch, skipInvalid=args.skip_invalid)
+                added += result['added']
+                for error in result['errors']:
+                    failed += 1
+                    print('{0}: game {1}: {2}'.format(
+                        filename, i * args.batch_size + error['game'] + 1,
+                        error['error']), file=sys.stderr)
+    print('Added {0} games{1}'.format(
+        added, ', {0} invalid'.format(failed) if failed else ''))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
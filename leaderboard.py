@@ -1,109 +1,179 @@
 #!/usr/bin/env python3
 
 import json
-import memcache
+import math
+import datetime
 
+import cache
 import db
 import handler
 import settings
+import workers
 
-periods = {
-    "annual":[
-        """SELECT
-             strftime('%Y', Scores.Date), Players.Name,
-             ROUND(SUM(Scores.Score) * 1.0 / COUNT(Scores.Score) * 100)
-               / 100 AS AvgScore,
-             COUNT(Scores.Score) AS GameCount, 0
-           FROM Scores LEFT JOIN Players ON Players.Id = Scores.PlayerId
-           WHERE Players.Id != ?
-           GROUP BY strftime('%Y', Date),Players.Id
-           ORDER BY AvgScore DESC;"""
-    ],
-    "biannual":[
-        """SELECT
-             strftime('%Y', Scores.Date) || ' ' ||
-               case ((strftime('%m', Date) - 1) / 6) when 0 then '1st'
-                 when 1 then '2nd' end,
-             Players.Name,
-             ROUND(SUM(Scores.Score) * 1.0 / COUNT(Scores.Score) * 100)
-               / 100 AS AvgScore,
-             COUNT(Scores.Score) AS GameCount, 0
-           FROM Scores LEFT JOIN Players ON Players.Id = Scores.PlayerId
-           WHERE Players.Id != ?
-        GROUP BY strftime('%Y', Date) || ' ' || ((strftime('%m', Date) - 1) / 6),Players.Id
-        ORDER BY AvgScore DESC;"""
-    ],
-    "quarter":[
-        """SELECT
-             Scores.Quarter, Players.Name,
-             ROUND(SUM(Scores.Score) * 1.0 / COUNT(Scores.Score) * 100)
-               / 100 AS AvgScore,
-             COUNT(Scores.Score) AS GameCount, {DROPGAMES}
-           FROM Scores LEFT JOIN Players ON Players.Id = Scores.PlayerId
-             LEFT JOIN Quarters ON Scores.Quarter = Quarters.Quarter
-           WHERE Players.Id != ? AND Scores.Id NOT IN
-             (SELECT Id FROM Scores as s WHERE s.PlayerId = Scores.PlayerId AND s.Quarter = Scores.Quarter
-                 ORDER BY s.Score ASC LIMIT {DROPGAMES})
-           GROUP BY Scores.Quarter,Players.Id
-           HAVING COUNT(Scores.Score) + {DROPGAMES} >= COALESCE(Quarters.GameCount,{DEFDROPGAMES}) * {DROPGAMES}
-               AND COUNT(Scores.Score) + {DROPGAMES} < COALESCE(Quarters.GameCount,{DEFDROPGAMES}) * ({DROPGAMES} + 1)
-           ORDER BY AvgScore DESC;""".format(DROPGAMES=i,DEFDROPGAMES=settings.DROPGAMES)
-        for i in range(settings.MAXDROPGAMES)
-    ]
-}
+periods = ["annual", "biannual", "quarter"]
+
+def sqlRound(value):
+    "Round to the nearest integer with halves away from zero, like SQLite"
+    if value >= 0:
+        return float(math.trunc(value + 0.5))
+    return -float(math.trunc(-value + 0.5))
+
+def averageScore(total, count):
+    return sqlRound(total * 1.0 / count * 100) / 100
+
+def periodRows(cur, period, name=None):
+    """Get the leaderboard rows for a period from the PlayerPeriods
+    aggregates.  Each row has the period name, player name, average score,
+    number of games counted, and number of games dropped.  In quarterly
+    leaderboards, players drop their lowest score for every GameCount games
+    they play in the quarter (DROPGAMES if the quarter has no setting).
+    Players who have played MAXDROPGAMES times the GameCount are left off,
+    as are players who would drop all their games.  The rule is applied in
+    a single pass over the aggregates, which hold the sum of each player's
+    scores without their lowest ones for every number of dropped games,
+    so its cost doesn't depend on MAXDROPGAMES.  If a period name is given,
+    like "2017 2nd", only its rows are read through the (Period, Name)
+    index."""
+    cur.execute(
+        """SELECT PlayerPeriods.Name, Players.Name, ScoreSum,
+             PlayerPeriods.GameCount, DropSums,
+             COALESCE(Quarters.GameCount, ?)
+           FROM PlayerPeriods JOIN Players ON Players.Id = PlayerPeriods.PlayerId
+             LEFT JOIN Quarters ON PlayerPeriods.Period = 'quarter' AND
+               Quarters.Quarter = PlayerPeriods.Name
+           WHERE PlayerPeriods.Period = ? AND Players.Id != ? {0}
+           ORDER BY PlayerPeriods.PlayerId""".format(
+               "" if name is None else "AND PlayerPeriods.Name = ?"),
+        (settings.DROPGAMES, period, db.getUnusedPointsPlayerID()) +
+        (() if name is None else (name,)))
+    rows = []
+    for name, player, total, count, dropSums, gamecount in cur.fetchall():
+        dropped = 0
+        if period == "quarter":
+            if gamecount <= 0:
+                continue
+            dropped = count // gamecount
+            if dropped >= settings.MAXDROPGAMES or dropped >= count:
+                continue
+            total = json.loads(dropSums)[dropped]
+        rows.append((name, player, averageScore(total, count - dropped),
+                     count - dropped, dropped))
+    # List players with fewer dropped games first among equal scores
+    rows.sort(key=lambda row: row[4])
+    return rows
+
+def rangeRows(cur, start, end):
+    """Get the leaderboard rows for the games played between the start and
+    end dates, inclusive.  The scores are read through the (Date, GameId)
+    index so the cost depends on the number of games in the range.  No
+    games are dropped."""
+    name = "{0} to {1}".format(start, end)
+    cur.execute(
+        """SELECT Players.Name, SUM(Scores.Score), COUNT(*)
+           FROM Scores JOIN Players ON Players.Id = Scores.PlayerId
+           WHERE Scores.Date BETWEEN ? AND ? AND Players.Id != ?
+           GROUP BY Scores.PlayerId""",
+        (start, end, db.getUnusedPointsPlayerID()))
+    return [(name, player, averageScore(total, count), count, 0)
+            for player, total, count in cur.fetchall()]
+
+def rangeTags(start, end):
+    """Cache tags for a date range leaderboard: the years it covers, or all
+    the scores for long ranges"""
+    years = range(int(start[:4]), int(end[:4]) + 1)
+    if len(years) > 10:
+        return ['scores', 'players']
+    return ['annual:{0}'.format(year) for year in years] + ['players']
 
 class LeaderboardHandler(handler.BaseHandler):
     def get(self, period):
         self.render("leaderboard.html")
 
 class LeaderDataHandler(handler.BaseHandler):
-    def get(self, period):
-        while period.startswith('/'):
-            period = period[1:]
+    @handler.data_version_etag
+    async def get(self, period):
+        name = None
+        period = (period or "").strip('/')
         if '/' in period:
-            period, rest = period.split('/', 1)
+            period, name = period.split('/', 1)
         if period not in periods:
             period = "quarter"
+        start = self.get_argument('from', None)
+        end = self.get_argument('to', None)
+        try:
+            offset = int(self.get_argument('offset', 0))
+            limit = int(self.get_argument('limit', 0))
+            if offset < 0 or limit < 0:
+                raise ValueError("Offset and limit can't be negative")
+            if start is not None or end is not None:
+                start = start or "0001-01-01"
+                end = end or "9999-12-31"
+                for date in (start, end):
+                    datetime.datetime.strptime(date, db.dateFormat)
+        except ValueError as e:
+            self.write(json.dumps({'status': 1, 'error': str(e)}))
+            return
 
-        if settings.MEMCACHE != "":
-            mc=memcache.Client([settings.MEMCACHE])
-            leaderboards = mc.get("leaderboards_" + period)
-        else:
-            mc = None
-            leaderboards = None
-
-        if leaderboards is None:
-            with db.getCur() as cur:
-                leaderboards = {}
-                rows = []
-                for query in periods[period]:
-                    cur.execute(query, (db.getUnusedPointsPlayerID(),))
-                    rows += cur.fetchall()
-                places={}
-                last_place={}
-                rows.sort(key=lambda row: row[2], reverse=True) # sort by score
-                for row in rows:
-                    if row[0] not in leaderboards:
-                        leaderboards[row[0]] = []
-                        places[row[0]] = 1
-                    leaderboard = leaderboards[row[0]]
-                    leaderboard += [
-                        {'place': places[row[0]],
-                         'name':row[1],
-                         'score':row[2],
-                         'count':str(row[3]) + ("" if row[4] == 0 else " (+" + str(row[4]) + ")"),
-                         'dropped':row[4]}]
-                    places[row[0]] += 1
-                leaders = sorted(list(leaderboards.items()), reverse=True)
-                leaderboards = []
-                for name, scores in leaders:
-                    leaderboards += [{'name':name, 'scores':scores}]
-                leaderboards=json.dumps({'leaderboards':leaderboards})
-                if mc is not None:
-                    mc.set("leaderboards_" + period, leaderboards)
+        leaderboards, stale = await workers.run_db(
+            getLeaderboards, period, name, start, end, offset, limit)
+        if stale:
+            # Don't let clients revalidate stale leaderboards as current
+            self.clear_header('Etag')
+            self.set_header('Warning', '110 - "Response is Stale"')
         self.write(leaderboards)
 
-def clearCache():
-    if settings.MEMCACHE != "":
-        mc=memcache.Client([settings.MEMCACHE])
-        mc.delete_multi(list(map(lambda period:"leaderboards_" + period, periods.keys())))
+def getLeaderboards(period, name=None, start=None, end=None, offset=0,
+                    limit=0):
+    """Get the JSON encoded leaderboards from the cache or the DB and whether
+    they are stale.  Without a name or date range, all the leaderboards for
+    the period are returned.  With a name, like "2017 2nd", only that one
+    is returned, and with start and end dates, a single leaderboard for the
+    games in that range.  The offset and limit select which places are
+    listed on each leaderboard; a limit of 0 lists all of them.  After
+    scores change, the previous leaderboards are returned as stale while
+    one thread rebuilds them."""
+    if start is not None:
+        key = "leaderboards_range_{0}_{1}".format(start, end)
+        tags = rangeTags(start, end)
+    elif name is not None:
+        key = "leaderboards_{0}_{1}".format(period, name)
+        tags = ['{0}:{1}'.format(period, name), 'players']
+    else:
+        key = "leaderboards_" + period
+        tags = ['scores', 'players'] + (
+            ['quarters'] if period == 'quarter' else [])
+    if offset or limit:
+        key += "_{0}_{1}".format(offset, limit)
+    return cache.fetch_stale(
+        key, tags,
+        lambda: computeLeaderboards(period, name, start, end, offset, limit))
+
+def computeLeaderboards(period, name=None, start=None, end=None, offset=0,
+                        limit=0):
+    with db.getCur() as cur:
+        leaderboards = {}
+        if start is not None:
+            rows = rangeRows(cur, start, end)
+        else:
+            rows = periodRows(cur, period, name)
+        places={}
+        rows.sort(key=lambda row: row[2], reverse=True) # sort by score
+        for row in rows:
+            if row[0] not in leaderboards:
+                leaderboards[row[0]] = []
+                places[row[0]] = 1
+            leaderboard = leaderboards[row[0]]
+            leaderboard += [
+                {'place': places[row[0]],
+                 'name':row[1],
+                 'score':row[2],
+                 'count':str(row[3]) + ("" if row[4] == 0 else " (+" + str(row[4]) + ")"),
+                 'dropped':row[4]}]
+            places[row[0]] += 1
+        leaders = sorted(list(leaderboards.items()), reverse=True)
+        leaderboards = []
+        for name, scores in leaders:
+            leaderboards += [{'name':name, 'total':len(scores),
+                              'scores':scores[offset:offset + limit
+                                              if limit else None]}]
+        return json.dumps({'leaderboards':leaderboards})
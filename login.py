@@ -15,6 +15,7 @@ import handler
 import settings
 import db
 import util
+import workers
 
 log = logging.getLogger("WebServer")
 
@@ -35,6 +36,26 @@ def expiration_date(start=None, duration=settings.LINKVALIDDAYS):
         start = datetime.date.today()
     return start + datetime.timedelta(days=duration)
 
+def hashPassword(password):
+    return pbkdf2_sha256.encrypt(password)
+
+def verifyPassword(password, passhash):
+    return pbkdf2_sha256.verify(password, passhash)
+
+def createVerifyLink(email, check_existing=True):
+    """Create an invitation link code for the email address.  Returns None
+    if check_existing is true and an account already exists for it."""
+    with db.getCur() as cur:
+        if check_existing:
+            cur.execute("SELECT Email from Users where Email = ?", (email,))
+            if cur.fetchone() is not None:
+                return None
+        code = util.randString(32)
+        cur.execute("INSERT INTO VerifyLinks (Id, Email, Expires) "
+                    "VALUES (?, LOWER(?), ?)",
+                    (code, email, expiration_date().isoformat()))
+        return code
+
 class InviteHandler(handler.BaseHandler):
     @tornado.web.authenticated
     def get(self):
@@ -45,26 +66,18 @@ class InviteHandler(handler.BaseHandler):
         self.render("login.html")
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         email = self.get_argument('email', None)
         if not re.match("^[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]+$", email, flags = re.IGNORECASE):
             self.render("invite.html", message = "Please enter a valid email address.")
         else:
-            with db.getCur() as cur:
-                cur.execute("SELECT Email from Users where Email = ?", (email,))
-                try:
-                    existing = cur.fetchone()[0]
-                    self.render("message.html",
-                                message = "Account for {0} already exists.".format(
-                                    email),
-                                title="Duplicate Account")
-                    return
-                except:
-                    pass
-                code = util.randString(32)
-                cur.execute("INSERT INTO VerifyLinks (Id, Email, Expires) "
-                            "VALUES (?, LOWER(?), ?)",
-                            (code, email, expiration_date().isoformat()))
+            code = await workers.run_db(createVerifyLink, email)
+            if code is None:
+                self.render("message.html",
+                            message = "Account for {0} already exists.".format(
+                                email),
+                            title="Duplicate Account")
+                return
 
             util.sendEmail(email, "Your {0} Account".format(settings.CLUBNAME),
                            format_invite(settings.CLUBNAME, self.request.host,
@@ -76,23 +89,18 @@ class InviteHandler(handler.BaseHandler):
                         title = "Invite")
 
 class SetupHandler(handler.BaseHandler):
-    def get(self):
-        with db.getCur() as cur:
-            cur.execute("SELECT COUNT(*) FROM Users")
-            if cur.fetchone()[0] != 0:
-                self.redirect("/")
-            else:
-                self.render("setup.html")
-    def post(self):
+    async def get(self):
+        if (await workers.fetchone("SELECT COUNT(*) FROM Users"))[0] != 0:
+            self.redirect("/")
+        else:
+            self.render("setup.html")
+    async def post(self):
         email = self.get_argument('email', None)
         if not re.match("^[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]+$", email, flags = re.IGNORECASE):
             self.render("setup.html", message = "Please enter a valid email address.")
         else:
-            with db.getCur() as cur:
-                code = util.randString(32)
-                cur.execute("INSERT INTO VerifyLinks (Id, Email, Expires) "
-                            "VALUES (?, LOWER(?), ?)",
-                            (code, email, expiration_date().isoformat()))
+            code = await workers.run_db(createVerifyLink, email,
+                                        check_existing=False)
 
             util.sendEmail(email, "Your {0} Account".format(settings.CLUBNAME),
                            format_invite(settings.CLUBNAME, self.request.host,
@@ -103,150 +111,188 @@ class SetupHandler(handler.BaseHandler):
                         .format(settings.LINKVALIDDAYS),
                         title = "Invite")
 
+def checkVerifyLink(q):
+    """Check an invitation link code.  Returns the invitation's email and
+    expiration date and whether an account already exists for the email.
+    Expired and already used links are deleted.  Returns None if the code
+    isn't found."""
+    with db.getCur() as cur:
+        cur.execute(
+            "SELECT Email, Expires FROM VerifyLinks WHERE Id = ?",
+            (q,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        email, expires = row
+
+        if expires < datetime.date.today().isoformat():
+            cur.execute("DELETE FROM VerifyLinks WHERE Id = ?", (q,))
+            return email, expires, False
+
+        cur.execute("SELECT Email FROM Users WHERE Email = ?", (email,))
+        existing = cur.fetchone() is not None
+        if existing:
+            cur.execute("DELETE FROM VerifyLinks WHERE Id = ?", (q,))
+        return email, expires, existing
+
+def createUser(q, email, passhash):
+    """Create a user account from an invitation.  The first account becomes
+    an admin.  Returns the new user's ID and whether they are an admin."""
+    with db.getCur() as cur:
+        cur.execute("INSERT INTO Users (Email, Password) VALUES (LOWER(?), ?)", (email, passhash))
+        userID = cur.lastrowid
+        cur.execute("SELECT COUNT(*) FROM Users")
+        admin = cur.fetchone()[0] == 1
+        if admin:
+            cur.execute("INSERT INTO Admins SELECT Id FROM Users")
+        cur.execute("DELETE FROM VerifyLinks WHERE Id = ?", (q,))
+        return userID, admin
+
 class VerifyHandler(handler.BaseHandler):
-	def get(self, q):
-            with db.getCur() as cur:
-                cur.execute(
-                    "SELECT Email, Expires FROM VerifyLinks WHERE Id = ?",
-                    (q,))
-                try:
-                    email, expires = cur.fetchone()
-                except:
-                    self.redirect("/")
-                    return
+    async def get(self, q):
+        link = await workers.run_db(checkVerifyLink, q)
+        if link is None:
+            self.redirect("/")
+            return
+        email, expires, existing = link
 
-                if expires < datetime.date.today().isoformat():
-                    cur.execute("DELETE FROM VerifyLinks WHERE Id = ?", (q,))
-                    self.render("message.html",
-                                message = "The invite expired {0}.  Please request another.".format(
-                                    expires),
-                                title="Expired Invite.")
-                    return
+        if expires < datetime.date.today().isoformat():
+            self.render("message.html",
+                        message = "The invite expired {0}.  Please request another.".format(
+                            expires),
+                        title="Expired Invite.")
+            return
 
-                cur.execute("SELECT Email FROM Users WHERE Email = ?", (email,))
-                try:
-                    existing = cur.fetchone()[0]
-                    cur.execute("DELETE FROM VerifyLinks WHERE Id = ?", (q,))
+        if existing:
+            self.render("message.html",
+                        message = "Account for {0} already exists.".format(
+                            email),
+                        title="Duplicate Account")
+            return
+        self.render("verify.html", email = email, id = q)
 
-                    self.render("message.html",
-                                message = "Account for {0} already exists.".format(
-                                    email),
-                                title="Duplicate Account")
-                    return
-                except:
-                    pass
-            self.render("verify.html", email = email, id = q)
-
-	def post(self, q):
-            email = self.get_argument('email', None)
-            password = self.get_argument('password', None)
-            vpassword = self.get_argument('vpassword', None)
-
-            if email is None or password is None or vpassword is None or email == "" or password == "" or vpassword == "":
-                self.render("verify.html", email = email, id = q,
-                            message = "You must enter an email, a password, "
-                            "and repeat your password exactly.")
-                return
-            if password != vpassword:
-                self.render("verify.html", email = email, id = q,
-                            message = "Your passwords didn't match")
-                return
+    async def post(self, q):
+        email = self.get_argument('email', None)
+        password = self.get_argument('password', None)
+        vpassword = self.get_argument('vpassword', None)
 
-            with db.getCur() as cur:
-                passhash = pbkdf2_sha256.encrypt(password)
+        if email is None or password is None or vpassword is None or email == "" or password == "" or vpassword == "":
+            self.render("verify.html", email = email, id = q,
+                        message = "You must enter an email, a password, "
+                        "and repeat your password exactly.")
+            return
+        if password != vpassword:
+            self.render("verify.html", email = email, id = q,
+                        message = "Your passwords didn't match")
+            return
 
-                cur.execute("INSERT INTO Users (Email, Password) VALUES (LOWER(?), ?)", (email, passhash))
-                cur.execute("SELECT COUNT(*) FROM Users")
-                if cur.fetchone()[0] == 1:
-                    cur.execute("INSERT INTO Admins SELECT Id FROM Users")
-                    self.set_secure_cookie("admin", "1")
-                self.set_secure_cookie("user", str(cur.lastrowid))
-                cur.execute("DELETE FROM VerifyLinks WHERE Id = ?", (q,))
+        passhash = await workers.run_cpu(hashPassword, password)
+        userID, admin = await workers.run_db(createUser, q, email, passhash)
+        if admin:
+            self.set_secure_cookie("admin", "1")
+        self.set_secure_cookie("user", str(userID))
 
-            self.redirect("/")
+        self.redirect("/")
 
-class ResetPasswordHandler(handler.BaseHandler):
-    def get(self):
-        email = None
-        if self.current_user:
-            with db.getCur() as cur:
-                cur.execute("SELECT Email FROM Users WHERE Id = ?", self.current_user)
-                email = cur.fetchone()
-                if email is not None:
-                    email = email[0]
-        self.render("forgotpassword.html", email = email)
-    def post(self):
+def userEmail(userID):
+    row = None
+    if userID:
         with db.getCur() as cur:
-            email = self.get_argument("email", None)
-            cur.execute("SELECT Id FROM Users WHERE Email = ?", (email,))
+            cur.execute("SELECT Email FROM Users WHERE Id = ?", (userID,))
             row = cur.fetchone()
-            if row is not None:
-                code = util.randString(32)
-                cur.execute("INSERT INTO ResetLinks(Id, User, Expires) "
-                            "VALUES (?, ?, ?)",
-                            (code, row[0], expiration_date().isoformat()))
-
-                util.sendEmail(
-                    email, "Your {0} Account".format(settings.CLUBNAME), """
+    return row[0] if row is not None else None
+
+def createResetLink(email):
+    "Create a password reset link code for a user's email, if they exist"
+    with db.getCur() as cur:
+        cur.execute("SELECT Id FROM Users WHERE Email = ?", (email,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        code = util.randString(32)
+        cur.execute("INSERT INTO ResetLinks(Id, User, Expires) "
+                    "VALUES (?, ?, ?)",
+                    (code, row[0], expiration_date().isoformat()))
+        return code
+
+class ResetPasswordHandler(handler.BaseHandler):
+    async def get(self):
+        email = await workers.run_db(userEmail, self.current_user)
+        self.render("forgotpassword.html", email = email)
+    async def post(self):
+        email = self.get_argument("email", None)
+        code = await workers.run_db(createResetLink, email)
+        if code is not None:
+            util.sendEmail(
+                email, "Your {0} Account".format(settings.CLUBNAME), """
 <p>Here's the link to reset your {clubname} account password.<br />
 Click <a href="http://{host}/reset/{code}">this link</a> to reset your password,
 or copy and paste the following into your URL bar:<br />
 http://{host}/reset/{code} </p>
 """.format(clubname=settings.CLUBNAME, host=self.request.host, code=code))
-                self.render("message.html",
-                            message = "Your password reset link has been sent")
-            else:
-                self.render("message.html",
-                            message = "No account found associated with this email",
-                            email = email)
+            self.render("message.html",
+                        message = "Your password reset link has been sent")
+        else:
+            self.render("message.html",
+                        message = "No account found associated with this email",
+                        email = email)
+
+def resetPassword(q, userID, passhash):
+    with db.getCur() as cur:
+        cur.execute("UPDATE Users SET Password = ? WHERE Id = ?", (passhash, userID))
+        cur.execute("DELETE FROM ResetLinks WHERE Id = ?", (q,))
 
 class ResetPasswordLinkHandler(handler.BaseHandler):
-    def get(self, q):
-        with db.getCur() as cur:
-            cur.execute(
-                "SELECT Email FROM Users JOIN ResetLinks ON "
-                "ResetLinks.User = Users.Id WHERE ResetLinks.Id = ? AND "
-                "ResetLinks.Expires > datetime('now')", (q,))
-            row = cur.fetchone()
-            if row is None:
-                self.render("message.html",
-                            message = "Link is either invalid or has expired. "
-                            "Please request a new one.")
-            else:
-                self.render("resetpassword.html", email = row[0], id = q)
-    def post(self, q):
+    async def get(self, q):
+        row = await workers.fetchone(
+            "SELECT Email FROM Users JOIN ResetLinks ON "
+            "ResetLinks.User = Users.Id WHERE ResetLinks.Id = ? AND "
+            "ResetLinks.Expires > datetime('now')", (q,))
+        if row is None:
+            self.render("message.html",
+                        message = "Link is either invalid or has expired. "
+                        "Please request a new one.")
+        else:
+            self.render("resetpassword.html", email = row[0], id = q)
+    async def post(self, q):
         password = self.get_argument('password', None)
         vpassword = self.get_argument('vpassword', None)
 
-        with db.getCur() as cur:
-            cur.execute(
-                "SELECT Users.Id, Email "
-                "FROM Users JOIN ResetLinks ON ResetLinks.User = Users.Id "
-                "WHERE ResetLinks.Id = ?",
-                (q,))
-            row = cur.fetchone()
-            if row is None:
-                self.render("message.html",
-                            message = "Link is either invalid or has expired. "
-                            "Please request a new one")
-            else:
-                id = row[0]
-                email = row[1]
-                if password is None or vpassword is None or password == "" or vpassword == "":
-                    self.render("resetpassword.html", email = email, id = q,
-                    message = "You must enter a pasword and repeat that password")
-                    return
-                if password != vpassword:
-                    self.render("resetpassword.html", email = email, id = q,
-                    message = "Your passwords didn't match")
-                    return
-                passhash = pbkdf2_sha256.encrypt(password)
+        row = await workers.fetchone(
+            "SELECT Users.Id, Email "
+            "FROM Users JOIN ResetLinks ON ResetLinks.User = Users.Id "
+            "WHERE ResetLinks.Id = ?",
+            (q,))
+        if row is None:
+            self.render("message.html",
+                        message = "Link is either invalid or has expired. "
+                        "Please request a new one")
+        else:
+            id = row[0]
+            email = row[1]
+            if password is None or vpassword is None or password == "" or vpassword == "":
+                self.render("resetpassword.html", email = email, id = q,
+                message = "You must enter a pasword and repeat that password")
+                return
+            if password != vpassword:
+                self.render("resetpassword.html", email = email, id = q,
+                message = "Your passwords didn't match")
+                return
+            passhash = await workers.run_cpu(hashPassword, password)
 
-                cur.execute("UPDATE Users SET Password = ? WHERE Id = ?", (passhash, id))
-                cur.execute("DELETE FROM ResetLinks WHERE Id = ?", (q,))
-                self.render("message.html",
-                    message = "Your password has been reset. "
-                    "You may now <a href=\"/login\">Login</a>")
+            await workers.run_db(resetPassword, q, id, passhash)
+            self.render("message.html",
+                message = "Your password has been reset. "
+                "You may now <a href=\"/login\">Login</a>")
+
+def userLoginInfo(userID):
+    "Get whether a user is an admin and their stylesheet setting"
+    with db.getCur() as cur:
+        cur.execute("SELECT EXISTS(SELECT * FROM Admins WHERE Id = ?)", (userID,))
+        admin = cur.fetchone()[0] == 1
+        cur.execute("SELECT Value FROM Settings WHERE UserId = ? AND Setting = 'stylesheet';", (userID,))
+        res = cur.fetchone()
+        return admin, res[0] if res is not None else None
 
 class LoginHandler(handler.BaseHandler):
     def get(self):
@@ -258,7 +304,7 @@ class LoginHandler(handler.BaseHandler):
                 return self.redirect(uri)
 
         self.render("login.html", uri = uri)
-    def post(self):
+    async def post(self):
         email = self.get_argument('email', None)
         password = self.get_argument('password', None)
         uri = self.get_argument('next', '/')
@@ -267,31 +313,28 @@ class LoginHandler(handler.BaseHandler):
             self.render("login.html", message = "Please enter an email and password")
             return
 
-        with db.getCur() as cur:
-            cur.execute("SELECT Id, Password FROM Users WHERE Email = LOWER(?)", (email,))
+        row = await workers.fetchone(
+            "SELECT Id, Password FROM Users WHERE Email = LOWER(?)", (email,))
+
+        if row is not None:
+            userID = row[0]
+            passhash = row[1]
+
+            if await workers.run_cpu(verifyPassword, password, passhash):
+                self.set_secure_cookie("user", str(userID))
+                log.info("Successful login for {0} (ID = {1})".format(
+                    email, userID))
+                admin, stylesheet = await workers.run_db(userLoginInfo, userID)
+                if admin:
+                    log.info("and {0} is an admin user".format(
+                        email))
+                    self.set_secure_cookie("admin", "1")
+                if stylesheet != None:
+                    self.set_secure_cookie("stylesheet", stylesheet)
 
-            row = cur.fetchone()
-            if row is not None:
-                userID = row[0]
-                passhash = row[1]
-
-                if pbkdf2_sha256.verify(password, passhash):
-                    self.set_secure_cookie("user", str(userID))
-                    log.info("Successful login for {0} (ID = {1})".format(
-                        email, userID))
-                    cur.execute("SELECT EXISTS(SELECT * FROM Admins WHERE Id = ?)", (userID,))
-                    if cur.fetchone()[0] == 1:
-                        log.info("and {0} is an admin user".format(
-                            email))
-                        self.set_secure_cookie("admin", "1")
-                    cur.execute("SELECT Value FROM Settings WHERE UserId = ? AND Setting = 'stylesheet';", (userID,))
-                    res = cur.fetchone()
-                    if res != None:
-                        self.set_secure_cookie("stylesheet", res[0])
-
-                    if userID != None:
-                        self.redirect(uri)
-                        return
+                if userID != None:
+                    self.redirect(uri)
+                    return
         log.info("Invalid login attempt for {0}".format(email))
         self.render("login.html", message = "Incorrect email and password", uri = uri)
 
@@ -304,25 +347,25 @@ class LogoutHandler(handler.BaseHandler):
         self.clear_cookie("admin")
         self.redirect(uri)
 
+def saveSettings(userID, stylesheet, email):
+    with db.getCur() as cur:
+        cur.execute("DELETE FROM Settings WHERE UserId = ? AND Setting = 'stylesheet';", (userID,))
+        cur.execute("INSERT INTO Settings(UserId, Setting, Value) VALUES(?, 'stylesheet', ?);", (userID, stylesheet))
+        cur.execute("UPDATE Users SET Email = LOWER(?) WHERE Id = ? AND Email != LOWER(?)", (email, userID, email))
+
 class SettingsHandler(handler.BaseHandler):
     @tornado.web.authenticated
-    def get(self):
-        with db.getCur() as cur:
-            cur.execute("SELECT Email FROM Users WHERE Id = ?", self.current_user)
-            email = cur.fetchone()
-            if email is not None:
-                email = email[0]
-            self.render("settings.html", email = email, stylesheets=sorted(os.listdir("static/css/colors")))
+    async def get(self):
+        email = await workers.run_db(userEmail, self.current_user)
+        self.render("settings.html", email = email, stylesheets=sorted(os.listdir("static/css/colors")))
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         stylesheet = self.get_argument('stylesheet', None)
         email = self.get_argument('email', None)
         if stylesheet is None or email is None:
             self.render("message.html", message="Please pick a stylesheet and enter a valid email", title="Settings")
         else:
-            with db.getCur() as cur:
-                cur.execute("DELETE FROM Settings WHERE UserId = ? AND Setting = 'stylesheet';", (self.current_user,))
-                cur.execute("INSERT INTO Settings(UserId, Setting, Value) VALUES(?, 'stylesheet', ?);", (self.current_user, stylesheet))
-                cur.execute("UPDATE Users SET Email = LOWER(?) WHERE Id = ? AND Email != LOWER(?)", (email, self.current_user, email))
+            await workers.run_db(saveSettings, self.current_user, stylesheet,
+                                 email)
             self.set_secure_cookie("stylesheet", stylesheet)
             self.redirect("/settings")
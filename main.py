@@ -28,6 +28,10 @@ import handler
 import util
 import db
 import settings
+import workers
+import backup
+import cache
+import push
 
 import seating
 import timers
@@ -36,143 +40,20 @@ import admin
 import addgame
 import leaderboard
 import playerstats
+import history
 
 # import and define tornado-y things
 from tornado.options import options
 cookie_secret = util.randString(32)
 
 class MainHandler(handler.BaseHandler):
-    def get(self):
+    async def get(self):
         admin = handler.stringify(self.get_secure_cookie("admin"))
 
-        no_user = False
-        with db.getCur() as cur:
-            cur.execute("SELECT COUNT(*) FROM Users")
-            no_user = cur.fetchone()[0] == 0
+        no_user = (await workers.fetchone("SELECT COUNT(*) FROM Users"))[0] == 0
 
         self.render("index.html", admin = admin, no_user = no_user)
 
-class HistoryHandler(handler.BaseHandler):
-    def get(self, page):
-        if page is None:
-            page = 0
-        else:
-            page = int(page[1:]) - 1
-        PERPAGE = 5
-        with db.getCur() as cur:
-            cur.execute("SELECT DISTINCT Date FROM Scores ORDER BY Date DESC")
-            dates = cur.fetchall()
-            gamecount = len(dates)
-            if gamecount > 0:
-                cur.execute("SELECT Scores.GameId,"
-                            " strftime('%Y-%m-%d', Scores.Date), Rank,"
-                            " Players.Name, Scores.RawScore / 1000.0,"
-                            " Scores.Score, Scores.Chombos, Players.Id"
-                            " FROM Scores INNER JOIN Players ON"
-                            "   Players.Id = Scores.PlayerId"
-                            " WHERE Scores.Date BETWEEN ? AND ?;",
-                            (dates[min(page * PERPAGE + PERPAGE - 1,
-                                       gamecount - 1)][0],
-                             dates[min(page * PERPAGE, gamecount - 1)][0]))
-                rows = cur.fetchall()
-                games = {}
-                for row in rows:
-                    gID, date, rank, name, rawscore, points, chombos, pID = row
-                    if gID not in games:
-                        games[gID] = {'date':date, 'scores':[],
-                                      'id':gID, 'unusedPoints': 0}
-                    if pID == db.getUnusedPointsPlayerID():
-                        games[gID]['unusedPoints'] = rawscore
-                    else:
-                        games[gID]['scores'].append(
-                            (rank, name, rawscore, round(points, 2), chombos))
-                maxpage = math.ceil(gamecount * 1.0 / PERPAGE)
-                pages = range(max(1, page + 1 - 10), int(min(maxpage, page + 1 + 10) + 1))
-                games = sorted(games.values(),
-                               key=lambda x: (x['date'], x['id']), reverse=True)
-                if page != 0:
-                    prev = page
-                else:
-                    prev = None
-                if page + 1 < maxpage:
-                    nex = page + 2
-                else:
-                    nex = None
-                self.render("history.html", error=None, games=games,
-                            curpage=page + 1, pages=pages, gamecount=gamecount,
-                            nex=nex, prev=prev,
-                            ChomboPenalty=settings.CHOMBOPENALTY)
-            else:
-                self.render("message.html", message="No games entered thusfar", title="Game History")
-
-class PlayerHistory(handler.BaseHandler):
-    def get(self, player, page):
-        if page is None:
-            page = 0
-        else:
-            page = int(page[1:]) - 1
-        PERPAGE = 10
-        with db.getCur() as cur:
-            cur.execute("SELECT Id,Name FROM Players WHERE Id = ? OR Name = ?", (player, player))
-            player = cur.fetchone()
-            if len(player) == 0:
-                self.render("message.html", message="Couldn't find that player", title="User Game History")
-                return
-            name = player[1]
-            player = player[0]
-            cur.execute("SELECT DISTINCT GameId FROM Scores WHERE PlayerId = ? ORDER BY Date DESC", (player,))
-            games = [i[0] for i in cur.fetchall()]
-            gamecount = len(games)
-            if gamecount > 0:
-                thesegames = games[min(page * PERPAGE, gamecount - 1):
-                                   min(page * PERPAGE + PERPAGE, gamecount)]
-                placeholder= '?' # For SQLite. See DBAPI paramstyle
-                placeholders= ', '.join(placeholder for i in range(len(thesegames)))
-                cur.execute(
-                    "SELECT Scores.GameId,"
-                    " strftime('%Y-%m-%d', Scores.Date), Rank, Players.Name,"
-                    " Scores.RawScore / 1000.0, Scores.Score, Scores.Chombos,"
-                    " Players.Id"
-                    " FROM Scores INNER JOIN Players"
-                    "  ON Players.Id = Scores.PlayerId"
-                    " WHERE Scores.GameId IN (" + placeholders + ")"
-                    " GROUP BY Scores.Id ORDER BY Scores.Date ASC;", thesegames)
-                rows = cur.fetchall()
-                games = {}
-                for row in rows:
-                    gID = row[0]
-                    if gID not in games:
-                        games[gID] = {'date':row[1], 'scores':{},
-                                      'id':gID, 'unusedPoints': 0}
-                    if row[7] == db.getUnusedPointsPlayerID():
-                        games[gID]['unusedPoints'] = row[4]
-                    else:
-                        games[gID]['scores'][row[2]] = (
-                            row[3], row[4], round(row[5], 2), row[6])
-                maxpage = math.ceil(gamecount * 1.0 / PERPAGE)
-                pages = range(max(1, page + 1 - 10), int(min(maxpage, page + 1 + 10) + 1))
-                games = sorted(games.values(), key=lambda x: x["date"], reverse=True)
-                if page != 0:
-                    prev = page
-                else:
-                    prev = None
-                if page + 1 < maxpage:
-                    nex = page + 2
-                else:
-                    nex = None
-                self.render("userhistory.html",
-                        error=None,
-                        games=games,
-                        curpage=page + 1,
-                        pages=pages,
-                        gamecount=gamecount,
-                        nex = nex,
-                        prev = prev,
-                        user = name,
-                        player = player)
-            else:
-                self.render("message.html", message="No games entered thusfar", title="Game History", user = name)
-
 class PointCalculator(handler.BaseHandler):
     def get(self):
         self.render("pointcalculator.html")
@@ -180,6 +61,7 @@ class PointCalculator(handler.BaseHandler):
 class Application(tornado.web.Application):
     def __init__(self, force=False):
         db.init(force=force)
+        timers.load()
 
         handlers = [
                 (r"/", MainHandler),
@@ -193,13 +75,22 @@ class Application(tornado.web.Application):
                 (r"/reset/([^/]+)", login.ResetPasswordLinkHandler),
                 (r"/addgame", addgame.AddGameHandler),
                 (r"/leaderboard(/[^/]*)?", leaderboard.LeaderboardHandler),
-                (r"/leaderdata(/[^/]*)?", leaderboard.LeaderDataHandler),
-                (r"/history(/[0-9]+)?", HistoryHandler),
-                (r"/playerhistory/(.*?)(/[0-9]+)?", PlayerHistory),
+                (r"/leaderdata(/.*)?", leaderboard.LeaderDataHandler),
+                (r"/history(/[0-9]+)?", history.HistoryHandler),
+                (r"/historydata", history.GameHistoryDataHandler),
+                (r"/playerhistory/(.*?)(/[0-9]+)?", history.PlayerHistory),
+                (r"/playerhistorydata/(.*)", history.PlayerHistoryDataHandler),
                 (r"/playerstats/(.*)", playerstats.PlayerStatsHandler),
                 (r"/playerstatsdata/(.*)", playerstats.PlayerStatsDataHandler),
                 (r"/seating", seating.SeatingHandler),
                 (r"/seating/regentables", seating.RegenTables),
+                (r"/seating/nextround", seating.NextRound),
+                (r"/seating/status.json", seating.SeatingStatus),
+                (r"/seating/cancel", seating.CancelSeating),
+                (r"/seating/constraints.json", seating.SeatingConstraints),
+                (r"/seating/pair", seating.SeatingPair),
+                (r"/seating/pin", seating.PinPlayer),
+                (r"/seating/capacity", seating.TableCapacity),
                 (r"/seating/clearcurrentplayers", seating.ClearCurrentPlayers),
                 (r"/seating/addcurrentplayer", seating.AddCurrentPlayer),
                 (r"/seating/removeplayer", seating.RemovePlayer),
@@ -212,10 +103,15 @@ class Application(tornado.web.Application):
                 (r"/timers.json", timers.GetTimersHandler),
                 (r"/timers/add", timers.AddTimer),
                 (r"/timers/start", timers.StartTimer),
+                (r"/timers/pause", timers.PauseTimer),
+                (r"/timers/resume", timers.ResumeTimer),
                 (r"/timers/delete", timers.DeleteTimer),
+                (r"/push/([^/]+)", push.PushSocket),
                 (r"/pointcalculator", PointCalculator),
                 (r"/admin", admin.AdminPanelHandler),
                 (r"/admin/users", admin.ManageUsersHandler),
+                (r"/admin/stats.json", admin.StatsHandler),
+                (r"/admin/export", admin.ExportHandler),
                 (r"/admin/editquarter/([^/]*)", admin.EditQuarterHandler),
                 (r"/admin/quarters", admin.QuartersHandler),
                 (r"/admin/deletequarter/([^/]*)", admin.DeleteQuarterHandler),
@@ -229,14 +125,21 @@ class Application(tornado.web.Application):
                 static_path = os.path.join(os.path.dirname(__file__), "static"),
                 debug = True,
                 cookie_secret = cookie_secret,
-                login_url = "/login"
+                login_url = "/login",
+                websocket_ping_interval = 30
         )
         tornado.web.Application.__init__(self, handlers, **settings)
 
-def periodicCleanup():
+def cleanupDB():
     with db.getCur() as cur:
         cur.execute("DELETE FROM VerifyLinks WHERE Expires <= datetime('now')")
         cur.execute("DELETE FROM Players WHERE Id NOT IN (SELECT PlayerId FROM Scores)")
+        removed = cur.rowcount
+    if removed > 0:
+        cache.invalidate('players')
+
+async def periodicCleanup():
+    await workers.run_db(cleanupDB)
 
 def main():
     default_socket = "/tmp/mahjong.sock"
@@ -305,11 +208,17 @@ def main():
         http_server.add_socket(tornado.netutil.bind_unix_socket(socket))
 
     signal.signal(signal.SIGINT, sigint_handler)
+    workers.manager()  # Start the manager's process before serving requests
 
     tornado.ioloop.PeriodicCallback(periodicCleanup, 60 * 60 * 1000).start() # run periodicCleanup once an hour
+    if settings.BACKUPINTERVAL > 0:
+        tornado.ioloop.PeriodicCallback(
+            backup.request, settings.BACKUPINTERVAL * 60 * 60 * 1000).start()
     # start up web server
     tornado.ioloop.IOLoop.instance().start()
 
+    workers.shutdown()
+    backup.flush()
     if qm is not None:
         qm.end()
 
@@ -0,0 +1,869 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Search for seating arrangements of the current players that keep apart
+the players who have played each other the most this quarter.  Players
+are given by their positions in a matrix of the number of games each pair
+has played together, and an arrangement is a permutation of the positions
+that is cut into tables of 4 and 5 players.  An arrangement's score is the
+total number of games played together by each pair of players at the same
+table, plus 100 for every priority player seated at a 5 player table.
+Lower scores are better.
+
+The default search is simulated annealing (SEATINGSEARCH = "anneal").  It
+swaps the seats of two players at a time and rescores only the two tables
+they are at, accepting swaps that make the score worse with a probability
+that falls as the search cools.  It runs until it finds an arrangement
+scoring 0 or reaches the SEATINGTIME, SEATINGITERATIONS, or SEATINGSTALL
+limit.  Searches given a seed are reproducible, stopping after the number
+of swaps expected to fit in SEATINGTIME instead of timing themselves.  It
+can also plan several rounds at once, where seating a pair together in
+more than one round counts as though they had played another game
+together.  Seating
+Constraints keep pairs of players together or apart, pin players to
+tables, and set which tables seat 5.  The constrained search only makes
+moves that keep to them, rather than scoring arrangements that don't.
+
+The older genetic search evolves a population of arrangements by swapping
+pairs of players.  When NumPy is installed, the whole population is scored
+at once with array operations.  Otherwise, or if the "python" engine is
+chosen, each arrangement is scored in Python.  Both engines score
+arrangements identically.  Run this module to compare the speed and
+results of the searches, e.g.
+
+    python3 optimizer.py --players 16 24 40
+"""
+
+import sys
+import math
+import time
+import random
+import argparse
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import settings
+
+POPULATION = 256
+
+engines = ['numpy', 'python']
+
+def defaultEngine():
+    return 'python' if numpy is None else 'numpy'
+
+def tableSizes(numplayers):
+    "Get the number of 4 and 5 player tables for a number of players"
+    if numplayers >= 8:
+        tables_5p = numplayers % 4
+        total_tables = int(numplayers / 4)
+        tables_4p = total_tables - tables_5p
+    else:
+        if numplayers >= 5:
+            tables_5p = 1
+        else:
+            tables_5p = 0
+        total_tables = 1
+        tables_4p = total_tables - tables_5p
+    return tables_4p, tables_5p
+
+def tableLayout(numplayers, capacities=None):
+    """Get the sizes of the tables for a number of players in table order.
+    The capacities map table indices to 4 for tables that can't take a
+    fifth player or 5 for tables that should be the first to get one.
+    Other tables get the remaining fifth players from the last table back,
+    which is the layout of tableSeats when there are no capacities.  The
+    capacities of tables beyond those needed are ignored.  Raises
+    ValueError if the players can't be seated."""
+    capacities = capacities or {}
+    tables_4p, tables_5p = tableSizes(numplayers)
+    numtables = tables_4p + tables_5p
+    if numplayers < 4 or tables_4p < 0 or numplayers in (6, 7):
+        raise ValueError(
+            "Can't seat {0} players at tables of 4 and 5".format(numplayers))
+    fives = [table for table in range(numtables)
+             if capacities.get(table) == 5][:tables_5p]
+    fives += [table for table in reversed(range(numtables))
+              if table not in capacities][:tables_5p - len(fives)]
+    if len(fives) < tables_5p:
+        raise ValueError("Not enough tables can seat 5 players")
+    return [5 if table in fives else 4 for table in range(numtables)]
+
+def tableSeats(numplayers, sizes=None):
+    """Get the lists of the seat positions at each table, in the same way
+    tablesScore cuts arrangements into tables, or for tables of the given
+    sizes"""
+    if sizes is not None:
+        starts = [sum(sizes[:table]) for table in range(len(sizes))]
+        return [list(range(start, start + size))
+                for start, size in zip(starts, sizes)]
+    tables_4p, tables_5p = tableSizes(numplayers)
+    seats = list(range(numplayers))
+    return ([seats[i:i+4] for i in range(0, tables_4p * 4, 4)] +
+            [seats[i:i+5] for i in range(tables_4p * 4, numplayers, 5)])
+
+def mutateTables(tables):
+    tables = tables[:]
+    a = random.randint(0, len(tables) - 1)
+    b = random.randint(0, len(tables) - 1)
+    tables[a], tables[b] = tables[b], tables[a]
+
+    return tables
+
+def tablesScore(players, playergames, priorities, sizes=None):
+    numplayers = len(players)
+    if sizes is not None:
+        return sum(tableScore([players[seat] for seat in seats], playergames,
+                              priorities)
+                   for seats in tableSeats(numplayers, sizes))
+    tables_4p, tables_5p = tableSizes(numplayers)
+
+    score = 0
+
+    for i in range(0, tables_4p * 4, 4):
+        table = players[i:i+4]
+        score += tableScore(table, playergames, priorities)
+
+    for i in range(tables_4p * 4, numplayers, 5):
+        table = players[i:i+5]
+        score += tableScore(table, playergames, priorities)
+
+    return score
+
+def tableScore(players, playergames, priorities):
+    numplayers = len(players)
+
+    score = 0
+    for i in range(numplayers):
+        games = playergames[players[i]]
+        for j in range(i + 1, numplayers):
+            score += games[players[j]]
+        if priorities[players[i]] == 1 and numplayers == 5:
+            score += 100
+    return score
+
+class PopulationScorer():
+    """Score a population of arrangements, given as the rows of a 2-D
+    array, with NumPy.  The tables of each size are gathered from all the
+    arrangements into one array, and the games played by every pair of
+    seats at them are looked up in the co-play matrix at once."""
+    def __init__(self, numplayers, playergames, priorities):
+        self.matrix = numpy.asarray(playergames, dtype=numpy.int64).reshape(
+            numplayers, numplayers)
+        self.priority = (numpy.asarray(priorities) == 1).astype(numpy.int64)
+        bysize = {}
+        for seats in tableSeats(numplayers):
+            if len(seats) > 0:
+                bysize.setdefault(len(seats), []).append(seats)
+        self.tables = []
+        for size, seats in sorted(bysize.items()):
+            first, second = numpy.triu_indices(size, 1)
+            self.tables.append((size, numpy.array(seats), first, second))
+
+    def __call__(self, population):
+        scores = numpy.zeros(len(population), dtype=numpy.int64)
+        for size, seats, first, second in self.tables:
+            players = population[:, seats]  # arrangements x tables x seats
+            scores += self.matrix[players[:, :, first],
+                                  players[:, :, second]].sum(axis=(1, 2))
+            if size == 5:
+                scores += 100 * self.priority[players].sum(axis=(1, 2))
+        return scores
+
+def bestArrangementPython(tables, playergames, priorities,
+                          population = POPULATION):
+    """Evolve population arrangements for as many generations as there are
+    players, mutating a copy of each one and keeping the best of them and
+    their copies"""
+    numplayers = len(tables)
+
+    tabless = []
+    for i in range(population):
+        tables = tables[:]
+        random.shuffle(tables)
+        tabless += [(tablesScore(tables, playergames, priorities), tables)]
+    tabless.sort(key=itemgetter(0))
+
+    minScore = tabless[0][0]
+    iteration = 0
+
+    while iteration < numplayers and minScore > 0:
+        for j in range(population):
+            newTables = mutateTables(tabless[j][1])
+            tabless += [(tablesScore(newTables, playergames, priorities), newTables)]
+        tabless.sort(key=itemgetter(0))
+        tabless = tabless[0:population]
+
+        iteration += 1
+        minScore = tabless[0][0]
+
+    return tabless[0][1]
+
+def bestArrangementNumpy(tables, playergames, priorities,
+                         population = POPULATION):
+    """The same genetic search as bestArrangementPython with the population
+    kept in an array.  Every generation swaps two random seats in a copy
+    of each arrangement, scores all the copies at once, and keeps the best
+    of the arrangements and copies.  The stable sort keeps the older of
+    equally scored arrangements first, like the Python search."""
+    numplayers = len(tables)
+    tables = numpy.asarray(tables)
+    if numplayers == 0:
+        return []
+    score = PopulationScorer(numplayers, playergames, priorities)
+    rng = numpy.random.default_rng()
+    rows = numpy.arange(population)
+
+    arrangements = numpy.array(
+        [rng.permutation(tables) for i in range(population)])
+    scores = score(arrangements)
+    order = numpy.argsort(scores, kind='stable')
+    arrangements, scores = arrangements[order], scores[order]
+
+    minScore = scores[0]
+    iteration = 0
+
+    while iteration < numplayers and minScore > 0:
+        children = arrangements.copy()
+        a = rng.integers(0, numplayers, population)
+        b = rng.integers(0, numplayers, population)
+        children[rows, a], children[rows, b] = (children[rows, b],
+                                                children[rows, a])
+        arrangements = numpy.concatenate((arrangements, children))
+        scores = numpy.concatenate((scores, score(children)))
+        order = numpy.argsort(scores, kind='stable')[:population]
+        arrangements, scores = arrangements[order], scores[order]
+
+        iteration += 1
+        minScore = scores[0]
+
+    return arrangements[0].tolist()
+
+def bestArrangement(tables, playergames, priorities, population = POPULATION,
+                    engine = None):
+    """Find a low scoring arrangement of the players in tables, a list of
+    positions in the playergames matrix and priorities list.  The engine is
+    "numpy" or "python" and defaults to numpy when it is installed."""
+    engine = engine or defaultEngine()
+    if engine == 'numpy':
+        if numpy is None:
+            raise ImportError("The numpy seating engine needs NumPy")
+        return bestArrangementNumpy(tables, playergames, priorities,
+                                    population)
+    return bestArrangementPython(tables, playergames, priorities, population)
+
+class Annealer():
+    """Simulated annealing over the seats of the arrangements for one or
+    more rounds.  Each pair of players costs the games they have played
+    together times the number of rounds they are seated together in, plus
+    one for each round they are seated together in after their first.
+    That is, a pair seated together again counts as having played another
+    game.  Swapping the players in seats at two different tables of a round
+    only changes the costs of the pairs at those two tables, so the change
+    is computed from the other players at the two tables and the counts of
+    rounds each pair is seated together.  The playergames matrix must be
+    symmetric.  SWAPRATE is a conservative estimate of the swaps tried per
+    second, used to size the searches that must be reproducible."""
+    FINALTEMPERATURE = 0.05
+    SWAPRATE = 100000
+
+    def __init__(self, tables, playergames, priorities, rng, rounds=1,
+                 sizes=None):
+        self.rng = rng
+        self.arrangements = self.initial(tables, rounds)
+        self.playergames = playergames
+        self.priority = [1 if p == 1 else 0 for p in priorities]
+        numplayers = len(tables)
+        # Seats left out of the tables by the layout belong to no table
+        self.seats = [seats for seats in tableSeats(numplayers, sizes)
+                      if len(seats) > 0]
+        self.tableOf = [None] * numplayers
+        for table, seats in enumerate(self.seats):
+            for seat in seats:
+                self.tableOf[seat] = table
+        self.together = togetherCounts(self.arrangements, len(playergames),
+                                       sizes)
+        self.score = roundsScore(self.arrangements, playergames, priorities,
+                                 sizes)
+
+    def initial(self, tables, rounds):
+        "Make the arrangements for the rounds to start the search from"
+        arrangements = []
+        for i in range(rounds):
+            arrangement = list(tables)
+            self.rng.shuffle(arrangement)
+            arrangements.append(arrangement)
+        return arrangements
+
+    def tableDelta(self, arrangement, table, seat, leaving, joining):
+        "Get the change in cost at a table from replacing a seat's player"
+        if table is None:
+            return 0
+        leavingGames = self.playergames[leaving]
+        joiningGames = self.playergames[joining]
+        leavingTogether = self.together[leaving]
+        joiningTogether = self.together[joining]
+        seats = self.seats[table]
+        change = 0
+        for other in seats:
+            if other != seat:
+                z = arrangement[other]
+                change += (joiningGames[z] + joiningTogether[z] -
+                           leavingGames[z] - leavingTogether[z] + 1)
+        if len(seats) == 5:
+            change += 100 * (self.priority[joining] - self.priority[leaving])
+        return change
+
+    def delta(self, round, a, b):
+        """Get the change in score from swapping the players in seats a and
+        b of a round"""
+        tableA, tableB = self.tableOf[a], self.tableOf[b]
+        if tableA == tableB:
+            return 0
+        arrangement = self.arrangements[round]
+        x, y = arrangement[a], arrangement[b]
+        return (self.tableDelta(arrangement, tableA, a, x, y) +
+                self.tableDelta(arrangement, tableB, b, y, x))
+
+    def moveTogether(self, arrangement, table, seat, leaving, joining):
+        if table is None:
+            return
+        together = self.together
+        for other in self.seats[table]:
+            if other != seat:
+                z = arrangement[other]
+                together[leaving][z] -= 1
+                together[z][leaving] -= 1
+                together[joining][z] += 1
+                together[z][joining] += 1
+
+    def swap(self, round, a, b):
+        "Swap the players in seats a and b of a round"
+        arrangement = self.arrangements[round]
+        x, y = arrangement[a], arrangement[b]
+        if self.tableOf[a] != self.tableOf[b]:
+            self.moveTogether(arrangement, self.tableOf[a], a, x, y)
+            self.moveTogether(arrangement, self.tableOf[b], b, y, x)
+        arrangement[a], arrangement[b] = y, x
+
+    def temperature(self):
+        """Start at the average change of random swaps so that most swaps
+        that make the score worse are accepted at first"""
+        numplayers = len(self.tableOf)
+        changes = [abs(self.delta(self.rng.randrange(len(self.arrangements)),
+                                  self.rng.randrange(numplayers),
+                                  self.rng.randrange(numplayers)))
+                   for i in range(100)]
+        changes = [change for change in changes if change > 0]
+        return max(1.0, sum(changes) / len(changes)) if changes else 1.0
+
+    def run(self, budget, iterations, stall, progress=None):
+        """Search for up to budget seconds (None for no limit), iterations
+        swaps, or stall swaps without improvement.  If a progress function
+        is given, it is called with the number of swaps tried and the best
+        score so far every so often, and the search stops early if it
+        returns true.  Returns the best arrangements, their score, and the
+        number of swaps tried."""
+        best = [arrangement[:] for arrangement in self.arrangements]
+        bestScore = self.score
+        numplayers = len(self.tableOf)
+        rounds = len(self.arrangements)
+        if rounds == 0 or len(self.seats) < 2 or bestScore == 0:
+            return best, bestScore, 0
+        rng = self.rng
+        start = time.perf_counter()
+        initial = temperature = self.temperature()
+        iteration = sinceBest = 0
+        while iteration < iterations and sinceBest < stall and bestScore > 0:
+            if iteration % 256 == 0:
+                if progress is not None and progress(iteration, bestScore):
+                    break
+                done = iteration / iterations
+                if budget is not None:
+                    elapsed = time.perf_counter() - start
+                    if elapsed >= budget:
+                        break
+                    done = max(done, elapsed / budget)
+                temperature = initial * (
+                    self.FINALTEMPERATURE / initial) ** done
+            iteration += 1
+            sinceBest += 1
+            round = rng.randrange(rounds) if rounds > 1 else 0
+            a, b = rng.randrange(numplayers), rng.randrange(numplayers)
+            change = self.delta(round, a, b)
+            if change <= 0 or rng.random() < math.exp(-change / temperature):
+                self.swap(round, a, b)
+                self.score += change
+                if self.score < bestScore:
+                    best = [arrangement[:] for arrangement in self.arrangements]
+                    bestScore = self.score
+                    sinceBest = 0
+        return best, bestScore, iteration
+
+class Constraints():
+    """Constraints on the seating of players given by their positions:
+    pairs who must share a table, pairs who must not, players pinned to
+    table indices, and table capacities as in tableLayout"""
+    def __init__(self, together=(), apart=(), pinned=None, capacities=None):
+        self.together = list(together)
+        self.apart = list(apart)
+        self.pinned = dict(pinned or {})
+        self.capacities = dict(capacities or {})
+
+    def __bool__(self):
+        return bool(self.together or self.apart or self.pinned or
+                    self.capacities)
+
+    def layout(self, numplayers):
+        """Get the table sizes for a number of players, or None for the
+        usual layout of tableSeats if there are no constraints"""
+        return tableLayout(numplayers, self.capacities) if self else None
+
+    def groups(self):
+        "Get the lists of 2 or more players who must all share a table"
+        groups = {}
+        for x, y in self.together:
+            merged = groups.get(x, [x])
+            other = groups.get(y, [y])
+            if merged is not other:
+                merged = merged + other
+            for player in merged:
+                groups[player] = merged
+        unique = dict((id(group), group) for group in groups.values())
+        return sorted(sorted(group) for group in unique.values())
+
+class ConstrainedAnnealer(Annealer):
+    """Simulated annealing that keeps to seating Constraints.  Every
+    arrangement searched meets them.  Pinned players, and any group who
+    must share a table with them, stay at their table.  The other groups
+    who must share a table move between tables together, swapping with
+    players who aren't in a group or pinned.  Moves that would seat players
+    who must be kept apart at the same table are skipped without being
+    scored."""
+    GROUPMOVES = 0.1
+    PLACEMENTTRIES = 50
+    SWAPRATE = 50000
+
+    def __init__(self, tables, playergames, priorities, rng, rounds,
+                 constraints):
+        self.constraints = constraints
+        self.sizes = constraints.layout(len(tables))
+        self.groups = constraints.groups()
+        self.apart = {}
+        for x, y in constraints.apart:
+            self.apart.setdefault(x, set()).add(y)
+            self.apart.setdefault(y, set()).add(x)
+        for table in constraints.pinned.values():
+            if not 0 <= table < len(self.sizes):
+                raise ValueError(
+                    "There are only {0} tables".format(len(self.sizes)))
+        for group in self.groups:
+            if len(group) > 5:
+                raise ValueError("More than 5 players must share a table")
+            if len(self.pins(group)) > 1:
+                raise ValueError("Players who must share a table are pinned "
+                                 "to different tables")
+            if any(other in self.apart.get(player, ())
+                   for player in group for other in group):
+                raise ValueError("Players who must share a table must also "
+                                 "be kept apart")
+        grouped = set(player for group in self.groups for player in group)
+        self.movingGroups = [group for group in self.groups
+                             if len(self.pins(group)) == 0]
+        self.free = [player for player in tables if player not in grouped
+                     and player not in constraints.pinned]
+        self.isFree = set(self.free)
+        Annealer.__init__(self, tables, playergames, priorities, rng, rounds,
+                          self.sizes)
+        self.seatOf = [dict((player, seat)
+                            for seat, player in enumerate(arrangement))
+                       for arrangement in self.arrangements]
+
+    def pins(self, players):
+        "Get the set of tables any of the players are pinned to"
+        return set(self.constraints.pinned[player] for player in players
+                   if player in self.constraints.pinned)
+
+    def initial(self, tables, rounds):
+        return [self.place(tables) for i in range(rounds)]
+
+    def place(self, tables):
+        """Seat the players at random in a way that meets the constraints,
+        seating the pinned players and groups first"""
+        seats = tableSeats(len(tables), self.sizes)
+        grouped = set(player for group in self.groups for player in group)
+        units = self.groups + [[player] for player in tables
+                               if player not in grouped]
+        for attempt in range(self.PLACEMENTTRIES):
+            self.rng.shuffle(units)
+            units.sort(key=lambda unit: (len(self.pins(unit)) == 0,
+                                         -len(unit)))
+            seated = [[] for table in seats]
+            for unit in units:
+                pins = self.pins(unit)
+                for table in (list(pins) if pins else
+                              self.rng.sample(range(len(seats)), len(seats))):
+                    if (len(seated[table]) + len(unit) <= len(seats[table])
+                        and not any(other in self.apart.get(player, ())
+                                    for player in unit
+                                    for other in seated[table])):
+                        seated[table].extend(unit)
+                        break
+                else:
+                    break
+            else:
+                arrangement = [None] * len(tables)
+                for table, players in zip(seats, seated):
+                    for seat, player in zip(table, players):
+                        arrangement[seat] = player
+                return arrangement
+        raise ValueError("The seating constraints can't all be met")
+
+    def swap(self, round, a, b):
+        Annealer.swap(self, round, a, b)
+        arrangement = self.arrangements[round]
+        self.seatOf[round][arrangement[a]] = a
+        self.seatOf[round][arrangement[b]] = b
+
+    def fits(self, round, a, b):
+        """Check that swapping the players in seats a and b of a round keeps
+        the players who must be apart at different tables"""
+        tableA, tableB = self.tableOf[a], self.tableOf[b]
+        if tableA == tableB:
+            return True
+        arrangement = self.arrangements[round]
+        x, y = arrangement[a], arrangement[b]
+        apartX, apartY = self.apart.get(x), self.apart.get(y)
+        return not (
+            (apartX and any(arrangement[seat] in apartX
+                            for seat in self.seats[tableB] if seat != b)) or
+            (apartY and any(arrangement[seat] in apartY
+                            for seat in self.seats[tableA] if seat != a)))
+
+    def apartAt(self, round, table):
+        "Check whether any players who must be apart share a table"
+        players = [self.arrangements[round][seat] for seat in self.seats[table]]
+        return any(other in self.apart.get(player, ())
+                   for player in players for other in players)
+
+    def accept(self, change, temperature):
+        return change <= 0 or self.rng.random() < math.exp(-change / temperature)
+
+    def swapFree(self, round, temperature):
+        """Try swapping two players who aren't pinned or in a group.
+        Returns the change in score if the swap is made or None if not."""
+        seatOf = self.seatOf[round]
+        a = seatOf[self.rng.choice(self.free)]
+        b = seatOf[self.rng.choice(self.free)]
+        if not self.fits(round, a, b):
+            return None
+        change = self.delta(round, a, b)
+        if not self.accept(change, temperature):
+            return None
+        self.swap(round, a, b)
+        return change
+
+    def moveGroup(self, round, temperature):
+        """Try moving a group who must share a table to another table by
+        swapping them with players there who aren't pinned or in a group.
+        Returns the change in score if the move is made or None if not."""
+        group = self.rng.choice(self.movingGroups)
+        arrangement = self.arrangements[round]
+        seatOf = self.seatOf[round]
+        tableA = self.tableOf[seatOf[group[0]]]
+        tableB = self.rng.randrange(len(self.seats))
+        if tableA == tableB:
+            return None
+        candidates = [seat for seat in self.seats[tableB]
+                      if arrangement[seat] in self.isFree]
+        if len(candidates) < len(group):
+            return None
+        moves = list(zip([seatOf[player] for player in group],
+                         self.rng.sample(candidates, len(group))))
+        change = 0
+        for a, b in moves:
+            change += self.delta(round, a, b)
+            self.swap(round, a, b)
+        if (self.apartAt(round, tableA) or self.apartAt(round, tableB) or
+            not self.accept(change, temperature)):
+            for a, b in reversed(moves):
+                self.swap(round, a, b)
+            return None
+        return change
+
+    def run(self, budget, iterations, stall, progress=None):
+        """Search like Annealer.run, moving a group instead of swapping two
+        players GROUPMOVES of the time"""
+        best = [arrangement[:] for arrangement in self.arrangements]
+        bestScore = self.score
+        rounds = len(self.arrangements)
+        if (rounds == 0 or len(self.seats) < 2 or bestScore == 0 or
+            (len(self.free) < 2 and len(self.movingGroups) == 0)):
+            return best, bestScore, 0
+        rng = self.rng
+        start = time.perf_counter()
+        initial = temperature = self.temperature()
+        iteration = sinceBest = 0
+        while iteration < iterations and sinceBest < stall and bestScore > 0:
+            if iteration % 256 == 0:
+                if progress is not None and progress(iteration, bestScore):
+                    break
+                done = iteration / iterations
+                if budget is not None:
+                    elapsed = time.perf_counter() - start
+                    if elapsed >= budget:
+                        break
+                    done = max(done, elapsed / budget)
+                temperature = initial * (
+                    self.FINALTEMPERATURE / initial) ** done
+            iteration += 1
+            sinceBest += 1
+            round = rng.randrange(rounds) if rounds > 1 else 0
+            if self.movingGroups and (len(self.free) < 2 or
+                                      rng.random() < self.GROUPMOVES):
+                change = self.moveGroup(round, temperature)
+            else:
+                change = self.swapFree(round, temperature)
+            if change is not None:
+                self.score += change
+                if self.score < bestScore:
+                    best = [arrangement[:] for arrangement in self.arrangements]
+                    bestScore = self.score
+                    sinceBest = 0
+        return best, bestScore, iteration
+
+def togetherCounts(arrangements, size, sizes=None):
+    """Count the rounds each pair of players is seated at the same table in
+    a size x size matrix"""
+    together = [[0] * size for i in range(size)]
+    for arrangement in arrangements:
+        for seats in tableSeats(len(arrangement), sizes):
+            table = [arrangement[seat] for seat in seats]
+            for i, x in enumerate(table):
+                for y in table[i + 1:]:
+                    together[x][y] += 1
+                    together[y][x] += 1
+    return together
+
+def roundsScore(arrangements, playergames, priorities, sizes=None):
+    """Score the arrangements for a series of rounds.  This is the sum of
+    their tablesScores plus one for every round that each pair of players
+    is seated together in after their first, so it is the tablesScore of a
+    single arrangement."""
+    score = sum(tablesScore(arrangement, playergames, priorities, sizes)
+                for arrangement in arrangements)
+    together = togetherCounts(arrangements, len(playergames), sizes)
+    for i, counts in enumerate(together):
+        for count in counts[i + 1:]:
+            score += count * (count - 1) // 2
+    return score
+
+class Progress():
+    """Report the progress of a search in a shared dictionary, like one
+    made by a multiprocessing manager, at most every interval seconds.
+    The search is asked to stop once the cancel event is set."""
+    def __init__(self, status, cancel, interval=0.25):
+        self.status = status
+        self.cancel = cancel
+        self.interval = interval
+        self.last = None
+
+    def __call__(self, iterations, score):
+        "Record the progress and return true if the search should stop"
+        now = time.perf_counter()
+        if self.last is not None and now - self.last < self.interval:
+            return False
+        self.last = now
+        self.status.update(iterations=iterations, score=score)
+        return self.cancel.is_set()
+
+def annealRounds(tables, playergames, priorities, rounds, budget=None,
+                 iterations=None, stall=None, seed=None, progress=None,
+                 constraints=None):
+    """Search for low scoring arrangements of the players in tables for a
+    number of rounds by simulated annealing.  The limits default to the
+    SEATINGTIME, SEATINGITERATIONS, and SEATINGSTALL settings.  When a seed
+    is given the time budget is replaced by the number of swaps the
+    annealer's SWAPRATE allows in it, so the same arrangements are found
+    every time in about the same time.  Progress is reported to the optional progress function as
+    in Annealer.run.  If there are Constraints, the arrangements are laid
+    out in tables of the sizes from their layout.  Returns the list of
+    arrangements, their roundsScore, and the number of swaps tried.
+    Raises ValueError if the constraints can't be met."""
+    if constraints:
+        annealer = ConstrainedAnnealer(tables, playergames, priorities,
+                                       random.Random(seed), rounds,
+                                       constraints)
+    else:
+        annealer = Annealer(tables, playergames, priorities,
+                            random.Random(seed), rounds)
+    if budget is None:
+        budget = settings.SEATINGTIME
+    if iterations is None:
+        iterations = settings.SEATINGITERATIONS
+    if seed is not None:
+        iterations = min(iterations, max(1, int(budget * annealer.SWAPRATE)))
+        budget = None
+    return annealer.run(
+        budget, iterations,
+        settings.SEATINGSTALL if stall is None else stall,
+        progress)
+
+def annealArrangement(tables, playergames, priorities, budget=None,
+                      iterations=None, stall=None, seed=None):
+    """Search for a low scoring arrangement of the players in tables by
+    simulated annealing.  Returns the arrangement, its score, and the
+    number of swaps tried."""
+    arrangements, score, iterations = annealRounds(
+        tables, playergames, priorities, 1, budget, iterations, stall, seed)
+    return arrangements[0], score, iterations
+
+def planRounds(tables, playergames, priorities, rounds, seed=None,
+               progress=None, constraints=None):
+    """Find low scoring arrangements for a number of rounds with the
+    SEATINGSEARCH method.  Annealing is used for any constraints, since
+    the genetic search doesn't handle them.  It plans one round at a time,
+    counting the pairs seated together in the rounds before it as games
+    played, and only reports its progress between rounds.  Returns the
+    list of arrangements, their roundsScore, and the number of iterations,
+    which are swaps for annealing.  The genetic search doesn't count them.
+    If the progress function stops the search, the arrangements are the
+    best found so far, and the genetic search may return fewer rounds."""
+    if settings.SEATINGSEARCH == "genetic" and not constraints:
+        if seed is not None:
+            random.seed(seed)
+        arrangements = []
+        for i in range(rounds):
+            if progress is not None and progress(i, None):
+                break
+            together = togetherCounts(arrangements, len(playergames))
+            games = [[g + t for g, t in zip(gamesRow, togetherRow)]
+                     for gamesRow, togetherRow in zip(playergames, together)]
+            arrangements.append(bestArrangement(
+                tables, games, priorities,
+                engine='python' if seed is not None else None))
+        return (arrangements,
+                roundsScore(arrangements, playergames, priorities), None)
+    return annealRounds(tables, playergames, priorities, rounds, seed=seed,
+                        progress=progress, constraints=constraints)
+
+def arrange(tables, playergames, priorities, seed=None):
+    """Find a low scoring arrangement with the SEATINGSEARCH method.
+    Returns the arrangement, its score, and the number of iterations."""
+    arrangements, score, iterations = planRounds(
+        tables, playergames, priorities, 1, seed)
+    return arrangements[0], score, iterations
+
+def randomPlayerGames(numplayers, maxgames=3, rng=random):
+    "Make a random symmetric co-play matrix for testing and benchmarks"
+    playergames = [[0] * numplayers for i in range(numplayers)]
+    for i in range(numplayers):
+        for j in range(i + 1, numplayers):
+            playergames[i][j] = playergames[j][i] = rng.randint(0, maxgames)
+    return playergames
+
+def randomConstraints(numplayers, rng=random):
+    """Make random Constraints for testing and benchmarks: a pair kept
+    together and a pair kept apart per 10 players, a player pinned to the
+    first table, and a 4 player capacity for the last table"""
+    players = list(range(numplayers))
+    rng.shuffle(players)
+    count = max(1, numplayers // 10)
+    return Constraints(
+        together=[(players[2 * i], players[2 * i + 1]) for i in range(count)],
+        apart=[(players[2 * i + 1], players[2 * i + 2]) for i in range(count)],
+        pinned={players[-1]: 0},
+        capacities={len(tableLayout(numplayers)) - 1: 4})
+
+def benchmark(numplayers, repeat=3, engines=engines, budget=None):
+    """Time scoring a population and the full search with each engine for
+    random players, and annealing with and without randomConstraints with
+    the time budget (SEATINGTIME by default).  Checks that the engines
+    score the population equally and returns a dictionary of engine names,
+    "anneal", and "constrained" to (scoring seconds, search seconds, best
+    score) tuples.  Annealing has no scoring time."""
+    rng = random.Random(numplayers)
+    playergames = randomPlayerGames(numplayers, rng=rng)
+    priorities = [rng.randint(0, 1) for i in range(numplayers)]
+    population = []
+    for i in range(POPULATION):
+        arrangement = list(range(numplayers))
+        rng.shuffle(arrangement)
+        population.append(arrangement)
+
+    results = {}
+    expected = [tablesScore(a, playergames, priorities) for a in population]
+    for engine in engines:
+        if engine == 'numpy':
+            scorer = PopulationScorer(numplayers, playergames, priorities)
+            array = numpy.array(population)
+            scoreAll = lambda: scorer(array).tolist()
+        else:
+            scoreAll = lambda: [tablesScore(a, playergames, priorities)
+                                for a in population]
+        if scoreAll() != expected:
+            raise AssertionError(
+                "The {0} engine scored arrangements differently".format(engine))
+        start = time.perf_counter()
+        for i in range(repeat):
+            scoreAll()
+        scoring = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        for i in range(repeat):
+            best = bestArrangement(list(range(numplayers)), playergames,
+                                   priorities, engine=engine)
+        search = (time.perf_counter() - start) / repeat
+        results[engine] = (scoring, search,
+                           tablesScore(best, playergames, priorities))
+    start = time.perf_counter()
+    for i in range(repeat):
+        best, score, iterations = annealArrangement(
+            list(range(numplayers)), playergames, priorities, budget)
+    if score != tablesScore(best, playergames, priorities):
+        raise AssertionError("Annealing scored its arrangement incorrectly")
+    results['anneal'] = (None, (time.perf_counter() - start) / repeat, score)
+    constraints = randomConstraints(numplayers, rng)
+    start = time.perf_counter()
+    for i in range(repeat):
+        arrangements, score, iterations = annealRounds(
+            list(range(numplayers)), playergames, priorities, 1, budget,
+            constraints=constraints)
+    results['constrained'] = (None, (time.perf_counter() - start) / repeat,
+                              score)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-p', '--players', type=int, nargs='+', default=[8, 16, 24, 40],
+        help='Numbers of players to benchmark')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='Number of times to repeat each timing')
+    parser.add_argument(
+        '-b', '--budget', type=float, default=None,
+        help='Seconds for each annealing search.  Defaults to SEATINGTIME')
+    args = parser.parse_args()
+
+    available = [e for e in engines if e != 'numpy' or numpy is not None]
+    if numpy is None:
+        print("NumPy is not installed; only the python engine is timed")
+    print("{0:>7} {1:>11} {2:>12} {3:>12} {4:>6}".format(
+        "players", "engine", "score (ms)", "search (ms)", "best"))
+    for numplayers in args.players:
+        results = benchmark(numplayers, args.repeat, available, args.budget)
+        for engine in available + ['anneal', 'constrained']:
+            scoring, search, best = results[engine]
+            print("{0:>7} {1:>11} {2:>12} {3:>12.1f} {4:>6}".format(
+                numplayers, engine,
+                "-" if scoring is None else "{0:.2f}".format(scoring * 1000),
+                search * 1000, best))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Resolution of player names and IDs to Players records.  Names are matched
+without regard to ASCII case, like the unique Players_Name index, so
+"alice" and "Alice" are the same player.  A string is taken to be a
+player's name if any player has that name, and a player's ID only if not,
+so players with numeric names can still be found by name.  Integers are
+always IDs.
+
+Players are found with indexed queries in the caller's transaction, e.g.
+
+    ids = players.resolve_many(cur, ["Alice", "bob", "12"], create=True)
+
+Pages that only show players can pass cached=True to look them up in name
+to ID maps kept in the cache, tagged with "players", and reloaded after
+the Players table changes.  Those maps may not have caught up with the
+latest changes, so anything that writes player IDs queries instead.
+"""
+
+import string
+
+import cache
+import db
+
+_nocase = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def nocase(name):
+    "Normalize a name the way SQLite's NOCASE collation compares it"
+    return name.translate(_nocase)
+
+def loadMaps():
+    with db.getCur() as cur:
+        cur.execute("SELECT Id, Name FROM Players ORDER BY Id DESC")
+        rows = cur.fetchall()
+    # Load in descending ID order so the oldest of any duplicates wins
+    return {'names': dict((nocase(name), id) for id, name in rows
+                          if name is not None),
+            'ids': dict((id, name) for id, name in rows)}
+
+def playerMaps():
+    "Get the maps of normalized names to IDs and IDs to names"
+    return cache.fetch("playermaps", ['players'], loadMaps)
+
+def isID(player):
+    return isinstance(player, int) or (
+        isinstance(player, str) and player.isdigit())
+
+def chunks(values, size=500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def resolve_many(cur, players, create=False, created=None, cached=False):
+    """Map player names or IDs to player IDs.  Players that aren't found
+    are left out of the result unless create is true, in which case
+    records are added for the names and the IDs of the new players are
+    appended to the created list, if one is given.  The caller should
+    invalidate the "players" cache tag after committing new players.  If
+    cached is true, the cached maps are tried before querying, which is
+    only safe for showing players."""
+    maps = playerMaps() if cached else {'names': {}, 'ids': {}}
+    result = {}
+    missing = []
+    for player in dict.fromkeys(players):
+        if isinstance(player, str) and nocase(player) in maps['names']:
+            result[player] = maps['names'][nocase(player)]
+        elif isID(player) and int(player) in maps['ids']:
+            result[player] = int(player)
+        else:
+            missing.append(player)
+    if len(missing) == 0:
+        return result
+
+    names = {}
+    for chunk in chunks(player for player in missing
+                        if isinstance(player, str)):
+        cur.execute("SELECT Id, Name FROM Players WHERE Name COLLATE NOCASE"
+                    " IN ({0}) ORDER BY Id DESC".format(
+                        ",".join("?" * len(chunk))), chunk)
+        names.update((nocase(name), id) for id, name in cur.fetchall())
+    ids = set()
+    for chunk in chunks(int(player) for player in missing
+                        if isID(player)):
+        cur.execute("SELECT Id FROM Players WHERE Id IN ({0})".format(
+            ",".join("?" * len(chunk))), chunk)
+        ids.update(row[0] for row in cur.fetchall())
+    for player in missing:
+        if isinstance(player, str) and nocase(player) in names:
+            result[player] = names[nocase(player)]
+        elif isID(player) and int(player) in ids:
+            result[player] = int(player)
+        elif create and isinstance(player, str):
+            if nocase(player) not in names:
+                cur.execute("INSERT INTO Players(Name) VALUES(?)", (player,))
+                names[nocase(player)] = cur.lastrowid
+                if created is not None:
+                    created.append(cur.lastrowid)
+            result[player] = names[nocase(player)]
+    return result
+
+def resolve(cur, player, create=False, created=None, cached=False):
+    "Get the ID of a player given by name or ID, or None if there's none"
+    return resolve_many(cur, [player], create, created, cached).get(player)
+
+def lookup(cur, player):
+    """Get the (Id, Name, MeetupName) record of a player given by name or
+    ID, or None if there's none"""
+    playerID = resolve(cur, player, cached=True)
+    if playerID is None:
+        return None
+    cur.execute("SELECT Id, Name, MeetupName FROM Players WHERE Id = ?",
+                (playerID,))
+    return cur.fetchone()
+
+def resolve_meetup_names(cur, names):
+    """Get the IDs of the players with the given meetup names, or names for
+    players without a meetup name, ignoring names that aren't found"""
+    result = set()
+    for chunk in chunks(dict.fromkeys(names)):
+        cur.execute("SELECT Id FROM Players WHERE COALESCE(MeetupName, Name)"
+                    " COLLATE NOCASE IN ({0})".format(
+                        ",".join("?" * len(chunk))), chunk)
+        result.update(row[0] for row in cur.fetchall())
+    return sorted(result)
@@ -1,107 +1,74 @@
 #!/usr/bin/env python3
 
 import json
+import collections
 
+import cache
 import db
 import handler
 import leaderboard
+import players
+import workers
 from util import *
 
 class PlayerStatsDataHandler(handler.BaseHandler):
-    _statquery = """
-       SELECT Max(Score),MIN(Score),COUNT(*),
-         ROUND(SUM(Score) * 1.0/COUNT(*) * 100) / 100,
-         ROUND(SUM(Rank) * 1.0/COUNT(*) * 100) / 100,
-         MIN(Rank), MAX(Rank), MIN(Date), MAX(Date),
-         MIN(Quarter), MAX(Quarter) {subquery} """
-    _statqfields = ['maxscore', 'minscore', 'numgames', 'avgscore',
-                    'avgrank', 'maxrank', 'minrank', 'mindate', 'maxdate',
-                    'minquarter', 'maxquarter']
-    _rankhistogramquery = """
-        SELECT Rank, COUNT(*) {subquery} GROUP BY Rank ORDER BY Rank"""
-    _rankhfields = ['rank', 'rankcount']
-
-    def populate_queries(self, cur, period_dict):
-        cur.execute(self._statquery.format(**period_dict),
-                    period_dict['params'])
-        period_dict.update(
-            dict(zip(self._statqfields,
-                     map(lambda x: round(x, 2) if isinstance(x, float) else x,
-                         cur.fetchone()))))
-        cur.execute(self._rankhistogramquery.format(**period_dict),
-                    period_dict['params'])
-        rank_histogram = dict([map(int, r) for r in cur.fetchall()])
-        rank_histogram_list = [{'rank': i, 'count': rank_histogram.get(i, 0)}
-                               for i in range(1, 6)]
-        period_dict['rank_histogram'] = rank_histogram_list
-
-    def get(self, player):
+    def getStats(self, player):
+        """Get the player's statistics for all time, their last few games,
+        and the latest two quarters.  Returns the player's name and the
+        list of period statistics.  The list is None if the player isn't
+        found and empty if they have no scores.  The statistics are cached
+        until the player's scores change."""
         with db.getCur() as cur:
             name = player
-            cur.execute("SELECT Id,Name,MeetupName FROM Players WHERE Id = ? OR Name = ?", (player, player))
-            player = cur.fetchone()
-            if player is None or len(player) == 0:
-                self.write(json.dumps({'status': 1,
-                                       'error': "Couldn't find player"}))
-                return
+            player = players.lookup(cur, player)
+            if player is None:
+                return name, None
             playerID, name, meetupName = player
 
-            N = 5
-            periods = [
-                {'name': 'All Time Stats',
-                 'subquery': "FROM Scores WHERE PlayerId = ?",
-                 'params': (playerID,)
-                },
-            ]
-            p = periods[0]
-            self.populate_queries(cur, p)
-            if p['numgames'] == 0:
-                return self.render("playerstats.html", name=name,
-                                   error = "Couldn't find any scores for")
-
-            # Add optional periods if warranted
-            if p['numgames'] > N:
-                periods.append(
-                    {'name': 'Last {0} Game Stats'.format(N),
-                     'subquery': "FROM (SELECT * FROM Scores WHERE PlayerId = ? ORDER BY Date DESC LIMIT ?)",
-                     'params': (playerID, N)
-                     })
-            if p['minquarter'] < p['maxquarter']:
-                periods.append(
-                    {'name': 'Quarter {0} Stats'.format(p['maxquarter']),
-                     'subquery': "FROM Scores WHERE PlayerId = ? AND Quarter = ?",
-                     'params': (playerID, p['maxquarter'])
-                     })
-                prevQtr = formatQuarter(prevQuarter(parseQuarter(p['maxquarter'])))
-                periods.append(
-                    {'name': 'Quarter {0} Stats'.format(prevQtr),
-                     'subquery': "FROM Scores WHERE PlayerId = ? AND Quarter = ?",
-                     'params': (playerID, prevQtr)
-                     })
-            for p in periods[1:]:
-                self.populate_queries(cur, p)
-
+            return name, cache.fetch(
+                "playerstats:{0}".format(playerID),
+                ["player:{0}".format(playerID)],
+                lambda: self.periodStats(cur, playerID))
+
+    def periodStats(self, cur, playerID):
+        """Compute the statistics of a player, an empty list if they have no
+        scores.  The player's scores are read in one query, newest first,
+        and every period is aggregated from them in Python."""
+        cur.execute(
+            "SELECT Score, Rank, Date, Quarter FROM Scores WHERE PlayerId = ?"
+            " ORDER BY Date DESC, GameId DESC", (playerID,))
+        scores = cur.fetchall()
+        return playerPeriodStats(scores)
+
+    @handler.data_version_etag
+    async def get(self, player):
+        name, periods = await workers.run_db(self.getStats, player)
+        if periods is None:
+            self.write(json.dumps({'status': 1,
+                                   'error': "Couldn't find player"}))
+        elif len(periods) == 0:
+            self.render("playerstats.html", name=name,
+                        error = "Couldn't find any scores for")
+        else:
             self.write(json.dumps({'playerstats': periods}))
 
 
 class PlayerStatsHandler(handler.BaseHandler):
-    def get(self, player):
-        with db.getCur() as cur:
-            name = player
-            cur.execute("SELECT Id,Name,MeetupName FROM Players WHERE Id = ? OR Name = ?", (player, player))
-            player = cur.fetchone()
-            if player is None or len(player) == 0:
-                return self.render("playerstats.html", name=name,
-                                   error = "Couldn't find player")
-
-            player, name, meetupname = player
-            self.render("playerstats.html",
-                        error = None,
-                        name = name,
-                        meetupname = meetupname,
-                )
-
-    def post(self, player):
+    async def get(self, player):
+        name = player
+        player = await workers.run_db(lookupPlayer, player)
+        if player is None:
+            return self.render("playerstats.html", name=name,
+                               error = "Couldn't find player")
+
+        player, name, meetupname = player
+        self.render("playerstats.html",
+                    error = None,
+                    name = name,
+                    meetupname = meetupname,
+            )
+
+    async def post(self, player):
         name = self.get_argument("name", player)
         meetupname = self.get_argument("meetupname", None)
         if name != player or meetupname is not None:
@@ -114,13 +81,88 @@ class PlayerStatsHandler(handler.BaseHandler):
                 cols += ["MeetupName = ?"]
                 args += [meetupname]
             if len(args) > 0:
-                query = "UPDATE Players SET " + ",".join(cols) + " WHERE Id = ? OR Name = ?"
-                args += [player, player]
-                with db.getCur() as cur:
-                    cur.execute(query, args)
-                    leaderboard.clearCache()
+                error = await workers.run_db(
+                    updatePlayer, player, cols, args,
+                    name if name != player else None)
+                if error:
+                    return self.render("playerstats.html", name=name,
+                                       error=error)
             self.redirect("/playerstats/" + name)
 
+def lookupPlayer(player):
+    with db.getCur() as cur:
+        return players.lookup(cur, player)
+
+def updatePlayer(player, cols, args, name=None):
+    """Set columns of the record of a player given by ID or name and
+    invalidate the cached results that show the player.  If the player is
+    being renamed, the new name must not belong to another player.
+    Returns an error message or None if the update succeeded."""
+    with db.getCur() as cur:
+        playerID = players.resolve(cur, player)
+        if playerID is None:
+            return "Couldn't find player"
+        if name is not None and players.resolve(cur, name) not in (
+                None, playerID):
+            return "There is already a player named"
+        query = "UPDATE Players SET " + ",".join(cols) + " WHERE Id = ?"
+        cur.execute(query, args + [playerID])
+    cache.invalidate('players', "player:{0}".format(playerID))
+    return None
+
+statFields = ['maxscore', 'minscore', 'numgames', 'avgscore', 'avgrank',
+              'maxrank', 'minrank', 'mindate', 'maxdate', 'minquarter',
+              'maxquarter']
+
+def scoreStats(name, scores, ascending=False):
+    """Aggregate (Score, Rank, Date, Quarter) rows into the statistics of a
+    period with its rank histogram.  Note that maxrank is the best (lowest)
+    rank.  Only numgames is set if there are no scores.  The scores are
+    summed in the order given, or from the lowest if ascending is set, to
+    round averages the way the SQL aggregates they replace did."""
+    stats = {'name': name}
+    if len(scores) == 0:
+        stats.update((field, None) for field in statFields)
+        stats['numgames'] = 0
+    else:
+        points, ranks, dates, quarters = zip(*scores)
+        count = len(scores)
+        stats.update(zip(statFields, [
+            max(points), min(points), count,
+            leaderboard.averageScore(db.ascendingSum(
+                sorted(points) if ascending else points), count),
+            leaderboard.averageScore(sum(ranks), count),
+            min(ranks), max(ranks), min(dates), max(dates),
+            min(quarters), max(quarters)]))
+        for field in statFields:
+            if isinstance(stats[field], float):
+                stats[field] = round(stats[field], 2)
+    histogram = collections.Counter(rank for score, rank, date, quarter
+                                    in scores)
+    stats['rank_histogram'] = [{'rank': i, 'count': histogram.get(i, 0)}
+                               for i in range(1, 6)]
+    return stats
+
+def playerPeriodStats(scores, N=5):
+    """Compute the statistics for all of a player's scores, their last N
+    games, and their latest two quarters from (Score, Rank, Date, Quarter)
+    rows ordered newest first.  Returns an empty list if there are none."""
+    if len(scores) == 0:
+        return []
+    periods = [scoreStats('All Time Stats', scores[::-1])]
+    if len(scores) > N:
+        periods.append(
+            scoreStats('Last {0} Game Stats'.format(N), scores[:N]))
+    first, last = periods[0]['minquarter'], periods[0]['maxquarter']
+    if first < last:
+        prevQtr = formatQuarter(prevQuarter(parseQuarter(last)))
+        for quarter in (last, prevQtr):
+            periods.append(scoreStats(
+                'Quarter {0} Stats'.format(quarter),
+                [score for score in scores if score[3] == quarter],
+                ascending=True))
+    return periods
+
 quarterSuffixes = {'1': 'st', '2': 'nd', '3': 'rd', '4': 'th'}
 
 def parseQuarter(qstring):
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Push channels for pages that show live data, like the timers and the
+seating tables.  A page opens a WebSocket to /push/ followed by the names
+of the channels it wants, separated by commas, e.g. /push/seating,timers.
+It gets a snapshot of each channel's data when it connects and again every
+time the data changes, as JSON messages like
+
+    {"channel": "timers", "data": {"timers": [...]}}
+
+Modules register a channel with a function that computes its snapshot,
+in the database pool unless it reads only memory, and the handlers that
+change the data call publish() on the IOLoop after the change is
+committed.  The snapshot is computed once per change and sent to every
+subscriber, and changes that arrive while a snapshot is being computed
+are folded into one more snapshot, so the database work follows the
+number of changes, not the number of browsers.  Channels can require a
+signed in user.  Pages only poll as a fallback while they have no
+connection.  A proxy in front of the server must pass the WebSocket
+upgrade for /push/, as the nginx configuration in ansible/ does.
+"""
+
+import json
+import logging
+
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+
+import handler
+import workers
+
+log = logging.getLogger("WebServer")
+
+class Channel():
+    "A named snapshot of data and the sockets subscribed to it"
+    def __init__(self, name, snapshot, authenticated=False, database=True):
+        self.name = name
+        self.snapshot = snapshot
+        self.authenticated = authenticated
+        self.database = database
+        self.clients = set()
+        self.publishing = False
+        self.stale = False
+        self.published = 0
+
+    async def message(self):
+        data = (await workers.run_db(self.snapshot) if self.database else
+                self.snapshot())
+        return json.dumps({"channel":self.name, "data":data})
+
+    def publish(self):
+        if self.publishing:
+            self.stale = True
+        elif self.clients:
+            self.publishing = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self.broadcast)
+
+    async def broadcast(self):
+        try:
+            self.stale = True
+            while self.stale and self.clients:
+                self.stale = False
+                message = await self.message()
+                for client in list(self.clients):
+                    client.send(message)
+                self.published += 1
+        except Exception:
+            log.exception("Push channel {0} failed".format(self.name))
+        finally:
+            self.publishing = False
+
+channels = {}
+
+def register(name, snapshot, authenticated=False, database=True):
+    """Register a channel whose data is the result of calling snapshot in
+    the database pool, or on the IOLoop if database is false.  If
+    authenticated is true, only signed in users can subscribe."""
+    channels[name] = Channel(name, snapshot, authenticated, database)
+
+def publish(*names):
+    """Send new snapshots of the named channels to their subscribers.  Call
+    this on the IOLoop after committing a change to the channels' data."""
+    for name in names:
+        channels[name].publish()
+
+def connections():
+    "Get the number of open push sockets"
+    return len(PushSocket.sockets)
+
+def statistics():
+    return {'connections': connections(),
+            'channels': dict((name, {'subscribers': len(channel.clients),
+                                     'published': channel.published})
+                             for name, channel in channels.items())}
+
+class PushSocket(tornado.websocket.WebSocketHandler, handler.BaseHandler):
+    """Subscribe to the channels named in the path, sending a snapshot of
+    each when the socket opens.  Unknown channels and channels the user
+    may not see are refused before the socket is opened."""
+    sockets = set()
+
+    def get(self, names):
+        self.subscriptions = []
+        for name in names.split(','):
+            channel = channels.get(name)
+            if channel is None:
+                raise tornado.web.HTTPError(404)
+            if channel.authenticated and not self.current_user:
+                raise tornado.web.HTTPError(403)
+            self.subscriptions.append(channel)
+        return super().get(names)
+
+    async def open(self, names):
+        self.sockets.add(self)
+        for channel in self.subscriptions:
+            channel.clients.add(self)
+        for channel in self.subscriptions:
+            self.send(await channel.message())
+
+    def send(self, message):
+        try:
+            self.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            self.on_close()
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        self.sockets.discard(self)
+        for channel in self.subscriptions:
+            channel.clients.discard(self)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Rebuild the per-player, per-period aggregates (the PlayerPeriods table)
+that the leaderboards are read from and the counts of games each pair of
+players have played together each quarter (the PairCounts table) that
+the seating is read from.  The aggregates are normally kept up to date
+as games are added, edited, and deleted, and rebuilt when the schema or
+MAXDROPGAMES changes, so this is only needed after the Scores table is
+changed by other means.
+"""
+
+import sys
+import argparse
+
+import db
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-f', '--force', default=False, action='store_true',
+        help='Force database schema updates without prompting')
+    args = parser.parse_args()
+
+    db.init(force=args.force)
+    db.rebuildPlayerPeriods()
+    db.rebuildPairCounts()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,15 +3,23 @@
 
 import meetup.api
 import json
+import tornado.ioloop
 import tornado.web
 import db
-import random
+import cache
+import players
 import datetime
-import math
-from operator import itemgetter
+import itertools
+import logging
+import time
 
 import handler
+import optimizer
+import push
 import settings
+import workers
+
+log = logging.getLogger("WebServer")
 
 def meetup_ready():
     return (settings.MEETUP_APIKEY and settings.MEETUP_GROUPNAME and
@@ -27,96 +35,398 @@ class SeatingHandler(handler.BaseHandler):
         self.render("seating.html", meetup_ok = meetup_ready(),
                     today=meetup_date().strftime('%a %d-%b'))
 
+MAXROUNDS = 20
+
 class RegenTables(handler.BaseHandler):
+    """Start a background job planning the seating for the rounds of the
+    session that haven't started, cancelling any job already running.  The
+    rounds argument is the number of rounds in the whole session, which
+    defaults to the number already planned or SEATINGROUNDS.  The started
+    rounds are kept and the pairs seated together in them count as games
+    played when planning the remaining rounds, so late arrivals and
+    departures only change the rounds still to come.  Responds with the
+    job's ID for /seating/status.json."""
+    @tornado.web.authenticated
+    async def post(self):
+        self.set_header('Content-Type', 'application/json')
+        seed = self.get_argument('seed', None)
+        if seed is not None and not seed.lstrip('-').isdigit():
+            self.write('{"status":1,"error":"The seed must be an integer"}')
+            return
+        rounds = self.get_argument('rounds', None)
+        if rounds is not None and not (rounds.isdigit() and
+                                       0 < int(rounds) <= MAXROUNDS):
+            self.write(json.dumps({
+                "status":1,
+                "error":"The rounds must be a number from 1 to {0}".format(
+                    MAXROUNDS)}))
+            return
+        cancelSeating()
+        session = await workers.run_db(sessionPlayerGames)
+        players, constraints, started, planned = (
+            session[0], session[3], session[4], session[5])
+        rounds = int(rounds) if rounds else planned or settings.SEATINGROUNDS
+        if rounds <= started:
+            self.write(json.dumps({
+                "status":1,
+                "error":"Only rounds after round {0} can be planned".format(
+                    started)}))
+            return
+        try:
+            constraints.layout(len(players))
+        except ValueError as e:
+            self.write(json.dumps({"status":1, "error":str(e)}))
+            return
+        job = SeatingJob(session, rounds, None if seed is None else int(seed))
+        tornado.ioloop.IOLoop.current().spawn_callback(job.run)
+        self.write(json.dumps({"status":0, "job":job.id}))
+
+class SeatingJob():
+    """A search for the seating of the remaining rounds of the session.
+    The search runs in the CPU process pool and reports its progress in a
+    dictionary shared through the workers' multiprocessing manager.  It
+    stops early when cancelled, and its plan is only saved, in one short
+    transaction, if it finishes and the current players haven't changed.
+    Calls to the manager are round trips to its process, so they are made
+    in the worker threads rather than on the IOLoop."""
+    ids = itertools.count(1)
+
+    def __init__(self, session, rounds, seed):
+        self.id = next(SeatingJob.ids)
+        self.session = session
+        self.rounds = rounds
+        self.seed = seed
+        self.state = 'running'
+        self.error = None
+        self.result = None
+        self.started = time.time()
+        self.finished = None
+        self.progress = None
+        self.cancelled = None
+        jobs[self.id] = self
+        while len(jobs) > MAXJOBS:
+            jobs.pop(min(jobs))
+
+    def cancel(self):
+        if self.state == 'running':
+            self.state = 'cancelled'
+            if self.cancelled is not None:
+                tornado.ioloop.IOLoop.current().spawn_callback(
+                    workers.run_db, self.cancelled.set)
+
+    async def run(self):
+        (players, playergames, priorities, constraints,
+         started, planned) = self.session
+        try:
+            self.progress, self.cancelled = await workers.run_db(sharedState)
+            if self.state != 'running':
+                return
+            arrangements, score, iterations = await workers.run_cpu(
+                optimizer.planRounds, list(range(len(players))), playergames,
+                priorities, self.rounds - started, self.seed,
+                optimizer.Progress(self.progress, self.cancelled),
+                constraints)
+            if self.state == 'running':
+                tableNumbers = [None] * len(players)
+                for table, seats in enumerate(optimizer.tableSeats(
+                        len(players), constraints.layout(len(players)))):
+                    for seat in seats:
+                        tableNumbers[seat] = table + 1
+                await workers.run_db(
+                    saveRounds,
+                    [[players[i] for i in arrangement]
+                     for arrangement in arrangements],
+                    tableNumbers, started + 1, self.current())
+                push.publish('seating')
+        except ValueError as e:
+            self.fail(str(e))
+        except tornado.web.HTTPError as e:
+            self.fail(e.log_message)
+        except Exception:
+            log.exception("Seating job {0} failed".format(self.id))
+            self.fail("Seating search failed")
+        else:
+            if self.state == 'running':
+                self.state = 'done'
+                self.result = {"rounds":self.rounds, "score":score,
+                               "iterations":iterations}
+        finally:
+            self.finished = time.time()
+
+    def current(self):
+        "Get the (PlayerId, Priority, TableNumber) rows the job started from"
+        players, priorities, constraints = (
+            self.session[0], self.session[2], self.session[3])
+        return [(player, priority, None if i not in constraints.pinned
+                 else constraints.pinned[i] + 1)
+                for i, (player, priority) in enumerate(zip(players,
+                                                           priorities))]
+
+    def fail(self, error):
+        if self.state == 'running':
+            self.state = 'failed'
+            self.error = error
+
+    async def status(self):
+        status = {"job":self.id, "state":self.state, "rounds":self.rounds,
+                  "elapsed":round((self.finished or time.time()) -
+                                  self.started, 3)}
+        if self.state == 'running' and self.progress is not None:
+            status.update(await workers.run_db(self.progress.copy))
+        elif self.result is not None:
+            status.update(self.result)
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+def sharedState():
+    "Make the progress dictionary and cancel event shared with a search"
+    manager = workers.manager()
+    return manager.dict(), manager.Event()
+
+jobs = {}
+MAXJOBS = 10
+
+def cancelSeating():
+    "Cancel the running seating jobs, e.g. when the current players change"
+    for job in jobs.values():
+        job.cancel()
+
+class SeatingStatus(handler.BaseHandler):
+    """Get the state of the seating job given by the job argument, or the
+    latest job, with the number of iterations and the best score so far
+    while it runs"""
+    @tornado.web.authenticated
+    async def get(self):
+        self.set_header('Content-Type', 'application/json')
+        job = self.get_argument('job', None)
+        if job is None:
+            job = max(jobs) if jobs else None
+        elif job.isdigit():
+            job = int(job)
+        if job not in jobs:
+            self.write('{"status":1,"error":"No such seating job"}')
+            return
+        status = await jobs[job].status()
+        status["status"] = 0
+        self.write(json.dumps(status))
+
+class CancelSeating(handler.BaseHandler):
     @tornado.web.authenticated
     def post(self):
         self.set_header('Content-Type', 'application/json')
-        with db.getCur() as cur:
-            cur.execute("SELECT PlayerId, Priority FROM CurrentPlayers")
-            priorities = dict(cur.fetchall())
-            players = list(priorities.keys())
-            playergames = playerGames(players, cur)
-            tables = bestArrangement(players, playergames, priorities)
-            cur.execute("DELETE FROM CurrentTables")
-            cur.execute("INSERT INTO CurrentTables(PlayerId) VALUES" + ",".join(["(?)"] * len(players)), tables)
-            self.write('{"status":0}')
+        cancelSeating()
+        self.write('{"status":0}')
+
+def recordedTables(cur):
+    """Get the (Round, TableNumber) of the tables of started rounds whose
+    game has been entered, so it is already counted in PairCounts"""
+    cur.execute(
+        "SELECT Seats.Round, Seats.TableNumber"
+        " FROM SessionSeats AS Seats"
+        " JOIN SessionRounds ON SessionRounds.Round = Seats.Round"
+        " JOIN Scores ON Scores.PlayerId = Seats.PlayerId"
+        "  AND Scores.Date >= date(SessionRounds.Started, 'localtime')"
+        " WHERE Started IS NOT NULL AND Seats.TableNumber IS NOT NULL"
+        " GROUP BY Seats.Round, Seats.TableNumber, Scores.GameId"
+        " HAVING COUNT(DISTINCT Seats.PlayerId) = ("
+        "  SELECT COUNT(PlayerId) FROM SessionSeats"
+        "  WHERE Round = Seats.Round AND TableNumber = Seats.TableNumber)")
+    return set(cur.fetchall())
+
+def sessionPlayerGames():
+    """Get the current players' IDs, the matrix of the number of games each
+    pair of them have played together this quarter, the list of their
+    priorities, and their seating Constraints.  The matrix, priorities,
+    and constraints are indexed by the players' positions in the list of
+    IDs, and the constraints' tables are numbered from 0.  Pairs seated at
+    the same table in a started round of the session are counted in the
+    matrix as another game until that game has been entered, that is until
+    a game on or after the round's start has all the table's players.
+    Also returns the numbers of rounds started and planned."""
+    with db.getCur() as cur:
+        cur.execute("SELECT PlayerId, Priority, TableNumber FROM CurrentPlayers")
+        rows = cur.fetchall()
+        players = [row[0] for row in rows]
+        priorities = [row[1] for row in rows]
+        position = dict((player, i) for i, player in enumerate(players))
+        playergames = playerGames(players, cur)
+
+        cur.execute("SELECT PlayerId, OtherId, Together FROM SeatingPairs")
+        pairs = [(position[a], position[b], together)
+                 for a, b, together in cur.fetchall()]
+        cur.execute("SELECT TableNumber, Capacity FROM SeatingTables")
+        constraints = optimizer.Constraints(
+            together=[(a, b) for a, b, together in pairs if together],
+            apart=[(a, b) for a, b, together in pairs if not together],
+            pinned=dict((position[player], table - 1)
+                        for player, priority, table in rows
+                        if table is not None),
+            capacities=dict((table - 1, capacity)
+                            for table, capacity in cur.fetchall()))
+
+        cur.execute("SELECT COUNT(Started), COUNT(*) FROM SessionRounds")
+        started, planned = cur.fetchone()
+        cur.execute("SELECT SessionSeats.Round, TableNumber, PlayerId"
+                    " FROM SessionSeats JOIN SessionRounds"
+                    "  ON SessionRounds.Round = SessionSeats.Round"
+                    " WHERE Started IS NOT NULL AND TableNumber IS NOT NULL")
+        seated = {}
+        for round, table, player in cur.fetchall():
+            if player in position:
+                seated.setdefault((round, table), []).append(position[player])
+        for key in recordedTables(cur):
+            seated.pop(key, None)
+    for table in seated.values():
+        for i, x in enumerate(table):
+            for y in table[i + 1:]:
+                playergames[x][y] += 1
+                playergames[y][x] += 1
+    return players, playergames, priorities, constraints, started, planned
+
+def saveRounds(arrangements, tableNumbers, first, current):
+    """Replace the rounds of the session plan from round number first on
+    with the arrangements of player IDs, seating each seat at the table
+    number in tableNumbers.  Raises ValueError if one of those rounds has
+    started or the current (PlayerId, Priority, TableNumber) rows have
+    changed since the plan was made."""
+    with db.getCur() as cur:
+        cur.execute("DELETE FROM SessionSeats WHERE Round >= ?", (first,))
+        cur.execute("SELECT COUNT(*) FROM SessionRounds"
+                    " WHERE Round >= ? AND Started IS NOT NULL", (first,))
+        if cur.fetchone()[0] > 0:
+            raise ValueError("Round {0} started while planning".format(first))
+        cur.execute("SELECT PlayerId, Priority, TableNumber FROM CurrentPlayers")
+        if sorted(cur.fetchall()) != sorted(current):
+            raise ValueError("The players changed while planning")
+        cur.execute("DELETE FROM SessionRounds WHERE Round >= ?", (first,))
+        cur.executemany("INSERT INTO SessionRounds(Round) VALUES (?)",
+                        [(first + i,) for i in range(len(arrangements))])
+        cur.executemany(
+            "INSERT INTO SessionSeats(Round, Seat, PlayerId, TableNumber)"
+            " VALUES (?, ?, ?, ?)",
+            [(first + i, seat, player, tableNumbers[seat])
+             for i, arrangement in enumerate(arrangements)
+             for seat, player in enumerate(arrangement)])
+
+class NextRound(handler.BaseHandler):
+    @tornado.web.authenticated
+    async def post(self):
+        self.set_header('Content-Type', 'application/json')
+        round = await workers.run_db(startNextRound)
+        push.publish('seating')
+        if round is None:
+            self.write('{"status":1,"error":"No more rounds are planned"}')
+        else:
+            self.write(json.dumps({"status":0, "round":round}))
+
+def startNextRound():
+    """Start the first round of the session plan that hasn't started.
+    Returns its number or None if every round has started."""
+    with db.getCur() as cur:
+        cur.execute("SELECT MIN(Round) FROM SessionRounds WHERE Started IS NULL")
+        round = cur.fetchone()[0]
+        if round is not None:
+            cur.execute("UPDATE SessionRounds SET Started = datetime('now')"
+                        " WHERE Round = ?", (round,))
+    return round
 
 class CurrentPlayers(handler.BaseHandler):
     @tornado.web.authenticated
-    def get(self):
-        with db.getCur() as cur:
-            self.set_header('Content-Type', 'application/json')
-            cur.execute("SELECT Name, Priority FROM CurrentPlayers INNER JOIN Players ON PlayerId = Players.Id ORDER BY Players.Name")
-            self.write(json.dumps({"players":[{"name":row[0], "priority":row[1] == 1} for row in cur.fetchall()]}))
+    @handler.data_version_etag
+    async def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(await workers.run_db(currentPlayers)))
+
+def currentPlayers():
+    with db.getCur() as cur:
+        cur.execute("SELECT Name, Priority, TableNumber FROM CurrentPlayers INNER JOIN Players ON PlayerId = Players.Id ORDER BY Players.Name")
+        return {"players":[{"name":row[0], "priority":row[1] == 1, "table":row[2]} for row in cur.fetchall()]}
+
+def sessionPlayers():
+    "Get the current players and the seating constraints for the push channel"
+    return {"players":currentPlayers()["players"],
+            "constraints":seatingConstraints()}
 
 
 class AddMeetupPlayers(handler.BaseHandler):
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         if meetup_ready():
-            client = meetup.api.Client(settings.MEETUP_APIKEY)
-            event_params = {'group_urlname':settings.MEETUP_GROUPNAME}
-            if meetup_date() < datetime.date.today():
-                event_params['status'] = 'past'
-                event_params['desc'] = True
-            events = client.GetEvents(event_params)
-            ret = {'status':'error','message':'Unknown error ocurred'}
-            if len(events.results) > 0:
-                event = events.results[0]
-                for result in events.results:
-                    if datetime.date.fromtimestamp(result['time'] / 1000) == meetup_date():
-                        event = result
-                rsvps = client.GetRsvps({'event_id':event['id']})
-                with db.getCur() as cur:
-                    members = [member['member']['name'] for member in rsvps.results if member['response'] == 'yes']
-                    if len(members) > 0:
-                        cur.execute("INSERT INTO CurrentPlayers(PlayerId, Priority) SELECT Id, 1 FROM Players WHERE \
-                            COALESCE(MeetupName, Name) IN (" + ",".join('?' * len(members)) + ") AND NOT EXISTS(SELECT 1 FROM CurrentPlayers WHERE PlayerId = Players.Id)", members)
-                    ret['status'] = "success"
-                    ret['message'] = "Players added"
-            else:
-                ret['message'] = 'No meetup events found'
+            ret = await workers.run_db(addMeetupPlayers)
+            push.publish('currentplayers')
         else:
             ret = {'status':'error','message':'Meetup.com API not configured'}
         self.write(json.dumps(ret))
 
+def addMeetupPlayers():
+    "Add the players who RSVP'd yes to today's meetup event"
+    client = meetup.api.Client(settings.MEETUP_APIKEY)
+    event_params = {'group_urlname':settings.MEETUP_GROUPNAME}
+    if meetup_date() < datetime.date.today():
+        event_params['status'] = 'past'
+        event_params['desc'] = True
+    events = client.GetEvents(event_params)
+    ret = {'status':'error','message':'Unknown error ocurred'}
+    if len(events.results) > 0:
+        event = events.results[0]
+        for result in events.results:
+            if datetime.date.fromtimestamp(result['time'] / 1000) == meetup_date():
+                event = result
+        rsvps = client.GetRsvps({'event_id':event['id']})
+        with db.getCur() as cur:
+            members = [member['member']['name'] for member in rsvps.results if member['response'] == 'yes']
+            ids = players.resolve_meetup_names(cur, members)
+            if len(ids) > 0:
+                cur.executemany("INSERT INTO CurrentPlayers(PlayerId, Priority) SELECT ?, 1 WHERE \
+                    NOT EXISTS(SELECT 1 FROM CurrentPlayers WHERE PlayerId = ?)", [(i, i) for i in ids])
+            ret['status'] = "success"
+            ret['message'] = "Players added"
+    else:
+        ret['message'] = 'No meetup events found'
+    return ret
+
 class AddCurrentPlayer(handler.BaseHandler):
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         player = self.get_argument('player', None)
 
         if player is None or player == "":
             self.write('{"status":1,"error":"Please enter a player"}')
             return
 
-        with db.getCur() as cur:
-            cur.execute("SELECT Id FROM Players WHERE Id = ? OR Name = ?", (player, player))
-            row = cur.fetchone()
-            if row is None or len(row) == 0:
-                cur.execute("INSERT INTO Players(Name) VALUES(?)", (player,))
-                cur.execute("SELECT Id FROM Players WHERE Name = ?", (player,))
-                row = cur.fetchone()
-            player = row[0]
-
-            cur.execute("INSERT INTO CurrentPlayers(PlayerId, Priority) SELECT ?, 0 WHERE NOT EXISTS(SELECT 1 FROM CurrentPlayers WHERE PlayerId = ?)", (player,player))
-            self.write('{"status":0}')
+        cancelSeating()
+        await workers.run_db(addCurrentPlayer, player)
+        push.publish('currentplayers')
+        self.write('{"status":0}')
+
+def addCurrentPlayer(player):
+    "Add a player by ID or name to the current players, creating them if needed"
+    with db.getCur() as cur:
+        created = []
+        player = players.resolve(cur, player, create=True, created=created)
+
+        cur.execute("INSERT INTO CurrentPlayers(PlayerId, Priority) SELECT ?, 0 WHERE NOT EXISTS(SELECT 1 FROM CurrentPlayers WHERE PlayerId = ?)", (player,player))
+    if created:
+        cache.invalidate('players')
 
 class RemovePlayer(handler.BaseHandler):
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         player = self.get_argument('player', None)
 
         if player is None:
             self.write('{"status":1,"error":"Please enter a player"}')
             return
 
-        with db.getCur() as cur:
-            cur.execute("DELETE FROM CurrentPlayers WHERE PlayerId IN (SELECT Id FROM Players WHERE Players.Id = ? OR Players.Name = ?)", (player, player))
-            self.write('{"status":0}')
+        cancelSeating()
+        await workers.run_db(removeCurrentPlayer, player)
+        push.publish('currentplayers')
+        self.write('{"status":0}')
 
 class PrioritizePlayer(handler.BaseHandler):
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         player = self.get_argument('player', None)
         priority = self.get_argument('priority', 0)
 
@@ -124,155 +434,236 @@ class PrioritizePlayer(handler.BaseHandler):
             self.write('{"status":1,"error":"Please enter a player"}')
             return
 
-        with db.getCur() as cur:
-            cur.execute("UPDATE CurrentPlayers Set Priority = ? WHERE PlayerId IN (SELECT Id FROM Players WHERE Players.Id = ? OR Players.Name = ?)", (priority, player, player))
+        cancelSeating()
+        await workers.run_db(prioritizeCurrentPlayer, player, priority)
+        push.publish('currentplayers')
 
-            self.write('{"status":0}')
+        self.write('{"status":0}')
 
-class ClearCurrentPlayers(handler.BaseHandler):
+def removeCurrentPlayer(player):
+    with db.getCur() as cur:
+        cur.execute("DELETE FROM CurrentPlayers WHERE PlayerId = ?",
+                    (players.resolve(cur, player),))
+
+def prioritizeCurrentPlayer(player, priority):
+    with db.getCur() as cur:
+        cur.execute("UPDATE CurrentPlayers Set Priority = ? WHERE PlayerId = ?",
+                    (priority, players.resolve(cur, player)))
+
+class SeatingConstraints(handler.BaseHandler):
+    """Get the seating constraints: the pairs of current players who must
+    or must not share a table, the players pinned to a table, and the
+    tables whose capacity is set to 4 or 5"""
     @tornado.web.authenticated
-    def post(self):
-        with db.getCur() as cur:
-            cur.execute("DELETE FROM CurrentPlayers")
-            cur.execute("DELETE FROM CurrentTables")
-            self.set_header('Content-Type', 'application/json')
+    @handler.data_version_etag
+    async def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(await workers.run_db(seatingConstraints)))
+
+def seatingConstraints():
+    with db.getCur() as cur:
+        cur.execute("SELECT a.Name, b.Name, Together FROM SeatingPairs"
+                    " JOIN Players AS a ON a.Id = SeatingPairs.PlayerId"
+                    " JOIN Players AS b ON b.Id = SeatingPairs.OtherId"
+                    " ORDER BY a.Name, b.Name")
+        pairs = [{"player":a, "other":b, "together":together == 1}
+                 for a, b, together in cur.fetchall()]
+        cur.execute("SELECT Name, TableNumber FROM CurrentPlayers"
+                    " JOIN Players ON Players.Id = PlayerId"
+                    " WHERE TableNumber IS NOT NULL ORDER BY TableNumber, Name")
+        pinned = [{"player":name, "table":table}
+                  for name, table in cur.fetchall()]
+        cur.execute("SELECT TableNumber, Capacity FROM SeatingTables"
+                    " ORDER BY TableNumber")
+        tables = [{"table":table, "capacity":capacity}
+                  for table, capacity in cur.fetchall()]
+    return {"status":0, "pairs":pairs, "pinned":pinned, "tables":tables}
+
+class SeatingPair(handler.BaseHandler):
+    """Require two current players to share a table (together=1) or not
+    (together=0), or drop the constraint on them (remove=1)"""
+    @tornado.web.authenticated
+    async def post(self):
+        self.set_header('Content-Type', 'application/json')
+        player = self.get_argument('player', None)
+        other = self.get_argument('other', None)
+        if not player or not other:
+            self.write('{"status":1,"error":"Please enter two players"}')
+            return
+        cancelSeating()
+        error = await workers.run_db(
+            setSeatingPair, player, other,
+            self.get_argument('together', '0') == '1',
+            self.get_argument('remove', '0') == '1')
+        push.publish('currentplayers')
+        if error:
+            self.write(json.dumps({"status":1, "error":error}))
+        else:
             self.write('{"status":0}')
 
-class CurrentTables(tornado.web.RequestHandler):
-    def get(self):
+def setSeatingPair(player, other, together, remove=False):
+    "Set or remove the constraint on a pair.  Returns an error message or None"
+    with db.getCur() as cur:
+        ids = players.resolve_many(cur, [player, other])
+        cur.execute("SELECT PlayerId FROM CurrentPlayers")
+        current = set(row[0] for row in cur.fetchall())
+        if not all(ids.get(p) in current for p in (player, other)):
+            return "Both players must be current players"
+        a, b = sorted((ids[player], ids[other]))
+        if a == b:
+            return "Please enter two different players"
+        cur.execute("DELETE FROM SeatingPairs WHERE PlayerId = ? AND OtherId = ?",
+                    (a, b))
+        if not remove:
+            cur.execute("INSERT INTO SeatingPairs(PlayerId, OtherId, Together)"
+                        " VALUES (?, ?, ?)", (a, b, 1 if together else 0))
+    return None
+
+class PinPlayer(handler.BaseHandler):
+    "Pin a current player to a table number, or unpin them if there's none"
+    @tornado.web.authenticated
+    async def post(self):
         self.set_header('Content-Type', 'application/json')
-        result = {"status":"error", "message":"Unknown error ocurred"}
-        with db.getCur() as cur:
-            cur.execute("SELECT Players.Name FROM CurrentTables INNER JOIN Players ON Players.Id = CurrentTables.PlayerId")
-            rows = cur.fetchall()
-            numplayers = len(rows)
-            if numplayers < 4 or numplayers in [11, 7, 6]:
-                result["message"] = "Invalid number of players: " + str(numplayers)
-            else:
-                if numplayers >= 8:
-                    tables_5p = numplayers % 4
-                    total_tables = math.floor(numplayers / 4)
-                    tables_4p = total_tables - tables_5p
-                else:
-                    if numplayers == 5:
-                        tables_5p = 1
-                    else:
-                        tables_5p = 0
-                    total_tables = 1
-                    tables_4p = total_tables - tables_5p
-
-                result["tables"] = []
-                places = "東南西北５"
-                for table in range(total_tables):
-                    if table < tables_4p:
-                        players = [{"wind":places[player], "name":rows[table * 4 + player][0]} for player in range(4)]
-                    else:
-                        players = [{"wind":places[player], "name":rows[table * 4 + (table - tables_4p) + player][0]} for player in range(5)]
-                    result["tables"] += [{
-                            "index":str(table + 1),
-                            "players":players
-                        }]
-                result["status"] = "success"
-                result["message"] = "Generated tables"
-            self.write(json.dumps(result))
-
-
-class PlayersList(tornado.web.RequestHandler):
-    def get(self):
-        with db.getCur() as cur:
-            self.set_header('Content-Type', 'application/json')
-            cur.execute("SELECT Name FROM Players WHERE Id != ? ORDER BY Name",
-                        (db.getUnusedPointsPlayerID(),))
-            self.write(json.dumps(list(map(lambda x:x[0], cur.fetchall()))))
-
-POPULATION = 256
-
-def bestArrangement(tables, playergames, priorities, population = POPULATION):
-    numplayers = len(tables)
-
-    tabless = []
-    for i in range(POPULATION):
-        tables = tables[:]
-        random.shuffle(tables)
-        tabless += [(tablesScore(tables, playergames, priorities), tables)]
-    tabless.sort(key=itemgetter(0))
-
-    minScore = tabless[0][0]
-    iteration = 0
-
-    while iteration < numplayers and minScore > 0:
-        for j in range(POPULATION):
-            newTables = mutateTables(tabless[j][1])
-            tabless += [(tablesScore(newTables, playergames, priorities), newTables)]
-        tabless.sort(key=itemgetter(0))
-        tabless = tabless[0:POPULATION]
-
-        iteration += 1
-        if minScore != tabless[0][0]:
-            minScore = tabless[0][0]
-            improved = 0
-
-    return tabless[0][1]
-
-def mutateTables(tables):
-    tables = tables[:]
-    a = random.randint(0, len(tables) - 1)
-    b = random.randint(0, len(tables) - 1)
-    tables[a], tables[b] = tables[b], tables[a]
-
-    return tables
-
-def tablesScore(players, playergames, priorities):
-    numplayers = len(players)
-    if numplayers >= 8:
-        tables_5p = numplayers % 4
-        total_tables = int(numplayers / 4)
-        tables_4p = total_tables - tables_5p
-    else:
-        if numplayers >= 5:
-            tables_5p = 1
+        player = self.get_argument('player', None)
+        table = self.get_argument('table', '')
+        if player is None or player == "":
+            self.write('{"status":1,"error":"Please enter a player"}')
+            return
+        if table != '' and not (table.isdigit() and int(table) > 0):
+            self.write('{"status":1,"error":"Invalid table number"}')
+            return
+        cancelSeating()
+        await workers.run_db(pinCurrentPlayer, player,
+                             int(table) if table else None)
+        push.publish('currentplayers')
+        self.write('{"status":0}')
+
+def pinCurrentPlayer(player, table):
+    with db.getCur() as cur:
+        cur.execute("UPDATE CurrentPlayers SET TableNumber = ? WHERE PlayerId = ?",
+                    (table, players.resolve(cur, player)))
+
+class TableCapacity(handler.BaseHandler):
+    """Set a table number's capacity to 4 or 5 players, or clear it so the
+    table can get a fifth player if needed"""
+    @tornado.web.authenticated
+    async def post(self):
+        self.set_header('Content-Type', 'application/json')
+        table = self.get_argument('table', '')
+        capacity = self.get_argument('capacity', '')
+        if not (table.isdigit() and int(table) > 0):
+            self.write('{"status":1,"error":"Invalid table number"}')
+            return
+        if capacity not in ('', '4', '5'):
+            self.write('{"status":1,"error":"The capacity must be 4 or 5"}')
+            return
+        cancelSeating()
+        await workers.run_db(setTableCapacity, int(table),
+                             int(capacity) if capacity else None)
+        push.publish('currentplayers')
+        self.write('{"status":0}')
+
+def setTableCapacity(table, capacity):
+    with db.getCur() as cur:
+        if capacity is None:
+            cur.execute("DELETE FROM SeatingTables WHERE TableNumber = ?",
+                        (table,))
         else:
-            tables_5p = 0
-        total_tables = 1
-        tables_4p = total_tables - tables_5p
+            cur.execute("INSERT OR REPLACE INTO SeatingTables(TableNumber,"
+                        " Capacity) VALUES (?, ?)", (table, capacity))
 
-    score = 0
+def clearCurrentPlayers():
+    with db.getCur() as cur:
+        cur.execute("DELETE FROM CurrentPlayers")
+        cur.execute("DELETE FROM SessionSeats")
+        cur.execute("DELETE FROM SessionRounds")
 
-    for i in range(0, tables_4p * 4, 4):
-        table = players[i:i+4]
-        score += tableScore(table, playergames, priorities)
-
-    for i in range(tables_4p * 4, numplayers, 5):
-        table = players[i:i+5]
-        score += tableScore(table, playergames, priorities)
-
-    return score
+class ClearCurrentPlayers(handler.BaseHandler):
+    @tornado.web.authenticated
+    async def post(self):
+        cancelSeating()
+        await workers.run_db(clearCurrentPlayers)
+        push.publish('currentplayers', 'seating')
+        self.set_header('Content-Type', 'application/json')
+        self.write('{"status":0}')
 
-def tableScore(players, playergames, priorities):
-    numplayers = len(players)
+class CurrentTables(tornado.web.RequestHandler):
+    """Show the tables of a round of the session plan given by the round
+    argument, or of the latest round started, or the first round if none
+    has started"""
+    @handler.data_version_etag
+    async def get(self):
+        self.set_header('Content-Type', 'application/json')
+        round = self.get_argument('round', None)
+        if round is not None and not round.isdigit():
+            self.write(json.dumps({"status":"error",
+                                   "message":"Invalid round: " + round}))
+            return
+        self.write(json.dumps(await workers.run_db(
+            roundTables, None if round is None else int(round))))
+
+def roundTables(round=None):
+    result = {"status":"error", "message":"Unknown error ocurred"}
+    with db.getCur() as cur:
+        cur.execute("SELECT COUNT(Started), COUNT(*) FROM SessionRounds")
+        started, planned = cur.fetchone()
+        if round is None:
+            round = max(started, 1)
+        cur.execute("SELECT Players.Name, TableNumber FROM SessionSeats"
+                    " INNER JOIN Players ON Players.Id = SessionSeats.PlayerId"
+                    " WHERE Round = ? ORDER BY Seat", (round,))
+        rows = cur.fetchall()
+    result.update({"round":round, "rounds":planned,
+                   "started":round <= started})
+    numplayers = len(rows)
+    if numplayers < 4 or numplayers in [11, 7, 6]:
+        result["message"] = "Invalid number of players: " + str(numplayers)
+    else:
+        tables = {}
+        for name, table in rows:
+            if table is not None:
+                tables.setdefault(table, []).append(name)
+        result["tables"] = []
+        places = "東南西北５"
+        for table in sorted(tables):
+            players = [{"wind":places[player], "name":name}
+                       for player, name in enumerate(tables[table])]
+            result["tables"] += [{
+                    "index":str(table),
+                    "players":players
+                }]
+        result["status"] = "success"
+        result["message"] = "Generated tables"
+    return result
+
+push.register('seating', roundTables)
+push.register('currentplayers', sessionPlayers, authenticated=True)
+
+def playerNames():
+    return cache.fetch("playernames", ['players'], computePlayerNames)
+
+def computePlayerNames():
+    with db.getCur() as cur:
+        cur.execute("SELECT Name FROM Players WHERE Id != ? ORDER BY Name",
+                    (db.getUnusedPointsPlayerID(),))
+        return list(map(lambda x:x[0], cur.fetchall()))
 
-    score = 0
-    for i in range(numplayers):
-        for j in range(i + 1, numplayers):
-            if (players[i], players[j]) in playergames:
-                score += playergames[(players[i], players[j])]
-            elif (players[j], players[i]) in playergames:
-                score += playergames[(players[j], players[i])]
-        if priorities[players[i]] == 1 and numplayers == 5:
-            score += 100
-    return score
+class PlayersList(tornado.web.RequestHandler):
+    @handler.data_version_etag
+    async def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(await workers.run_db(playerNames)))
 
 def playerGames(players, c):
+    """Count the games each pair of the players have played together this
+    quarter from the PairCounts kept up to date as games are entered.
+    Returns a symmetric matrix, as a list of lists, indexed by the players'
+    positions in the list."""
     numplayers = len(players)
-
-    playergames = dict()
-    now = datetime.datetime.now()
-    now = str(now.year) + " " + str(int((now.month - 1) / 3))
-
-    for i in range(numplayers):
-        for j in range(i + 1, numplayers):
-            games = c.execute("SELECT COUNT(*) FROM Scores WHERE PlayerId = ? AND GameId IN (SELECT GameId FROM Scores WHERE PlayerId = ?) AND strftime('%Y', Date) || ' ' || ((strftime('%m', Date) - 1) / 3) = ?", (players[i], players[j], now)).fetchone()[0]
-            if games != 0:
-                playergames[(players[i], players[j])] = games
+    position = dict((player, i) for i, player in enumerate(players))
+    playergames = [[0] * numplayers for i in range(numplayers)]
+    for (a, b), games in db.pairGames(c, players).items():
+        i, j = position[a], position[b]
+        playergames[i][j] = playergames[j][i] = games
 
     return playergames
@@ -17,15 +17,24 @@ $(function() {
 		getData($("#period").val());
 	});
 
-	function getData(period) {
+	function getData(period, retries) {
 		if (periods.indexOf(period) === -1)
 			period = "quarter";
+		if (retries === undefined)
+			retries = 5;
 		$.getJSON("/leaderdata/" + period,
-			function(data) {
+			function(data, status, xhr) {
 				scores = data;
 				$("#leaderboards").html(Mustache.render(leaderboard, data));
 				$(".ordering").click(changeOrdering);
 				updateLeaderScores($("#min_games").val(), rank_visible());
+				/* Stale leaderboards are being rebuilt, so check again */
+				var warning = xhr.getResponseHeader("Warning");
+				if (warning && warning.indexOf("110") === 0 && retries > 0)
+					setTimeout(function() {
+						if ($("#period").val() === period)
+							getData(period, retries - 1);
+					}, 1000);
 			});
 	}
 
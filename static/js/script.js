@@ -1,4 +1,39 @@
 (function($) {
+	// Subscribe to push channels, calling onData(channel, data) with each
+	// snapshot.  Reconnects with a growing delay after the socket closes.
+	// The returned object's connected() tells pages when to poll instead.
+	window.pushChannels = function(channels, onData) {
+		var push = {
+			socket: null,
+			delay: 1000,
+			connected: function() {
+				return push.socket !== null &&
+					push.socket.readyState === WebSocket.OPEN;
+			}
+		};
+		function connect() {
+			if (!window.WebSocket)
+				return;
+			var protocol = location.protocol === "https:" ? "wss://" : "ws://";
+			push.socket = new WebSocket(protocol + location.host + "/push/" +
+				channels.join(","));
+			push.socket.onopen = function() {
+				push.delay = 1000;
+			};
+			push.socket.onmessage = function(event) {
+				var message = JSON.parse(event.data);
+				onData(message.channel, message.data);
+			};
+			push.socket.onclose = function() {
+				push.socket = null;
+				window.setTimeout(connect, push.delay);
+				push.delay = Math.min(push.delay * 2, 60000);
+			};
+		}
+		connect();
+		return push;
+	};
+
 	$(function() {
 		var players = null;
 
@@ -5,6 +5,7 @@
 		var tables = document.getElementById("tables");
 		var tablesTemplate;
 		var currentPlayersTemplate;
+		var constraintsTemplate;
 
 		$.get("/static/mustache/tables.mst", function(data) {
 			tablesTemplate = data;
@@ -14,6 +15,10 @@
 			currentPlayersTemplate = data;
 			Mustache.parse(currentPlayersTemplate);
 		});
+		$.get("/static/mustache/constraints.mst", function(data) {
+			constraintsTemplate = data;
+			Mustache.parse(constraintsTemplate);
+		});
 
 		$("#addperson").click(function() {
 			var val = $(selector).val();
@@ -52,6 +57,20 @@
 			}, 'json').fail(xhrError);
 		});
 		$("#regentables").click(regenTables);
+		$("#addpair").click(function() {
+			setPair($("#pairplayer").val(), $("#pairother").val(),
+				$("#pairtogether").val(), false);
+		});
+		$("#setcapacity").click(function() {
+			setCapacity($("#capacitytable").val(), $("#capacity").val());
+		});
+		$("#nextround").click(function() {
+			$.post("/seating/nextround", function(data) {
+				if (data.status !== 0)
+					console.log(data);
+				getCurrentTables();
+			}, 'json').fail(xhrError);
+		});
 
 		function removePlayer(player) {
 			$.post("/seating/removeplayer", {
@@ -72,50 +91,171 @@
 			}, 'json');
 		}
 
+		function pinPlayer(player, table) {
+			$.post("/seating/pin", {
+				player: player,
+				table: table
+			}, constraintChanged, 'json');
+		}
+
+		function setPair(player, other, together, remove) {
+			$.post("/seating/pair", {
+				player: player,
+				other: other,
+				together: together,
+				remove: remove ? 1 : 0
+			}, function(data) {
+				if (data.status === 0 && !remove) {
+					$("#pairplayer").val("");
+					$("#pairother").val("");
+				}
+				constraintChanged(data);
+			}, 'json');
+		}
+
+		function setCapacity(table, capacity) {
+			$.post("/seating/capacity", {
+				table: table,
+				capacity: capacity
+			}, constraintChanged, 'json');
+		}
+
+		function constraintChanged(data) {
+			if (data.status !== 0) {
+				console.log(data);
+				$("#seatingstatus").text(data.error);
+			}
+			else {
+				getCurrentPlayers();
+				getConstraints();
+				regenTables();
+			}
+		}
+
 		function regenTables() {
-			$.post("/seating/regentables", function(data) {
-				getCurrentTables();
+			var params = {};
+			if ($("#rounds").val())
+				params.rounds = $("#rounds").val();
+			$.post("/seating/regentables", params, function(data) {
+				if (data.status !== 0) {
+					console.log(data);
+					$("#seatingstatus").text(data.error);
+				}
+				else
+					pollSeating(data.job);
 			}, 'json').fail(xhrError);
 		}
 
+		function pollSeating(job) {
+			$.getJSON('/seating/status.json', {
+				job: job
+			}, function(data) {
+				if (data.status !== 0)
+					return console.log(data);
+				if (data.state === "running") {
+					$("#seatingstatus").text("SEARCHING" +
+						(data.score === undefined || data.score === null ? "" :
+							": BEST SCORE " + data.score + " AFTER " +
+							data.iterations + " SWAPS"));
+					window.setTimeout(function() {
+						pollSeating(job);
+					}, 500);
+				}
+				else {
+					if (data.state === "failed")
+						$("#seatingstatus").text(data.error);
+					else
+						$("#seatingstatus").text("");
+					if (data.state === "done")
+						getCurrentTables();
+				}
+			}).fail(xhrError);
+		}
+
 		function getCurrentPlayers() {
 			if (window.current_user !== undefined)
-				$.getJSON('/seating/currentplayers.json', function(data) {
-					if (data.players) {
-						data.players.forEach(function(player) {
-							player.id = player.name.replace(/ /g, "-");
-						});
-						$(people).html(Mustache.render(currentPlayersTemplate, data));
-						$(".priority").change(function() {
-							prioritizePlayer($(this).parent().data("name"), this.checked);
-						});
-						$(".deletebutton").click(function() {
-							removePlayer($(this).parent().data("name"));
-						});
-					}
-					else if (data.message)
-						$(people).html("<h1>" + data.message + "</h1>");
-				}).fail(xhrError);
+				$.getJSON('/seating/currentplayers.json', showCurrentPlayers).fail(xhrError);
+		}
+
+		function showCurrentPlayers(data) {
+			if (data.players) {
+				data.players.forEach(function(player) {
+					player.id = player.name.replace(/ /g, "-");
+				});
+				$(people).html(Mustache.render(currentPlayersTemplate, data));
+				$(".priority").change(function() {
+					prioritizePlayer($(this).parent().data("name"), this.checked);
+				});
+				$("#people .deletebutton").click(function() {
+					removePlayer($(this).parent().data("name"));
+				});
+				$(".pin").change(function() {
+					pinPlayer($(this).parent().data("name"), this.value);
+				});
+			}
+			else if (data.message)
+				$(people).html("<h1>" + data.message + "</h1>");
 		}
 
 
+		function getConstraints() {
+			if (window.current_user !== undefined)
+				$.getJSON('/seating/constraints.json', showConstraints).fail(xhrError);
+		}
+
+		function showConstraints(data) {
+			if (data.status !== 0)
+				return console.log(data);
+			$("#constraints").html(
+				Mustache.render(constraintsTemplate, data));
+			$("#constraints .constraint .deletebutton").click(function() {
+				var pair = $(this).parent();
+				setPair(pair.data("player"), pair.data("other"), 0, true);
+			});
+			$("#constraints .capacity .deletebutton").click(function() {
+				setCapacity($(this).parent().data("table"), "");
+			});
+		}
+
 		function getCurrentTables() {
-			$.getJSON('/seating/currenttables.json', function(data) {
-				if (data.status === "success")
-					$(tables).html(Mustache.render(tablesTemplate, {
-						"tables": data.tables
-					}));
-				else
-					$(tables).html("<h1>" + data.message + "</h1>");
-			}).fail(xhrError);
+			$.getJSON('/seating/currenttables.json', showCurrentTables).fail(xhrError);
+		}
+
+		function showCurrentTables(data) {
+			var heading = data.rounds > 0 ?
+				"<h2>ROUND " + data.round + " OF " + data.rounds +
+				(data.started ? "" : " (NOT STARTED)") + "</h2>" : "";
+			if (data.rounds > 0 && !$("#rounds").is(":focus"))
+				$("#rounds").val(data.rounds);
+			if (data.status === "success")
+				$(tables).html(heading + Mustache.render(tablesTemplate, {
+					"tables": data.tables
+				}));
+			else
+				$(tables).html(heading + "<h1>" + data.message + "</h1>");
 		}
 
 		function refresh() {
 			getCurrentPlayers();
+			getConstraints();
 			getCurrentTables();
 		}
+
+		// Changes are pushed while the socket is open, so only poll without it
+		var push = window.pushChannels(
+			window.current_user !== undefined ?
+			["seating", "currentplayers"] : ["seating"],
+			function(channel, data) {
+				if (channel === "seating")
+					showCurrentTables(data);
+				else {
+					showCurrentPlayers(data);
+					showConstraints(data.constraints);
+				}
+			});
 		window.setInterval(function() {
-			refresh();
+			if (!push.connected())
+				refresh();
 		}, 5000);
 		window.populatePlayerComplete();
 		refresh();
@@ -1,60 +1,88 @@
 $(function() {
 	var timerTemplate;
+	var push;
+	var received = performance.now();
 	$.get("/static/mustache/timer.mst", function(data) {
 		timerTemplate = data;
 		Mustache.parse(timerTemplate);
+		push = window.pushChannels(["timers"], function(channel, data) {
+			showTimers(data);
+		});
+		getTimers();
 	});
 
-	function startTimer(id) {
-		$.post("/timers/start", {
+	// The push socket is opened once the template has loaded, so poll
+	// until then and whenever it isn't connected
+	function pushed() {
+		return push !== undefined && push.connected();
+	}
+
+	function timerAction(action, id) {
+		$.post("/timers/" + action, {
 			"id": id
 		}, function(data) {
 			if (data.status !== 0)
 				console.log(data);
-			else
+			else if (!pushed())
 				getTimers();
 		});
 	}
 
+	function startTimer(id) {
+		timerAction("start", id);
+	}
+
 	function deleteTimer(id) {
-		$.post("/timers/delete", {
-			"id": id
-		}, function(data) {
-			if (data.status !== 0)
-				console.log(data);
-			else
-				getTimers();
-		});
+		timerAction("delete", id);
 	}
 
 	function getTimers() {
-		$.getJSON("/timers.json", function(data) {
-			data.current_user = window.current_user;
-			$("#timers").html(Mustache.render(timerTemplate, data));
-			$(".start").click(function() {
-				startTimer($(this).parent().data("id"));
-			});
-			$(".delete").click(function() {
-				deleteTimer($(this).parent().data("id"));
-			});
-			updateTimers();
+		$.getJSON("/timers.json", showTimers);
+	}
+
+	function showTimers(data) {
+		if (timerTemplate === undefined)
+			return;
+		// Count down from the server's remaining time using the time
+		// elapsed since it arrived, which doesn't depend on the clock's
+		// setting
+		received = performance.now();
+		data.current_user = window.current_user;
+		data.timers.forEach(function(timer) {
+			timer[timer.state] = true;
+		});
+		$("#timers").html(Mustache.render(timerTemplate, data));
+		$(".start").click(function() {
+			startTimer($(this).parent().data("id"));
+		});
+		$(".pause").click(function() {
+			timerAction("pause", $(this).parent().data("id"));
+		});
+		$(".resume").click(function() {
+			timerAction("resume", $(this).parent().data("id"));
+		});
+		$(".delete").click(function() {
+			deleteTimer($(this).parent().data("id"));
 		});
+		updateTimers();
 	}
 
 	function updateTimers() {
+		var elapsed = performance.now() - received;
 		$(".timer").each(function(i, timer) {
-			var time = $(timer).data("time");
 			var duration = new Date($(timer).data("duration") * 60 * 1000);
-			if (time === undefined)
-				time = new Date(new Date().getTime() + duration.getTime());
-			else
-				time = new Date(time.replace(/ /g, "T"));
-			var remaining = new Date(Math.max(time - new Date(), 0));
+			var remaining = $(timer).data("remaining");
+			if ($(timer).data("state") === "running")
+				remaining = Math.max(remaining - elapsed, 0);
+			remaining = new Date(Math.ceil(remaining / 1000) * 1000);
 			$(timer).children(".remaining").text(remaining.toUTCString().split(" ")[4] + "/" + duration.toUTCString().split(" ")[4]);
 		});
 	}
-	getTimers();
 	window.setInterval(updateTimers, 1000);
+	window.setInterval(function() {
+		if (!pushed())
+			getTimers();
+	}, 10000);
 
 	$("#clear").click(function() {
 		deleteTimer("all");
@@ -63,24 +91,30 @@ $(function() {
 		var data = {
 			"name": $("#name").val(),
 			"duration": $("#duration").val(),
+			"table": $("#table").val()
 		};
 		$.post("/timers/add", data, function(data) {
 			if (data.status !== 0)
 				console.log(data);
 			else {
-				getTimers();
+				if (!pushed())
+					getTimers();
 				$("#name").val("");
 				$("#duration").val("");
+				$("#table").val("");
 			}
 		}, 'json');
 	});
 	$("#start").click(function() {
 		startTimer();
 	});
-	$("#start").click(function() {
-		startTimer();
-	});
 	$("#reset").click(function() {
 		startTimer("all");
 	});
+	$("#pause").click(function() {
+		timerAction("pause", "all");
+	});
+	$("#resume").click(function() {
+		timerAction("resume", "all");
+	});
 });
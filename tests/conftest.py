@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+import cache
+import db
+
+RAWSCORES = [32000, 28000, 22000, 18000]
+
+def scores(names, raw=RAWSCORES):
+    "Make the scores of a game for addGame from player names or IDs"
+    return [{'player': name, 'score': score, 'chombos': 0}
+            for name, score in zip(names, raw)]
+
+def useDatabase(monkeypatch, directory):
+    """Switch to a new scores database and backup directory in a directory,
+    with an empty memory cache"""
+    directory.mkdir(parents=True, exist_ok=True)
+    monkeypatch.setattr(settings, 'DBFILE', str(directory / 'scores.db'))
+    monkeypatch.setattr(settings, 'DBBACKUPS', str(directory / 'backups'))
+    monkeypatch.setattr(cache, '_cache', cache.MemoryCache())
+    monkeypatch.setattr(db, '_unusedPointsPlayer', None)
+    db.init(force=True)
+    return settings.DBFILE
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    "Use a new scores database in a temporary directory"
+    yield useDatabase(monkeypatch, tmp_path)
+    db.getPool().close()
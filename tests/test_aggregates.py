@@ -0,0 +1,94 @@
+import pytest
+
+import admin
+import db
+import players
+from conftest import scores
+
+NAMES = ["Alice", "Bob", "Carol", "Dave", "Erin", "Frank"]
+
+def tableRows(query):
+    with db.getCur() as cur:
+        cur.execute(query)
+        return sorted(cur.fetchall())
+
+def playerPeriods():
+    return tableRows("SELECT PlayerId, Period, Name, ScoreSum, GameCount,"
+                     " DropSums FROM PlayerPeriods")
+
+def assertRebuildMatches(rows, rebuild):
+    "Check that rebuilding an aggregate table from Scores changes nothing"
+    incremental = rows()
+    rebuild()
+    assert incremental == rows()
+
+def gameIDs():
+    return [row[0] for row in tableRows("SELECT DISTINCT GameId FROM Scores")]
+
+@pytest.fixture
+def games(database):
+    "Add games in two years and several quarters"
+    for names, date in [(NAMES[:4], "2016-12-30"), (NAMES[1:5], "2017-01-03"),
+                        (NAMES[2:6], "2017-05-04"), (NAMES[:4], "2017-05-04")]:
+        assert db.addGame(scores(names), date)['status'] == 0
+    return gameIDs()
+
+def test_player_periods_after_add(games):
+    assert len(playerPeriods()) > 0
+    assertRebuildMatches(playerPeriods, db.rebuildPlayerPeriods)
+
+def test_player_periods_after_edit(games):
+    # Move a game to another year with a different player
+    result = db.addGame(scores(NAMES[2:6]), "2017-08-01", games[0])
+    assert result['status'] == 0
+    assertRebuildMatches(playerPeriods, db.rebuildPlayerPeriods)
+
+def test_player_periods_after_delete(games):
+    assert admin.deleteGame(games[1])
+    assertRebuildMatches(playerPeriods, db.rebuildPlayerPeriods)
+
+def test_player_periods_after_add_games(games):
+    result = db.addGames([{'scores': scores(NAMES[:4]), 'date': "2017-02-01"},
+                          {'scores': scores(NAMES[1:5]), 'date': "2018-01-01"},
+                          {'scores': scores(NAMES[2:6] + ["Grace"],
+                                            [30000, 30000, 25000, 20000,
+                                             20000]),
+                           'date': "2018-01-01"}])
+    assert result == {'status': 0, 'added': 3, 'errors': []}
+    assertRebuildMatches(playerPeriods, db.rebuildPlayerPeriods)
+
+def pairCounts():
+    return tableRows("SELECT Quarter, PlayerId, OtherId, Games FROM PairCounts")
+
+def test_pair_counts_after_add(games):
+    counts = pairCounts()
+    assertRebuildMatches(pairCounts, db.rebuildPairCounts)
+    # Only Carol and Dave played both of the games in 2017 2nd
+    assert sorted(row[3] for row in counts if row[0] == "2017 2nd") == (
+        [1] * 10 + [2])
+
+def test_pair_counts_after_edit(games):
+    result = db.addGame(scores(NAMES[2:6]), "2017-08-01", games[3])
+    assert result['status'] == 0
+    assertRebuildMatches(pairCounts, db.rebuildPairCounts)
+
+def test_pair_counts_after_delete(games):
+    assert admin.deleteGame(games[0])
+    assertRebuildMatches(pairCounts, db.rebuildPairCounts)
+    assert all(row[3] > 0 for row in pairCounts())
+
+def test_pair_counts_after_add_games(games):
+    result = db.addGames([{'scores': scores(NAMES[:4]), 'date': "2017-05-05"},
+                          {'scores': scores(NAMES[1:5]), 'date': "2017-05-05"}])
+    assert result['added'] == 2
+    assertRebuildMatches(pairCounts, db.rebuildPairCounts)
+
+def test_pair_games(games):
+    with db.getCur() as cur:
+        ids = dict((name, players.resolve(cur, name)) for name in NAMES)
+        pairs = db.pairGames(cur, ids.values(), "2017 2nd")
+    alice, bob, frank = ids["Alice"], ids["Bob"], ids["Frank"]
+    assert pairs[min(alice, bob), max(alice, bob)] == 1
+    assert pairs[min(ids["Carol"], ids["Dave"]),
+                 max(ids["Carol"], ids["Dave"])] == 2
+    assert (min(alice, frank), max(alice, frank)) not in pairs
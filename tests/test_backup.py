@@ -0,0 +1,61 @@
+import os
+import sqlite3
+
+import pytest
+
+import backup
+import db
+import settings
+from conftest import scores
+
+@pytest.fixture
+def manager(database, monkeypatch):
+    monkeypatch.setattr(settings, 'BACKUPDELAY', 60)
+    manager = backup.BackupManager()
+    monkeypatch.setattr(backup.BackupManager, 'instance', manager)
+    return manager
+
+def players(path):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute("SELECT COUNT(*) FROM Players").fetchone()[0]
+    finally:
+        con.close()
+
+def test_first_backup_is_made_before_the_change(manager):
+    db.make_backup()
+    assert len(backup.backup_files()) == 1
+    before = players(backup.backup_files()[0])
+    assert db.addGame(scores(["Alice", "Bob", "Carol", "Dave"]))['status'] == 0
+    assert players(backup.backup_files()[0]) == before
+
+def test_later_requests_are_coalesced(manager):
+    db.make_backup()
+    db.make_backup()
+    db.make_backup()
+    assert len(backup.backup_files()) == 1
+    assert manager.due is not None
+    stats = manager.statistics()
+    assert stats['requested'] == 3 and stats['coalesced'] == 1
+    manager.flush()
+    assert manager.due is None
+    assert manager.statistics()['snapshots'] == 2
+
+def test_background_requests_wait(manager):
+    backup.request()
+    assert backup.backup_files() == []
+    assert manager.due is not None
+
+def test_retention_keeps_newest(manager, monkeypatch):
+    monkeypatch.setattr(settings, 'BACKUPKEEP', 2)
+    os.makedirs(settings.DBBACKUPS)
+    paths = []
+    for i in range(4):
+        path = os.path.join(settings.DBBACKUPS,
+                            "2017-01-0{0}{1}".format(i + 1,
+                                                     backup.backup_suffix()))
+        open(path, 'w').close()
+        os.utime(path, (1000000 + i * 86400,) * 2)
+        paths.append(path)
+    assert sorted(backup.prune()) == sorted(paths[:2])
+    assert backup.backup_files() == paths[:1:-1]
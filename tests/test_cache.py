@@ -0,0 +1,115 @@
+import time
+import threading
+
+import pytest
+
+import cache
+
+@pytest.fixture(params=["memory", "disk"])
+def store(request, tmp_path):
+    if request.param == "disk":
+        return cache.DiskCache(str(tmp_path / "cache"))
+    return cache.MemoryCache(16)
+
+def waitFor(condition, timeout=5):
+    "Wait for a condition to become true, failing after timeout seconds"
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def counter(value="value"):
+    "Make a compute function that counts its calls"
+    calls = []
+    def compute():
+        calls.append(1)
+        return "{0}{1}".format(value, len(calls))
+    compute.calls = calls
+    return compute
+
+def test_fetch_caches_until_tag_invalidated(store):
+    compute = counter()
+    assert store.fetch("key", ["scores"], compute) == "value1"
+    assert store.fetch("key", ["scores"], compute) == "value1"
+    store.invalidate("players")
+    assert store.fetch("key", ["scores"], compute) == "value1"
+    store.invalidate("scores")
+    assert store.fetch("key", ["scores"], compute) == "value2"
+    assert len(compute.calls) == 2
+
+def test_invalidate_only_touches_tagged_values(store):
+    first, second = counter("a"), counter("b")
+    store.fetch("first", ["player:1"], first)
+    store.fetch("second", ["player:2"], second)
+    store.invalidate("player:1")
+    assert store.fetch("first", ["player:1"], first) == "a2"
+    assert store.fetch("second", ["player:2"], second) == "b1"
+
+def test_clear_invalidates_everything(store):
+    compute = counter()
+    store.fetch("key", ["scores"], compute)
+    store.clear()
+    assert store.fetch("key", ["scores"], compute) == "value2"
+
+def test_invalidation_during_compute_leaves_value_stale(store):
+    def compute():
+        store.invalidate("scores")
+        return "old"
+    assert store.fetch("key", ["scores"], compute) == "old"
+    assert store.get("key") is None
+
+def test_concurrent_misses_share_one_computation():
+    store = cache.MemoryCache(16)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "value"
+
+    results = []
+    def fetch():
+        results.append(store.fetch("key", ["scores"], compute))
+    threads = [threading.Thread(target=fetch) for i in range(4)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    waitFor(lambda: store.statistics().get('coalesced', 0) == 3)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ["value"] * 4
+    assert len(calls) == 1
+
+def test_errors_are_raised_and_not_cached():
+    store = cache.MemoryCache(16)
+    def fail():
+        raise ValueError("failed")
+    with pytest.raises(ValueError):
+        store.fetch("key", ["scores"], fail)
+    assert store.fetch("key", ["scores"], lambda: "value") == "value"
+
+def test_fetch_stale_serves_old_value_while_revalidating():
+    store = cache.MemoryCache(16)
+    store.fetch("key", ["scores"], lambda: "old")
+    store.invalidate("scores")
+    done = threading.Event()
+    def compute():
+        done.set()
+        return "new"
+    assert store.fetch_stale("key", ["scores"], compute) == ("old", True)
+    assert done.wait(5)
+    waitFor(lambda: store.get("key") is not None)
+    assert store.fetch_stale("key", ["scores"], compute) == ("new", False)
+
+def test_memory_cache_evicts_least_recently_used():
+    store = cache.MemoryCache(4)
+    for key in "abcdefgh":
+        store.fetch(key, [], lambda: key)
+    assert store.statistics()['evictions'] > 0
+    assert store.get("h") == "h"
+    assert store.get("a") is None
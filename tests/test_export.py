@@ -0,0 +1,67 @@
+import io
+import json
+
+import pytest
+
+import db
+import exportgames
+import importgames
+from conftest import scores, useDatabase
+
+GAMES = [
+    (scores(["Alice", "Bob", "Carol", "Dave"]), "2017-01-05"),
+    (scores(["Erin", "Carol", "Bob", "Alice"],
+            [40000, 30000, 20000, 10000]), "2017-04-02"),
+    ([{'player': "Alice", 'score': 30000, 'chombos': 1},
+      {'player': "Bob", 'score': 30000, 'chombos': 0},
+      {'player': "Carol", 'score': 25000, 'chombos': 0},
+      {'player': "Dave", 'score': 20000, 'chombos': 0},
+      {'player': "Erin", 'score': 20000, 'chombos': 2}], "2017-04-02"),
+]
+
+@pytest.fixture
+def games(database):
+    for game, date in GAMES:
+        assert db.addGame(game, date)['status'] == 0
+
+def export(fmt, **limits):
+    stream = io.StringIO()
+    count = exportgames.export(stream, fmt, **limits)
+    return stream.getvalue(), count
+
+@pytest.mark.parametrize("fmt", sorted(importgames.readers.keys()))
+def test_round_trip(games, fmt, tmp_path, monkeypatch):
+    exported, count = export(fmt)
+    assert count == 13
+    useDatabase(monkeypatch, tmp_path / "copy")
+    result = db.addGames(
+        importgames.readers[fmt](io.StringIO(exported, newline='')))
+    assert result == {'status': 0, 'added': 3, 'errors': []}
+    assert export(fmt) == (exported, count)
+
+def test_ndjson_games(games):
+    exported, count = export('ndjson')
+    games = [json.loads(line) for line in exported.splitlines()]
+    assert [(game['date'], game['quarter'], len(game['scores']))
+            for game in games] == [("2017-01-05", "2017 1st", 4),
+                                   ("2017-04-02", "2017 2nd", 4),
+                                   ("2017-04-02", "2017 2nd", 5)]
+    # Alice's chombo ranks her below Bob on the same raw score
+    ranks = dict((score['player'], (score['rank'], score['chombos']))
+                 for score in games[2]['scores'])
+    assert ranks["Bob"] == (1, 0)
+    assert ranks["Alice"][0] > 1 and ranks["Alice"][1] == 1
+
+def test_columnar_export_matches_csv(games):
+    exported, count = export('columnar')
+    columnar = json.loads(exported)
+    assert columnar['columns'] == exportgames.columns
+    rows = sum(len(chunk['game']) for chunk in columnar['chunks'])
+    assert rows == count == export('csv')[1]
+
+def test_export_limits(games):
+    assert export('csv', quarter="2017 2nd")[1] == 9
+    assert export('csv', start="2017-02-01", end="2017-12-31")[1] == 9
+    assert export('csv', player="Dave")[1] == 9
+    with pytest.raises(LookupError):
+        export('csv', player="Nobody")
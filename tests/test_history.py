@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+
+import db
+import history
+import main
+import players
+from conftest import scores
+
+NAMES = ["Alice", "Bob", "Carol", "Dave", "Erin"]
+DATES = ["2017-05-{0:02d}".format(day) for day in range(1, 13)]
+
+@pytest.fixture
+def games(database):
+    "Add two games on each of 12 dates, one of them without Alice"
+    for date in DATES:
+        assert db.addGame(scores(NAMES[:4]), date)['status'] == 0
+        assert db.addGame(scores(NAMES[1:]), date)['status'] == 0
+
+def pageDates(page):
+    games, newer, older = page
+    return sorted(set(game['date'] for game in games), reverse=True)
+
+def walk(player=None, perpage=5):
+    "Page back through the history from the latest games to the first"
+    pages = [history.historyPage(player, perpage=perpage)]
+    while pages[-1][2] is not None:
+        pages.append(history.historyPage(player, before=pages[-1][2],
+                                         perpage=perpage))
+    return pages
+
+def test_pages_hold_whole_dates(games):
+    pages = walk()
+    assert [pageDates(page) for page in pages] == [
+        DATES[11:6:-1], DATES[6:1:-1], DATES[1::-1]]
+    for page in pages:
+        assert len(page[0]) == 2 * len(pageDates(page))
+    assert pages[0][1] is None
+    assert pages[1][1:] == (DATES[6], DATES[2])
+
+def test_newer_pages_return_to_the_same_dates(games):
+    pages = walk()
+    newer = history.historyPage(after=pages[2][1], perpage=5)
+    assert pageDates(newer) == pageDates(pages[1])
+    assert newer[1:] == pages[1][1:]
+    latest = history.historyPage(after=newer[1], perpage=5)
+    assert pageDates(latest) == pageDates(pages[0])
+    assert latest[1] is None
+
+def test_player_pages_only_have_their_games(games):
+    with db.getCur() as cur:
+        alice = players.resolve(cur, "Alice")
+    pages = walk(alice, perpage=3)
+    assert len(pages) == 4
+    for page in pages:
+        assert len(page[0]) == len(pageDates(page)) == 3
+        assert all("Alice" in [score['name'] for score in game['scores']]
+                   for game in page[0])
+
+@pytest.mark.parametrize("cursor", ["2017-05-32", "junk", "2017-05-02:12"])
+def test_invalid_cursors(cursor):
+    with pytest.raises(ValueError):
+        history.parseCursor(cursor)
+
+def fetch(app, path):
+    async def request():
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(sockets)
+        try:
+            return await tornado.httpclient.AsyncHTTPClient().fetch(
+                "http://127.0.0.1:{0}{1}".format(
+                    sockets[0].getsockname()[1], path),
+                follow_redirects=False, raise_error=False)
+        finally:
+            server.stop()
+    return asyncio.run(request())
+
+def test_numbered_pages_redirect_to_latest(games):
+    app = main.Application(force=True)
+    response = fetch(app, "/history/3")
+    assert response.code == 301
+    assert response.headers['Location'] == "/history"
+    response = fetch(app, "/playerhistory/Alice/2")
+    assert response.code == 301
+    assert response.headers['Location'] == "/playerhistory/Alice"
+    assert fetch(app, "/historydata/2").code == 404
+    assert fetch(app, "/history?before=" + DATES[5]).code == 200
@@ -0,0 +1,111 @@
+import random
+
+import pytest
+
+import optimizer
+import settings
+
+def players(numplayers, seed=1):
+    "Make a random co-play matrix and priorities for a number of players"
+    rng = random.Random(seed)
+    playergames = optimizer.randomPlayerGames(numplayers, rng=rng)
+    priorities = [rng.randint(0, 1) for i in range(numplayers)]
+    return playergames, priorities
+
+def tables(arrangement, sizes=None):
+    "Get the sets of players at each table of an arrangement"
+    return [set(arrangement[seat] for seat in seats)
+            for seats in optimizer.tableSeats(len(arrangement), sizes)]
+
+@pytest.mark.parametrize("numplayers, sizes", [
+    (8, [4, 4]), (9, [4, 5]), (13, [4, 4, 5]), (16, [4, 4, 4, 4]),
+    (17, [4, 4, 4, 5]), (21, [4, 4, 4, 4, 5])])
+def test_table_layout(numplayers, sizes):
+    assert optimizer.tableLayout(numplayers) == sizes
+    assert [len(seats) for seats in optimizer.tableSeats(numplayers)] == sizes
+
+@pytest.mark.parametrize("numplayers", [3, 6, 7])
+def test_table_layout_impossible(numplayers):
+    with pytest.raises(ValueError):
+        optimizer.tableLayout(numplayers)
+
+@pytest.mark.skipif(optimizer.numpy is None, reason="NumPy isn't installed")
+@pytest.mark.parametrize("numplayers", [4, 5, 9, 16, 23])
+def test_engines_score_alike(numplayers):
+    playergames, priorities = players(numplayers)
+    rng = random.Random(numplayers)
+    population = [rng.sample(range(numplayers), numplayers)
+                  for i in range(32)]
+    scorer = optimizer.PopulationScorer(numplayers, playergames, priorities)
+    assert scorer(optimizer.numpy.array(population)).tolist() == [
+        optimizer.tablesScore(arrangement, playergames, priorities)
+        for arrangement in population]
+
+@pytest.mark.parametrize("engine", optimizer.engines)
+def test_genetic_engines_arrange_every_player(engine):
+    if engine == 'numpy' and optimizer.numpy is None:
+        pytest.skip("NumPy isn't installed")
+    playergames, priorities = players(13)
+    arrangement = optimizer.bestArrangement(
+        list(range(13)), playergames, priorities, population=16,
+        engine=engine)
+    assert sorted(arrangement) == list(range(13))
+
+@pytest.mark.parametrize("numplayers, rounds", [(8, 1), (13, 1), (20, 3)])
+def test_anneal_score_matches_arrangements(numplayers, rounds):
+    playergames, priorities = players(numplayers)
+    arrangements, score, iterations = optimizer.annealRounds(
+        list(range(numplayers)), playergames, priorities, rounds,
+        iterations=20000, seed=5)
+    assert len(arrangements) == rounds
+    for arrangement in arrangements:
+        assert sorted(arrangement) == list(range(numplayers))
+    assert score == optimizer.roundsScore(arrangements, playergames,
+                                          priorities)
+
+def test_anneal_improves_on_a_random_arrangement():
+    playergames, priorities = players(24)
+    start = list(range(24))
+    random.Random(3).shuffle(start)
+    arrangement, score, iterations = optimizer.annealArrangement(
+        list(range(24)), playergames, priorities, iterations=20000, seed=3)
+    assert score < optimizer.tablesScore(start, playergames, priorities)
+
+def test_seeded_search_is_repeatable_and_bounded(monkeypatch):
+    monkeypatch.setattr(settings, 'SEATINGTIME', 0.1)
+    monkeypatch.setattr(settings, 'SEATINGSTALL', 10 ** 9)
+    playergames, priorities = players(40)
+    first = optimizer.annealRounds(list(range(40)), playergames, priorities,
+                                   2, seed=11)
+    second = optimizer.annealRounds(list(range(40)), playergames, priorities,
+                                    2, seed=11)
+    assert first == second
+    assert first[2] <= 0.1 * optimizer.Annealer.SWAPRATE
+
+def test_constraints_are_kept():
+    playergames, priorities = players(17)
+    constraints = optimizer.Constraints(
+        together=[(0, 1), (1, 2)], apart=[(3, 4), (0, 5)],
+        pinned={6: 0, 3: 2}, capacities={3: 4, 0: 5})
+    sizes = constraints.layout(17)
+    assert sizes == [5, 4, 4, 4]
+    arrangements, score, iterations = optimizer.annealRounds(
+        list(range(17)), playergames, priorities, 3, iterations=20000,
+        seed=2, constraints=constraints)
+    assert score == optimizer.roundsScore(arrangements, playergames,
+                                          priorities, sizes)
+    for arrangement in arrangements:
+        seated = tables(arrangement, sizes)
+        tableOf = dict((player, table) for table, group in enumerate(seated)
+                       for player in group)
+        assert tableOf[0] == tableOf[1] == tableOf[2]
+        assert tableOf[3] != tableOf[4] and tableOf[0] != tableOf[5]
+        assert tableOf[6] == 0 and tableOf[3] == 2
+
+def test_impossible_constraints_are_refused():
+    playergames, priorities = players(8)
+    constraints = optimizer.Constraints(
+        together=[(0, 1), (1, 2), (2, 3), (3, 4)])
+    with pytest.raises(ValueError):
+        optimizer.annealRounds(list(range(8)), playergames, priorities, 1,
+                               seed=1, constraints=constraints)
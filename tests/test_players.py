@@ -0,0 +1,53 @@
+import db
+import players
+from conftest import scores
+
+NAMES = ["Alice", "Bob", "Carol", "Dave"]
+
+def test_names_resolve_without_case(database):
+    with db.getCur() as cur:
+        created = []
+        ids = players.resolve_many(cur, NAMES, create=True, created=created)
+        assert sorted(ids.values()) == sorted(created)
+        assert players.resolve(cur, "alice") == ids["Alice"]
+        assert players.resolve(cur, str(ids["Bob"])) == ids["Bob"]
+        assert players.resolve(cur, "Nobody") is None
+
+def test_numeric_names_are_names_first(database):
+    with db.getCur() as cur:
+        alice = players.resolve(cur, "Alice", create=True)
+        numbered = players.resolve(cur, str(alice + 10), create=True)
+        assert numbered != alice + 10
+        assert players.resolve(cur, str(alice + 10)) == numbered
+        assert players.resolve(cur, alice) == alice
+
+def test_unknown_player_ids_are_rejected(database):
+    result = db.addGame(scores(NAMES[:3] + [999]))
+    assert result == {"status": 1, "error": "Couldn't find player 999"}
+    with db.getCur() as cur:
+        cur.execute("SELECT COUNT(*) FROM Players WHERE Name IN (?, ?, ?)",
+                    NAMES[:3])
+        assert cur.fetchone()[0] == 0
+    result = db.addGames([{'scores': scores(NAMES)},
+                          {'scores': scores(NAMES[:3] + [998])}],
+                         skipInvalid=True)
+    assert result['added'] == 1
+    assert result['errors'] == [
+        {'game': 1, 'error': "Couldn't find player 998"}]
+
+def test_writes_check_ids_past_the_cache(database):
+    assert db.addGame(scores(NAMES))['status'] == 0
+    with db.getCur() as cur:
+        cur.execute("INSERT INTO Players(Name) VALUES('Ghost')")
+        ghost = cur.lastrowid
+    maps = players.playerMaps()
+    with db.getCur() as cur:
+        cur.execute("DELETE FROM Players WHERE Id = ?", (ghost,))
+    # The cached maps haven't been told about the deletion
+    assert players.playerMaps() is maps and ghost in maps['ids']
+    with db.getCur() as cur:
+        assert players.resolve(cur, ghost, cached=True) == ghost
+        assert players.resolve(cur, ghost) is None
+    result = db.addGame(scores(NAMES[:3] + [ghost]))
+    assert result == {"status": 1,
+                      "error": "Couldn't find player {0}".format(ghost)}
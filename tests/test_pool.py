@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+import db
+
+@pytest.mark.parametrize("sql, verb", [
+    ("SELECT * FROM Players", "SELECT"),
+    ("  select 1", "SELECT"),
+    ("WITH t AS (SELECT 1) SELECT * FROM t", "SELECT"),
+    ("WITH t(n) AS (SELECT ')') INSERT INTO Players(Name) SELECT n FROM t",
+     "INSERT"),
+    ("WITH RECURSIVE t(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM t"
+     " WHERE n < 3), u AS (SELECT 2) DELETE FROM Scores"
+     " WHERE GameId IN (SELECT n FROM t)", "DELETE"),
+    ("WITH t AS (SELECT 1) UPDATE Players SET Name = 'x'", "UPDATE"),
+    ("-- comment\nSELECT 1", "SELECT"),
+    ("/* (comment */ REPLACE INTO Players VALUES (1, 'x', NULL)", "REPLACE"),
+    ("PRAGMA user_version", "PRAGMA"),
+])
+def test_statement_verb(sql, verb):
+    assert db.statement_verb(sql) == verb
+
+def test_reads_skip_write_lock(database):
+    with db.getCur() as cur:
+        cur.execute("SELECT COUNT(*) FROM Players")
+        cur.execute("WITH t AS (SELECT 1) SELECT * FROM t")
+        assert not cur.has_write_lock
+
+def test_writes_take_write_lock_and_bump_version(database):
+    version = db.dataVersion()
+    with db.getCur() as cur:
+        cur.execute("WITH t AS (SELECT 'Alice' AS Name)"
+                    " INSERT INTO Players(Name) SELECT Name FROM t")
+        assert cur.has_write_lock
+    assert db.dataVersion() > version
+
+def test_rollback_releases_write_lock(database):
+    with pytest.raises(RuntimeError):
+        with db.getCur() as cur:
+            cur.execute("INSERT INTO Players(Name) VALUES('Alice')")
+            raise RuntimeError()
+    with db.getCur() as cur:
+        cur.execute("SELECT COUNT(*) FROM Players WHERE Name = 'Alice'")
+        assert cur.fetchone()[0] == 0
+    # The write lock is reentrant, so try it from another thread
+    acquired = []
+    def acquire():
+        lock = db.getPool().write_lock
+        acquired.append(lock.acquire(blocking=False))
+        if acquired[0]:
+            lock.release()
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    thread.join(5)
+    assert acquired == [True]
+
+def test_writers_wait_for_each_other(database):
+    done = threading.Event()
+
+    def writer():
+        with db.getCur() as cur:
+            cur.execute("INSERT INTO Players(Name) VALUES('Bob')")
+        done.set()
+
+    with db.getCur() as cur:
+        cur.execute("INSERT INTO Players(Name) VALUES('Alice')")
+        thread = threading.Thread(target=writer)
+        thread.start()
+        assert not done.wait(0.2)
+        # Readers aren't blocked by the writer
+        with db.getCur() as reader:
+            reader.execute("SELECT COUNT(*) FROM Players"
+                           " WHERE Name IN ('Alice', 'Bob')")
+            assert reader.fetchone()[0] == 0
+    thread.join(5)
+    assert done.is_set()
+    assert db.poolStats()['write_waits'] >= 1
+
+def test_connections_are_reused(database):
+    for i in range(3):
+        with db.getCur() as cur:
+            cur.execute("SELECT 1")
+    stats = db.poolStats()
+    assert stats['reused'] >= 2
+    assert stats['in_use'] == 0
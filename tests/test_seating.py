@@ -0,0 +1,43 @@
+import db
+import players
+import seating
+from conftest import scores
+
+NAMES = ["Alice", "Bob", "Carol", "Dave", "Erin", "Frank", "Grace", "Heidi"]
+
+def seatPlayers():
+    "Make the players current and plan two rounds at tables 1 and 2"
+    with db.getCur() as cur:
+        ids = [players.resolve(cur, name, create=True) for name in NAMES]
+        cur.executemany("INSERT INTO CurrentPlayers(PlayerId, Priority)"
+                        " VALUES(?, 0)", [(id,) for id in ids])
+    seating.saveRounds([ids, ids[::-1]], [1, 1, 1, 1, 2, 2, 2, 2], 1,
+                       [(id, 0, None) for id in ids])
+    return ids
+
+def gamesTogether():
+    ids, playergames, priorities, constraints, started, planned = (
+        seating.sessionPlayerGames())
+    return sum(map(sum, playergames)) // 2, started, planned
+
+def test_started_round_counts_until_its_games_are_entered(database):
+    seatPlayers()
+    assert gamesTogether() == (0, 0, 2)
+    assert seating.startNextRound() == 1
+    # Each table of 4 seats 6 pairs together
+    assert gamesTogether() == (12, 1, 2)
+    assert db.addGame(scores(NAMES[:4]))['status'] == 0
+    assert gamesTogether() == (12, 1, 2)
+    assert db.addGame(scores(NAMES[4:]))['status'] == 0
+    assert gamesTogether() == (12, 1, 2)
+    with db.getCur() as cur:
+        assert seating.recordedTables(cur) == {(1, 1), (1, 2)}
+
+def test_games_with_other_players_leave_the_table_counted(database):
+    seatPlayers()
+    seating.startNextRound()
+    assert db.addGame(scores(NAMES[:3] + ["Ivan"]))['status'] == 0
+    # Three pairs from the game plus the 12 pairs of the started tables
+    assert gamesTogether()[0] == 15
+    with db.getCur() as cur:
+        assert seating.recordedTables(cur) == set()
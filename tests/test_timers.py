@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+import timers
+
+def test_stopped_timer_shows_its_duration():
+    timer = timers.Timer(1, "Round 1", 30)
+    assert timer.state(100) == 'stopped'
+    assert timer.secondsLeft(100) == 30 * 60
+
+def test_running_timer_counts_down_and_expires():
+    timer = timers.Timer(1, "Round 1", 1)
+    timer.start(100)
+    assert timer.state(100) == 'running'
+    assert timer.secondsLeft(130) == 30
+    assert timer.state(160) == 'expired'
+    assert timer.secondsLeft(200) == 0
+
+def test_pause_and_resume_keep_the_remaining_time():
+    timer = timers.Timer(1, "Round 1", 10)
+    timer.start(0)
+    timer.pause(90)
+    assert timer.state(1000) == 'paused'
+    assert timer.secondsLeft(1000) == 510
+    timer.resume(1000)
+    assert timer.state(1000) == 'running'
+    assert timer.secondsLeft(1010) == 500
+    assert timer.status(1010) == {
+        "id": 1, "name": "Round 1", "duration": 10, "table": None,
+        "state": "running", "remaining": 500000}
+
+def test_pausing_only_affects_running_timers():
+    timer = timers.Timer(1, "Round 1", 1)
+    timer.pause(0)
+    assert timer.state(0) == 'stopped'
+    timer.start(0)
+    timer.pause(120)
+    assert timer.state(120) == 'expired'
+    timer.resume(120)
+    assert timer.state(120) == 'expired'
+
+def test_restart_clears_a_pause():
+    timer = timers.Timer(1, "Round 1", 1)
+    timer.start(0)
+    timer.pause(30)
+    timer.start(100)
+    assert timer.state(100) == 'running'
+    assert timer.secondsLeft(100) == 60
+
+@pytest.mark.parametrize("table, parsed", [
+    (None, None), ("", None), ("3", 3), ("12", 12)])
+def test_parse_table(table, parsed):
+    assert timers.parseTable(table) == parsed
+
+@pytest.mark.parametrize("table", ["0", "-1", "x", "1.5"])
+def test_parse_invalid_table(table):
+    with pytest.raises(ValueError):
+        timers.parseTable(table)
+
+def test_timers_are_restored_from_the_database(database, monkeypatch):
+    monkeypatch.setattr(timers, 'timers', {})
+    running = timers.Timer(timers.addTimer("Running", 10, 1), "Running", 10, 1)
+    paused = timers.Timer(timers.addTimer("Paused", 5, 2), "Paused", 5, 2)
+    stopped = timers.Timer(timers.addTimer("Stopped", 20, None), "Stopped",
+                           20)
+    now = time.monotonic()
+    running.start(now - 60)
+    paused.start(now - 60)
+    paused.pause(now - 30)
+    timers.saveTimers([timer.row(now) for timer in (running, paused)])
+
+    assert timers.load() == 3
+    now = time.monotonic()
+    restored = timers.timers
+    assert restored[running.id].state(now) == 'running'
+    assert abs(restored[running.id].secondsLeft(now) - 540) < 2
+    assert restored[running.id].table == 1
+    assert restored[paused.id].state(now) == 'paused'
+    assert restored[paused.id].secondsLeft(now) == pytest.approx(270)
+    assert restored[stopped.id].state(now) == 'stopped'
+    assert [timer['name'] for timer in timers.timerList(2)['timers']] == [
+        "Paused"]
@@ -1,63 +1,271 @@
 #!/usr/bin/env python3
 
+__doc__ = """
+Countdown timers for the rounds of play.  The timers are kept in memory
+with deadlines on the server's monotonic clock, so reading them needs no
+database access and every device counts down from the same server
+computed remaining time, whatever its own clock says.  The Timers table
+is only written when a timer changes, and the timers are restored from it
+at startup.  A running timer's Time is its wall clock deadline in local
+time, and a paused timer's Remaining is the seconds it had left.
+
+Timers may belong to a table number so that each table's timer can be
+started, paused, and resumed on its own, e.g. /timers/pause?table=3, or
+shown alone with /timers.json?table=3.
+"""
+
 import json
+import time
+import datetime
+import tornado.locks
 import tornado.web
 
-import handler
 import db
+import handler
+import push
+import workers
+
+timeFormat = "%Y-%m-%d %H:%M:%S"
+
+class Timer():
+    """A countdown of duration minutes.  It is stopped until started, then
+    running until its monotonic deadline passes, when it is expired.  A
+    running timer can be paused with the seconds remaining and resumed."""
+    def __init__(self, id, name, duration, table=None, deadline=None,
+                 remaining=None):
+        self.id = id
+        self.name = name
+        self.duration = duration
+        self.table = table
+        self.deadline = deadline
+        self.remaining = remaining
+
+    def state(self, now):
+        if self.remaining is not None:
+            return 'paused'
+        if self.deadline is None:
+            return 'stopped'
+        return 'running' if self.deadline > now else 'expired'
+
+    def secondsLeft(self, now):
+        if self.remaining is not None:
+            return self.remaining
+        if self.deadline is None:
+            return self.duration * 60
+        return max(0, self.deadline - now)
+
+    def start(self, now):
+        self.deadline = now + self.duration * 60
+        self.remaining = None
+
+    def pause(self, now):
+        if self.state(now) == 'running':
+            self.remaining = self.deadline - now
+            self.deadline = None
+
+    def resume(self, now):
+        if self.remaining is not None:
+            self.deadline = now + self.remaining
+            self.remaining = None
+
+    def status(self, now):
+        return {"id":self.id, "name":self.name, "duration":self.duration,
+                "table":self.table, "state":self.state(now),
+                "remaining":int(round(self.secondsLeft(now) * 1000))}
+
+    def row(self, now):
+        "Get the (Time, Remaining, Id) to save in the Timers table"
+        deadline = None
+        if self.deadline is not None:
+            deadline = (datetime.datetime.now() + datetime.timedelta(
+                seconds=self.deadline - now)).strftime(timeFormat)
+        return (deadline, self.remaining, self.id)
+
+timers = {}
+
+def load():
+    "Restore the timers from the Timers table, e.g. at startup"
+    now = time.monotonic()
+    wallclock = datetime.datetime.now()
+    timers.clear()
+    with db.getCur() as cur:
+        cur.execute("SELECT Id, Name, Duration, TableNumber, Time, Remaining"
+                    " FROM Timers")
+        for id, name, duration, table, deadline, remaining in cur.fetchall():
+            if deadline is not None:
+                try:
+                    deadline = now + (datetime.datetime.strptime(
+                        deadline, timeFormat) - wallclock).total_seconds()
+                except ValueError:
+                    deadline = None
+            timers[id] = Timer(id, name, duration or 0, table, deadline,
+                               remaining)
+    return len(timers)
+
+def timerList(table=None):
+    now = time.monotonic()
+    return {"timers":[timer.status(now) for id, timer in sorted(timers.items())
+                      if table is None or timer.table == table],
+            "now":int(time.time() * 1000)}
+
+push.register('timers', timerList, database=False)
+
+saving = tornado.locks.Lock()
+
+async def save(changed):
+    """Save the changed timers and tell the pages showing them.  Saves are
+    done one at a time so the table ends up with the latest state."""
+    now = time.monotonic()
+    rows = [timer.row(now) for timer in changed]
+    push.publish('timers')
+    async with saving:
+        await workers.run_db(saveTimers, rows)
+
+def saveTimers(rows):
+    with db.getCur() as cur:
+        cur.executemany("UPDATE Timers SET Time = ?, Remaining = ?"
+                        " WHERE Id = ?", rows)
+
+def addTimer(name, duration, table):
+    with db.getCur() as cur:
+        cur.execute("INSERT INTO Timers(Name, Duration, TableNumber)"
+                    " VALUES(?,?,?)", (name, duration, table))
+        return cur.lastrowid
+
+def deleteTimers(ids):
+    with db.getCur() as cur:
+        cur.executemany("DELETE FROM Timers WHERE Id = ?",
+                        [(id,) for id in ids])
+
+def parseTable(table):
+    "Parse a table number argument.  Raises ValueError if it's invalid"
+    if table is None or table == "":
+        return None
+    if not table.isdigit() or int(table) == 0:
+        raise ValueError("Invalid table number")
+    return int(table)
 
 class TimersHandler(handler.BaseHandler):
     def get(self):
         self.render("timers.html")
 
 class GetTimersHandler(handler.BaseHandler):
+    """Get the timers, or those of a table, with the milliseconds they have
+    left and the server's time in milliseconds since the epoch"""
     def get(self):
-        with db.getCur() as cur:
-            cur.execute("SELECT Id, Name, Time, Duration FROM Timers")
-            self.write(json.dumps({"timers":[{"id":row[0], "name":row[1],"time":row[2],"duration":row[3]} for row in cur.fetchall()]}))
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-cache')
+        try:
+            table = parseTable(self.get_argument("table", None))
+        except ValueError as e:
+            self.write(json.dumps({"status":1, "message":str(e)}))
+            return
+        self.write(json.dumps(timerList(table)))
+
+def candidates(chosen):
+    "Get the chosen timers, or all of them if none were chosen"
+    return list(timers.values()) if chosen is None else chosen
+
+class TimerAction(handler.BaseHandler):
+    """Base for changing the timers chosen by the id argument, which may be
+    "all", or the table argument.  Subclasses change the timers with act,
+    which returns the timers it changed.  The chosen timers are None if
+    neither argument is given."""
+
+    def chosen(self):
+        id = self.get_argument("id", None) or None
+        table = parseTable(self.get_argument("table", None))
+        if id == "all" or (id is None and table is not None):
+            return [timer for timer in timers.values()
+                    if table is None or timer.table == table]
+        if id is not None:
+            if not id.isdigit() or int(id) not in timers:
+                raise ValueError("Timer not found")
+            return [timers[int(id)]]
+        return None
+
+    @tornado.web.authenticated
+    async def post(self):
+        try:
+            chosen = self.chosen()
+        except ValueError as e:
+            self.write({"status":1, "message":str(e)})
+            return
+        now = time.monotonic()
+        changed = self.act(chosen, now)
+        if changed:
+            await save(changed)
+        self.write({"status":0, "message":"Success"})
 
 class AddTimer(handler.BaseHandler):
     @tornado.web.authenticated
-    def post(self):
-        ret = {"status":"error","message":"Unknown error occurred"}
+    async def post(self):
         name = self.get_argument("name", None)
-        duration = self.get_argument("duration", None)
-        with db.getCur() as cur:
-            cur.execute("INSERT INTO Timers(Name, Duration) VALUES(?,?)", (name,duration))
-            ret["status"] = 0
-            ret["message"] = "Success"
-        self.write(ret)
-
-class StartTimer(handler.BaseHandler):
-    @tornado.web.authenticated
-    def post(self):
-        ret = {"status":"error","message":"Unknown error occurred"}
-        id = self.get_argument("id", None)
-        with db.getCur() as cur:
-            if id == "all":
-                cur.execute("UPDATE Timers SET Time = datetime('now','localtime', '+' || Duration || ' minutes')")
-            elif id is not None:
-                cur.execute("UPDATE Timers SET Time = datetime('now','localtime', '+' || Duration || ' minutes') WHERE Id = ?", (id,))
-            else:
-                cur.execute("UPDATE Timers SET Time = datetime('now','localtime', '+' || Duration || ' minutes') WHERE Time IS NULL OR Time < datetime('now', 'localtime');")
-            ret["status"] = 0
-            ret["message"] = "Success"
-        self.write(ret)
-
-class DeleteTimer(handler.BaseHandler):
+        duration = self.get_argument("duration", "")
+        try:
+            table = parseTable(self.get_argument("table", None))
+        except ValueError as e:
+            self.write({"status":1, "message":str(e)})
+            return
+        try:
+            duration = float(duration)
+        except ValueError:
+            duration = 0
+        if not 0 < duration <= 24 * 60:
+            self.write({"status":1,
+                        "message":"Please enter a duration in minutes"})
+            return
+        if duration == int(duration):
+            duration = int(duration)
+        id = await workers.run_db(addTimer, name, duration, table)
+        timers[id] = Timer(id, name, duration, table)
+        push.publish('timers')
+        self.write({"status":0, "message":"Success"})
+
+class StartTimer(TimerAction):
+    """Start or restart the chosen timers.  With no timer chosen, start the
+    ones that are stopped or expired."""
+    def act(self, chosen, now):
+        if chosen is None:
+            chosen = [timer for timer in candidates(chosen)
+                      if timer.state(now) in ('stopped', 'expired')]
+        for timer in chosen:
+            timer.start(now)
+        return chosen
+
+class PauseTimer(TimerAction):
+    "Pause the chosen running timers, or all of them if none is chosen"
+    def act(self, chosen, now):
+        chosen = [timer for timer in candidates(chosen)
+                  if timer.state(now) == 'running']
+        for timer in chosen:
+            timer.pause(now)
+        return chosen
+
+class ResumeTimer(TimerAction):
+    "Resume the chosen paused timers, or all of them if none is chosen"
+    def act(self, chosen, now):
+        chosen = [timer for timer in candidates(chosen)
+                  if timer.state(now) == 'paused']
+        for timer in chosen:
+            timer.resume(now)
+        return chosen
+
+class DeleteTimer(TimerAction):
     @tornado.web.authenticated
-    def post(self):
-        id = self.get_argument("id", None)
-        ret = {"status":1,"message":"Unknown error occurred"}
-        with db.getCur() as cur:
-            if id == "all":
-                cur.execute("DELETE FROM Timers")
-                ret["status"] = 0
-                ret["message"] = "Timers cleared"
-            elif id is not None:
-                cur.execute("DELETE FROM Timers WHERE Id = ?", (id,))
-                ret["status"] = 0
-                ret["message"] = "Timer deleted"
-            else:
-                ret["message"] = "Please choose a timer"
-        self.write(ret)
+    async def post(self):
+        try:
+            chosen = self.chosen()
+        except ValueError as e:
+            self.write({"status":1, "message":str(e)})
+            return
+        if chosen is None:
+            self.write({"status":1, "message":"Please choose a timer"})
+            return
+        id = self.get_argument("id", None) or None
+        for timer in chosen:
+            timers.pop(timer.id, None)
+        await workers.run_db(deleteTimers, [timer.id for timer in chosen])
+        push.publish('timers')
+        self.write({"status":0, "message":"Timers cleared" if id == "all"
+                    else "Timer deleted"})
@@ -2,7 +2,7 @@
 
 import db
 import util
-import leaderboard
+import cache
 import settings
 
 def updateGame(cur, gameid):
@@ -22,6 +22,9 @@ def updateGame(cur, gameid):
               str(expectedtotal))
         return
 
+    periodKeys = db.gamePeriodKeys(cur, gameid)
+    pairs = db.gamePairs(cur, gameid)
+    tags = db.gameTags(cur, gameid)
     cur.execute("DELETE FROM Scores WHERE GameId = ?", (gameid,))
     for i in range(0, len(scores)):
         score = scores[i]
@@ -32,14 +35,18 @@ def updateGame(cur, gameid):
 
         cur.execute("INSERT INTO Scores(GameId, PlayerId, Rank, PlayerCount, RawScore, Chombos, Score, Date, Quarter) VALUES(?, ?, ?, ?, ?, ?, ?, ?, strftime('%Y', ?) || ' ' || case ((strftime('%m', ?) - 1) / 3) when 0 then '1st' when 1 then '2nd' when 2 then '3rd' when 3 then '4th' end)", (gameid, score['player'], i + 1, len(scores), score['score'], score['chombos'], adjscore, gamedate, gamedate, gamedate))
 
-        leaderboard.clearCache()
+    db.updatePlayerPeriods(cur, periodKeys)
+    db.updatePairCounts(cur, db.gamePairs(cur, gameid), pairs)
+    return tags
 
 def main():
+    tags = set()
     with db.getCur() as cur:
         cur.execute("SELECT GameId FROM Scores WHERE Quarter = '2017 2nd' AND Chombos > 0")
         games = cur.fetchall()
         for game in games:
-            updateGame(cur, game[0])
+            tags |= updateGame(cur, game[0]) or set()
+    cache.invalidate(*tags)
 
 
 if __name__ == "__main__":
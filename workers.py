@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Execution pools that keep blocking work off of the Tornado IOLoop.
+Database work runs in a bounded thread pool and CPU heavy work, like
+password hashing and seating arrangement searches, runs in a process pool.
+Each pool limits how many tasks may be waiting or running at once and how
+long a request will wait for its task to finish.  Handlers are coroutines
+that await the results, e.g.
+
+    rows = await workers.fetchall("SELECT Name FROM Players")
+    tables = await workers.run_cpu(seating.bestArrangement, players, ...)
+
+Tasks in the process pool can share dictionaries and events made by the
+multiprocessing manager() with the server, e.g. to report their progress
+or be cancelled.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+
+import tornado.web
+
+import db
+import settings
+
+log = logging.getLogger("WebServer")
+
+class WorkerPool():
+    """A lazily created executor with a limit on the number of pending
+    tasks and a timeout for each task.  Tasks are submitted from the IOLoop
+    thread, so the bookkeeping needs no locks."""
+    def __init__(self, name, executor_class, max_workers, max_pending,
+                 timeout):
+        self.name = name
+        self.executor_class = executor_class
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor = None
+        self.pending = 0
+        self.stats = collections.Counter()
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = self.executor_class(max_workers=self.max_workers)
+        return self.executor
+
+    async def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the pool and return its result.
+        Raises a 503 HTTPError if too many tasks are already pending and a
+        504 HTTPError if the task doesn't finish within the timeout.  Note
+        that a thread that times out still runs to completion."""
+        if self.pending >= self.max_pending:
+            self.stats['rejected'] += 1
+            log.warning("{0} pool is full with {1} pending tasks".format(
+                self.name, self.pending))
+            raise tornado.web.HTTPError(503, "Server busy, try again later")
+        self.pending += 1
+        self.stats['submitted'] += 1
+        self.stats['max_pending'] = max(self.stats['max_pending'],
+                                        self.pending)
+        try:
+            future = self.get_executor().submit(
+                functools.partial(func, *args, **kwargs))
+            return await asyncio.wait_for(asyncio.wrap_future(future),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            log.warning("{0} task {1} timed out after {2} seconds".format(
+                self.name, getattr(func, '__name__', func), self.timeout))
+            raise tornado.web.HTTPError(504, "Request timed out")
+        finally:
+            self.pending -= 1
+
+    def shutdown(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    def statistics(self):
+        stats = dict(self.stats)
+        stats.update({'workers': self.max_workers, 'pending': self.pending,
+                      'max_queue': self.max_pending, 'timeout': self.timeout})
+        return stats
+
+db_pool = WorkerPool(
+    "Database", concurrent.futures.ThreadPoolExecutor,
+    settings.DBWORKERS, settings.DBQUEUELIMIT, settings.DBTIMEOUT)
+# Worker processes are spawned rather than forked so that they don't
+# inherit the server's listening sockets, database connections, or locks
+cpu_pool = WorkerPool(
+    "CPU", functools.partial(concurrent.futures.ProcessPoolExecutor,
+                             mp_context=multiprocessing.get_context('spawn')),
+    settings.CPUWORKERS, settings.CPUQUEUELIMIT, settings.CPUTIMEOUT)
+
+_manager = None
+
+def manager():
+    """Get the multiprocessing manager, starting its process the first time.
+    The dictionaries, events, etc. it makes can be passed to tasks in the
+    process pool and are shared with the server.  The server starts it
+    before serving requests, and since every call to the manager or its
+    proxies waits on its process, handlers make them with run_db."""
+    global _manager
+    if _manager is None:
+        _manager = multiprocessing.get_context('spawn').Manager()
+    return _manager
+
+def run_db(func, *args, **kwargs):
+    "Run a function that uses the database in the database thread pool"
+    return db_pool.run(func, *args, **kwargs)
+
+def run_cpu(func, *args, **kwargs):
+    """Run a CPU heavy function in the process pool.  The function and its
+    arguments must be picklable, e.g. module level functions."""
+    return cpu_pool.run(func, *args, **kwargs)
+
+def _execute(sql, params, fetch):
+    with db.getCur() as cur:
+        cur.execute(sql, params)
+        return fetch(cur)
+
+def execute(sql, params=()):
+    "Execute a single statement in the database thread pool"
+    return run_db(_execute, sql, params, lambda cur: cur.rowcount)
+
+def fetchone(sql, params=()):
+    "Execute a query in the database thread pool and return its first row"
+    return run_db(_execute, sql, params, lambda cur: cur.fetchone())
+
+def fetchall(sql, params=()):
+    "Execute a query in the database thread pool and return all its rows"
+    return run_db(_execute, sql, params, lambda cur: cur.fetchall())
+
+def statistics():
+    return {'db': db_pool.statistics(), 'cpu': cpu_pool.statistics()}
+
+def shutdown(wait=True):
+    global _manager
+    db_pool.shutdown(wait=wait)
+    cpu_pool.shutdown(wait=wait)
+    if _manager is not None:
+        _manager.shutdown()
+        _manager = None